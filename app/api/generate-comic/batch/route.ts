@@ -0,0 +1,36 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { generateComicImages } from '@/lib/services/geminiServiceProxy';
+import { getProxyUserId } from '@/lib/auth';
+
+export async function POST(request: NextRequest) {
+  try {
+    const { panels, style, concurrency } = await request.json();
+
+    if (!Array.isArray(panels) || panels.length === 0 || !style) {
+      return NextResponse.json(
+        { success: false, error: 'Missing required fields' },
+        { status: 400 }
+      );
+    }
+
+    // 由代理服务器并发生成所有格，结果按格的顺序返回，单格失败不影响其他格
+    const results = await generateComicImages(panels, style, concurrency, await getProxyUserId(request));
+    const succeeded = results.filter((result: any) => result.success).length;
+
+    return NextResponse.json({
+      success: succeeded > 0,
+      results,
+      succeeded,
+      failed: results.length - succeeded
+    });
+  } catch (error) {
+    console.error('Error generating comic images:', error);
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : '批量生成图片失败'
+      },
+      { status: 500 }
+    );
+  }
+}
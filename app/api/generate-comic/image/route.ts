@@ -1,5 +1,15 @@
 import { NextRequest, NextResponse } from 'next/server';
-import { generatePanelImage } from '@/lib/services/geminiServiceProxy';
+import { generatePanelImage, generatePanelImageBinary } from '@/lib/services/geminiServiceProxy';
+import { getProxyUserId } from '@/lib/auth';
+
+/**
+ * Accept 头中的具体图片类型对应的转码格式（image/png 或 image/* 时不转码）
+ */
+function acceptedImageFormat(accept: string): 'jpeg' | 'webp' | undefined {
+  if (accept.includes('image/webp')) return 'webp';
+  if (accept.includes('image/jpeg')) return 'jpeg';
+  return undefined;
+}
 
 export async function POST(request: NextRequest) {
   const startTime = Date.now();
@@ -10,7 +20,8 @@ export async function POST(request: NextRequest) {
   console.log(`${'='.repeat(60)}\n`);
 
   try {
-    const { panel, style, referenceImageData } = await request.json();
+    const { panel, style, referenceImageData, format, quality } = await request.json();
+    const accept = request.headers.get('Accept') || '';
 
     console.log(`[API] 📥 请求参数:`);
     console.log(`[API]    - panelNumber: ${panel?.panelNumber}`);
@@ -27,9 +38,23 @@ export async function POST(request: NextRequest) {
 
     console.log(`[API] ✅ 参数验证通过`);
 
+    // Accept: image/* 时直接返回图片字节（不经过 Base64），格式取请求体的 format 或 Accept 中的具体类型
+    if (accept.includes('image/')) {
+      console.log(`[API] 🎨 调用 generatePanelImageBinary...`);
+      const { buffer, mimeType } = await generatePanelImageBinary(
+        panel, style, format ?? acceptedImageFormat(accept), quality, await getProxyUserId(request)
+      );
+
+      console.log(`[API] ✅ 图片生成成功 (${(buffer.length / 1024).toFixed(1)} KB, ${mimeType})，耗时 ${Date.now() - startTime}ms`);
+
+      return new NextResponse(new Uint8Array(buffer), {
+        headers: { 'Content-Type': mimeType, 'Vary': 'Accept' }
+      });
+    }
+
     // 生成图片
     console.log(`[API] 🎨 调用 generatePanelImage...`);
-    const imageData = await generatePanelImage(panel, style, referenceImageData);
+    const imageData = await generatePanelImage(panel, style, referenceImageData, await getProxyUserId(request));
 
     const endTime = Date.now();
     const duration = endTime - startTime;
@@ -0,0 +1,28 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { cancelComicJob } from '@/lib/services/geminiServiceProxy';
+
+/**
+ * 取消后台生成任务，已生成的格子保留
+ * POST /api/generate-comic/jobs/[jobId]/cancel
+ */
+export async function POST(
+  request: NextRequest,
+  { params }: { params: Promise<{ jobId: string }> }
+) {
+  try {
+    const { jobId } = await params;
+
+    await cancelComicJob(encodeURIComponent(jobId));
+
+    return NextResponse.json({ success: true });
+  } catch (error) {
+    console.error('Error cancelling comic job:', error);
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : '取消任务失败'
+      },
+      { status: 500 }
+    );
+  }
+}
@@ -0,0 +1,29 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getComicJob } from '@/lib/services/geminiServiceProxy';
+
+/**
+ * 查询后台生成任务的状态；?images=1 且任务已结束时返回带图片的完整结果
+ * GET /api/generate-comic/jobs/[jobId]
+ */
+export async function GET(
+  request: NextRequest,
+  { params }: { params: Promise<{ jobId: string }> }
+) {
+  try {
+    const { jobId } = await params;
+    const withImages = request.nextUrl.searchParams.get('images') === '1';
+
+    const job = await getComicJob(encodeURIComponent(jobId), withImages);
+
+    return NextResponse.json({ success: true, ...job });
+  } catch (error) {
+    console.error('Error fetching comic job:', error);
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : '查询任务失败'
+      },
+      { status: 500 }
+    );
+  }
+}
@@ -0,0 +1,33 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { submitComicJob } from '@/lib/services/geminiServiceProxy';
+import { getProxyUserId } from '@/lib/auth';
+
+/**
+ * 提交整部漫画的后台生成任务（脚本 + 全部图片），立即返回任务 ID
+ * POST /api/generate-comic/jobs
+ */
+export async function POST(request: NextRequest) {
+  try {
+    const { concept, style, concurrency } = await request.json();
+
+    if (!concept || !style) {
+      return NextResponse.json(
+        { success: false, error: 'Missing required fields' },
+        { status: 400 }
+      );
+    }
+
+    const jobId = await submitComicJob(concept, style, concurrency, await getProxyUserId(request));
+
+    return NextResponse.json({ success: true, jobId }, { status: 202 });
+  } catch (error) {
+    console.error('Error submitting comic job:', error);
+    return NextResponse.json(
+      {
+        success: false,
+        error: error instanceof Error ? error.message : '提交任务失败'
+      },
+      { status: 500 }
+    );
+  }
+}
@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { regeneratePanelImage } from '@/lib/services/geminiServiceProxy';
+import { getProxyUserId } from '@/lib/auth';
 
 export async function POST(request: NextRequest) {
   try {
@@ -12,8 +13,11 @@ export async function POST(request: NextRequest) {
       );
     }
 
-    // 重新生成图片
-    const imageData = await regeneratePanelImage(panel, style, referenceImageData);
+    // 重新生成图片（转发前端的 Idempotency-Key，同一次点击的重试不会重复生成）
+    const idempotencyKey = request.headers.get('Idempotency-Key') ?? undefined;
+    const imageData = await regeneratePanelImage(
+      panel, style, referenceImageData, idempotencyKey, await getProxyUserId(request)
+    );
 
     return NextResponse.json({
       success: true,
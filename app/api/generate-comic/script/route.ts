@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { generateComicScript } from '@/lib/services/geminiServiceProxy';
+import { getProxyUserId } from '@/lib/auth';
 import { MangaStyle } from '@/types/manga-generation';
 
 export async function POST(request: NextRequest) {
@@ -37,7 +38,7 @@ export async function POST(request: NextRequest) {
 
     // 生成脚本
     console.log(`[API] 📝 调用 generateComicScript...`);
-    const panels = await generateComicScript(concept);
+    const panels = await generateComicScript(concept, await getProxyUserId(request));
 
     const endTime = Date.now();
     const duration = endTime - startTime;
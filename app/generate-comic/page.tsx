@@ -11,6 +11,9 @@ import { useToast } from '@/lib/contexts/ToastContext';
 
 type Step = 'input' | 'script' | 'generating' | 'review' | 'publish' | 'publishing' | 'completed';
 
+// 重新生成单张图片的最多尝试次数（网络错误或 502/503/504 时重试）
+const REGENERATE_ATTEMPTS = 3;
+
 export default function GenerateComicPage() {
   const router = useRouter();
   const { showToast } = useToast();
@@ -113,54 +116,45 @@ export default function GenerateComicPage() {
       stage: 'generating-images',
       currentPanel: 0,
       totalPanels: panels.length,
-      message: '正在生成漫画图片...'
+      message: `正在并发生成 ${panels.length} 张漫画图片...`
     });
 
-    const updatedPanels = [...panels];
+    // 所有格一次提交给代理服务器并发生成，不再逐格请求、逐格等待
+    const updatedPanels = panels.map(panel => ({ ...panel }));
 
-    for (let i = 0; i < updatedPanels.length; i++) {
-      setGenerationProgress({
-        stage: 'generating-images',
-        currentPanel: i + 1,
-        totalPanels: updatedPanels.length,
-        message: `正在生成第 ${i + 1}/${updatedPanels.length} 张图片...`
+    try {
+      const response = await fetch('/api/generate-comic/batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ panels: updatedPanels, style: selectedStyle })
       });
 
-      try {
-        // 调用实际的图片生成API
-        const response = await fetch('/api/generate-comic/image', {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            panel: updatedPanels[i],
-            style: selectedStyle,
-            referenceImageData: i > 0 ? updatedPanels[i - 1].generatedImage : undefined
-          })
-        });
-
-        const data = await response.json();
-
-        if (!data.success) {
-          throw new Error(data.error || '生成图片失败');
-        }
-
-        // 更新生成的图片
-        updatedPanels[i].generatedImage = data.imageData;
-        updatedPanels[i].generationError = undefined;
-      } catch (error) {
-        console.error(`Error generating panel ${i + 1}:`, error);
-        updatedPanels[i].generationError = error instanceof Error ? error.message : '生成失败';
+      const data = await response.json();
 
-        // 如果是单个图片失败，继续生成其他图片
-        continue;
+      if (!data.results) {
+        throw new Error(data.error || '生成图片失败');
       }
 
-      setComicPanels([...updatedPanels]);
-
-      // 添加速率限制延迟
-      await new Promise(resolve => setTimeout(resolve, 2000));
+      // 结果按格的顺序返回，单格失败不影响其他格
+      data.results.forEach((result: any, i: number) => {
+        if (result.success) {
+          updatedPanels[i].generatedImage = result.imageData;
+          updatedPanels[i].generationError = undefined;
+        } else {
+          console.error(`Error generating panel ${i + 1}:`, result.error);
+          updatedPanels[i].generationError = result.error || '生成失败';
+        }
+      });
+    } catch (error) {
+      console.error('Error generating images:', error);
+      const message = error instanceof Error ? error.message : '生成失败';
+      updatedPanels.forEach(panel => {
+        panel.generationError = message;
+      });
     }
 
+    setComicPanels(updatedPanels);
+
     setIsGenerating(false);
     setCurrentStep('review');
 
@@ -181,13 +175,25 @@ export default function GenerateComicPage() {
       const panel = comicPanels.find(p => p.panelNumber === panelNumber);
       if (!panel) return;
 
-      const response = await fetch('/api/generate-comic/regenerate', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ panel, style: selectedStyle })
-      });
+      // 每次点击一个幂等键，这次点击的重试都带同一个键，代理服务器不会重复生成
+      const idempotencyKey = crypto.randomUUID();
+      let response: Response | undefined;
+      for (let attempt = 1; attempt <= REGENERATE_ATTEMPTS; attempt++) {
+        try {
+          response = await fetch('/api/generate-comic/regenerate', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey },
+            body: JSON.stringify({ panel, style: selectedStyle })
+          });
+          if (response.status < 502 || attempt === REGENERATE_ATTEMPTS) break;
+        } catch (error) {
+          // 网络错误：请求可能已经到达代理服务器，用同一个键重试
+          if (attempt === REGENERATE_ATTEMPTS) throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+      }
 
-      const data = await response.json();
+      const data = await response!.json();
 
       if (!data.success) {
         throw new Error(data.error || '重新生成失败');
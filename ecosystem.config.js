@@ -38,5 +38,28 @@ module.exports = {
       // 健康检查 - 移除 wait_ready，因为 next start 没有监听端口
       listen_timeout: 10000,
     },
+    {
+      name: 'gemini-proxy',
+      // Python 代理的生产入口：master 预加载应用后 fork 出 worker（数量见 GEMINI_WORKERS）
+      script: '.venv/bin/python',
+      args: '-m gemini_proxy.prefork',
+      interpreter: 'none',
+      cwd: path.resolve(__dirname),
+      instances: 1,
+      exec_mode: 'fork',
+      autorestart: true,
+      watch: false,
+      env: {
+        GEMINI_BIND: '127.0.0.1:3001',
+      },
+      error_file: path.join(__dirname, 'logs', 'proxy-err.log'),
+      out_file: path.join(__dirname, 'logs', 'proxy-out.log'),
+      merge_logs: true,
+      min_uptime: '5s',
+      max_restarts: 10,
+      restart_delay: 1000,
+      // worker 最多等待 GEMINI_GRACEFUL_TIMEOUT（默认 30 秒）处理完在途请求
+      kill_timeout: 35000,
+    },
   ],
 };
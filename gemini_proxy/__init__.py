@@ -0,0 +1,4 @@
+"""
+Gemini 代理服务器的内部组件
+由 gemini_proxy_server.py 使用
+"""
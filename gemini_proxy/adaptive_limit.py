@@ -0,0 +1,117 @@
+"""
+自适应并发限制 (AIMD)
+上游延迟和错误率正常时逐步放开在途请求数；遇到 429 或延迟突增时成倍收紧。
+超出限制的请求按优先级排队等待（见 scheduler），等待时间有上限
+"""
+
+import asyncio
+import time
+
+from gemini_proxy.key_pool import NoAvailableKeyError
+from gemini_proxy.resilience import api_error_code
+from gemini_proxy.scheduler import FairQueue, current_priority
+
+
+class LimiterTimeoutError(RuntimeError):
+    """排队等待超时，上游当前过载"""
+
+
+def is_throttle_error(error):
+    """上游限流：429，或所有 Key 都在限流冷却中"""
+    if isinstance(error, NoAvailableKeyError):
+        return True
+    return api_error_code(error) == 429
+
+
+class AdaptiveLimiter:
+    """AIMD 并发限制：每完成约 limit 个健康请求加 1，限流或延迟突增时乘以 decrease"""
+
+    def __init__(self, initial, minimum, maximum, decrease=0.5, latency_ratio=2.0, max_wait=60.0,
+                 starvation_timeout=10.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.decrease = decrease
+        self.latency_ratio = latency_ratio
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.baseline = None          # 健康延迟的指数滑动平均
+        self.throttled = 0
+        self.latency_spikes = 0
+        self.queue_timeouts = 0
+        self._last_decrease = 0.0
+        self._waiters = FairQueue(starvation_timeout)
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self):
+        """按当前请求的优先级占用一个名额；排队超过 max_wait 秒抛出 LimiterTimeoutError"""
+        priority_class, user = current_priority()
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self._waiters.record_immediate(priority_class)
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = self._waiters.push(future, priority_class, user)
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.queue_timeouts += 1
+            self._waiters.remove(waiter, timed_out=True)
+            raise LimiterTimeoutError(f"上游繁忙，排队超过 {self.max_wait:g} 秒")
+        except asyncio.CancelledError:
+            self._waiters.remove(waiter)
+            if future.done() and not future.cancelled():
+                # 名额刚转交过来请求就被取消了，归还名额
+                self.in_flight -= 1
+                self._wake()
+            raise
+        # 名额已由 _wake 转交给本请求
+
+    def release(self, latency=None, error=None):
+        """归还名额并根据结果调整限制；latency 为 None 表示不作为延迟样本"""
+        self.in_flight -= 1
+        if error is not None:
+            if is_throttle_error(error):
+                self.throttled += 1
+                self._shrink()
+        elif latency is not None:
+            self._observe(latency)
+        self._wake()
+
+    def _observe(self, latency):
+        if self.baseline is not None and latency > self.baseline * self.latency_ratio:
+            self.latency_spikes += 1
+            self._shrink()
+            return
+        self.baseline = latency if self.baseline is None else 0.9 * self.baseline + 0.1 * latency
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def _shrink(self):
+        # 同一批在途请求一起失败时只收紧一次
+        now = time.monotonic()
+        if now - self._last_decrease < max(1.0, self.baseline or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit * self.decrease)
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.pop()
+            if not waiter.future.done():
+                self.in_flight += 1
+                waiter.future.set_result(None)
+
+    def state(self):
+        return {
+            "limit": round(self.limit, 2),
+            "inFlight": self.in_flight,
+            "queued": self.queued,
+            "baselineLatency": round(self.baseline, 3) if self.baseline is not None else None,
+            "throttled": self.throttled,
+            "latencySpikes": self.latency_spikes,
+            "queueTimeouts": self.queue_timeouts,
+            "classes": self._waiters.stats(),
+        }
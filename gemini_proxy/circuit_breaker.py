@@ -0,0 +1,152 @@
+"""
+上游熔断器
+连续失败达到阈值后熔断 (open)，之后的请求立即失败并给出 Retry-After，
+不再排队等到超时；冷却结束后进入半开 (half-open)，放少量探测请求，成功即恢复
+"""
+
+import asyncio
+import math
+import time
+
+from gemini_proxy import structured_log as log
+from gemini_proxy.resilience import DeadlineExceededError, api_error_code, is_retryable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断中，请求被直接拒绝"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"上游 {name} 暂时不可用（熔断中），请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(error):
+    """上游不可用类的错误才计入熔断：5xx、网络错误和上游请求超时；
+    限流、请求本身的错误、调用方截止时间到期和本地排队超时都不算"""
+    code = api_error_code(error)
+    if code is not None:
+        return code >= 500
+    if isinstance(error, DeadlineExceededError):
+        return False
+    return is_retryable(error)
+
+
+class CircuitBreaker:
+    """单个上游（模型）的熔断器"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probes = 0
+
+    def retry_after(self):
+        """距离下次允许探测的秒数（向上取整，至少 1 秒）"""
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        return max(1, math.ceil(remaining))
+
+    def rejecting(self):
+        """熔断冷却期内返回 Retry-After 秒数，否则返回 None（不占用探测名额）"""
+        if self.state == OPEN and time.monotonic() - self.opened_at < self.reset_timeout:
+            return self.retry_after()
+        return None
+
+    def before_call(self):
+        """调用上游前检查，熔断中抛出 CircuitOpenError；返回本次是否为半开探测"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self.state = HALF_OPEN
+            self._probes = 0
+            log.info("breaker_half_open", "熔断器进入半开状态，放行探测请求", breaker=self.name)
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, 1)
+            self._probes += 1
+            return True
+        return False
+
+    def release(self, probe):
+        """本次没有真正调用上游（排队超时、被取消等）：只归还探测名额，不记录结果"""
+        if probe:
+            self._probes -= 1
+
+    def record(self, probe, error=None):
+        """记录一次调用结果；error 为 None 表示成功"""
+        if probe:
+            self._probes -= 1
+        if error is None:
+            if self.state != CLOSED:
+                log.info("breaker_closed", "熔断器已恢复", breaker=self.name)
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            return
+        if not is_upstream_failure(error):
+            # 取消、限流、参数错误等不说明上游故障；半开探测被取消时留给下一个请求探测
+            return
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._open(error)
+
+    def _open(self, error):
+        if self.state != OPEN:
+            self.times_opened += 1
+            log.warning("breaker_open", f"熔断器打开: {error}", breaker=self.name,
+                        failures=self.consecutive_failures, resetTimeout=self.reset_timeout)
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "consecutiveFailures": self.consecutive_failures,
+            "retryAfter": self.retry_after() if self.state == OPEN else 0,
+            "timesOpened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class UpstreamProbe:
+    """带缓存的上游探测：ttl 秒内复用上次结果，并发检查只发起一次探测"""
+
+    def __init__(self, probe, ttl=30.0, timeout=5.0):
+        self.probe = probe
+        self.ttl = ttl
+        self.timeout = timeout
+        self.result = None
+        self.checked_at = 0.0
+        self._pending = None
+
+    async def check(self):
+        """返回 {"ok", "error", "latency", "age"}"""
+        if self.result is None or time.monotonic() - self.checked_at >= self.ttl:
+            if self._pending is None:
+                self._pending = asyncio.ensure_future(self._run())
+            pending = self._pending
+            # shield：某个 /ready 请求断开时不取消其他请求共享的探测
+            await asyncio.shield(pending)
+        return {**self.result, "age": round(time.monotonic() - self.checked_at, 1)}
+
+    async def _run(self):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self.probe(), self.timeout)
+            result = {"ok": True, "error": None}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+        result["latency"] = round(time.monotonic() - start, 3)
+        self.result = result
+        self.checked_at = time.monotonic()
+        self._pending = None
@@ -0,0 +1,278 @@
+"""
+章节图片的派生版本：按宽度分档的页面缩放图和封面缩略图
+第一次请求时生成，按 (原图内容哈希, 参数) 存入磁盘缓存，超出容量时按 LRU 淘汰（即 ImageCache）；
+同一个派生版本的并发请求只生成一次。
+
+宽度按档位向上取整，且不超过原图宽度：请求 700 和 720 得到同一个文件，任意宽度的请求不会撑满缓存。
+原图改动后内容哈希变化，自然用上新的缓存键，旧的派生图随 LRU 淘汰。
+
+预先生成全部派生图:
+    python -m gemini_proxy.derivatives data --formats webp,jpeg
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import sys
+import time
+
+from PIL import ExifTags, Image, ImageOps
+
+from gemini_proxy import metrics
+from gemini_proxy import structured_log as log
+from gemini_proxy.image_cache import ImageCache
+from gemini_proxy.image_optimizer import (SOURCE_EXTENSIONS, available_formats, encode, file_digest, flatten,
+                                          is_grayscale, scan)
+from gemini_proxy.single_flight import SingleFlight
+
+PAGE = "page"
+THUMB = "thumb"
+
+# 页面宽度档位：手机竖屏的 1x / 1.5x / 2x / 3x，平板和桌面
+PAGE_WIDTHS = (360, 540, 720, 1080, 1440)
+# 封面缩略图宽度档位，按列表卡片的 3:4 比例居中裁切（MangaCard: aspect-[3/4] object-cover）
+THUMB_WIDTHS = (160, 320, 480)
+THUMB_ASPECT = (3, 4)
+
+COVER_NAME = "封面"
+
+MIME_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+
+# 生成逻辑变化、旧的派生图不再正确时加 1，旧缓存项不再命中，随 LRU 淘汰
+RENDER_VERSION = 2
+
+
+class DerivativeError(ValueError):
+    """请求的路径或参数无效"""
+
+
+class SourceNotFoundError(DerivativeError):
+    """原图不存在"""
+
+
+def bucket(width, widths):
+    """向上取整到档位；超过最大档位时取最大档位"""
+    for candidate in widths:
+        if candidate >= width:
+            return candidate
+    return widths[-1]
+
+
+def negotiate_format(accept):
+    """未指定格式时按 Accept 头选择：支持 WebP 的浏览器用 WebP，其余用 JPEG（AVIF 编码太慢，只在显式指定时使用）"""
+    return "webp" if "image/webp" in (accept or "").lower() else "jpeg"
+
+
+def derivative_key(digest, params):
+    h = hashlib.sha256(digest.encode("ascii"))
+    h.update(f"\0{RENDER_VERSION}\0".encode("ascii"))
+    h.update(json.dumps(params, sort_keys=True, separators=(",", ":")).encode("ascii"))
+    return h.hexdigest()
+
+
+def oriented_size(img):
+    """按 EXIF 方向摆正后的 (宽, 高)：方向 5–8 要旋转 90°，宽高互换；只读文件头，不解码"""
+    if img.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8):
+        return img.height, img.width
+    return img.size
+
+
+def inspect_source(path):
+    """返回 (内容哈希, 摆正后的 (宽, 高))；只读取文件头得到尺寸"""
+    with Image.open(path) as img:
+        size = oriented_size(img)
+    return file_digest(path), size
+
+
+def render(path, params):
+    """生成派生图片，返回字节；在线程中执行（Pillow 解码、缩放、编码时释放 GIL）"""
+    with Image.open(path) as img:
+        width = params["width"]
+        # 目标尺寸按摆正后的方向计算；flatten 中才旋转，draft 必须在解码前调用
+        source_width, source_height = oriented_size(img)
+        if params["kind"] == THUMB:
+            size = (width, width * THUMB_ASPECT[1] // THUMB_ASPECT[0])
+        else:
+            size = (width, max(1, round(source_height * width / source_width)))
+        # JPEG 可以直接按 1/2、1/4、1/8 解码，省去全尺寸解码和大部分缩放工作；缩放比例与方向无关
+        scale = max(size[0] / source_width, size[1] / source_height)
+        img.draft(None, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img = flatten(img)
+        if params["kind"] == THUMB:
+            img = ImageOps.fit(img, size, Image.LANCZOS)
+        elif img.size != size:
+            img = img.resize(size, Image.LANCZOS)
+        if is_grayscale(img):
+            img = img.convert("L")
+        return encode(img, params["format"], params["quality"])
+
+
+class DerivativeStore:
+    """按需生成并缓存派生图片"""
+
+    def __init__(self, root, cache, quality=80, page_widths=PAGE_WIDTHS, thumb_widths=THUMB_WIDTHS):
+        self.root = os.path.realpath(root)
+        self.cache = cache
+        self.quality = quality
+        self.widths = {PAGE: tuple(sorted(page_widths)), THUMB: tuple(sorted(thumb_widths))}
+        self._sources = {}      # 绝对路径 -> ((mtime_ns, 大小), 内容哈希, (宽, 高))
+        self._flight = SingleFlight()
+        self.generated = 0
+        self.coalesced = 0
+        self.generate_seconds = 0.0
+
+    def resolve(self, rel):
+        """相对 root 的路径 -> 绝对路径；拒绝越界、隐藏目录和非图片文件"""
+        parts = [part for part in (rel or "").replace("\\", "/").split("/") if part]
+        if not parts or any(part.startswith(".") for part in parts) or "\0" in rel:
+            raise DerivativeError("无效的图片路径")
+        if os.path.splitext(parts[-1])[1].lower() not in SOURCE_EXTENSIONS:
+            raise DerivativeError("不支持的图片类型")
+        path = os.path.realpath(os.path.join(self.root, *parts))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise DerivativeError("无效的图片路径")
+        if not os.path.isfile(path):
+            raise SourceNotFoundError("图片不存在")
+        return path
+
+    def params(self, kind, width, fmt, source_size):
+        if kind not in self.widths:
+            raise DerivativeError(f"未知的派生类型: {kind}")
+        fmt = "jpeg" if fmt in (None, "jpg") else fmt
+        if fmt not in MIME_TYPES or fmt not in available_formats():
+            raise DerivativeError(f"不支持的图片格式: {fmt}")
+        if width is not None and width <= 0:
+            raise DerivativeError("宽度必须是正整数")
+        widths = self.widths[kind]
+        width = bucket(width or widths[-1], widths)
+        # 不放大：比档位还窄的原图按原宽度输出，同一张图的更大档位共用一个缓存项
+        width = min(width, source_size[0])
+        return {"kind": kind, "width": width, "format": fmt, "quality": self.quality}
+
+    async def prepare(self, rel, kind=PAGE, width=None, fmt="jpeg"):
+        """解析请求，返回 (原图路径, 参数, 缓存键)；缓存键可直接作为 ETag"""
+        path = self.resolve(rel)
+        digest, size = await self._source(path)
+        params = self.params(kind, width, fmt, size)
+        return path, params, derivative_key(digest, params)
+
+    async def fetch(self, path, params, key):
+        """返回 (字节, MIME 类型, 来源)；来源为 hit / generated / coalesced"""
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            return cached[0], cached[1], "hit"
+        data, shared = await self._flight.do(key, lambda: self._generate(path, params, key))
+        if shared:
+            self.coalesced += 1
+        return data, MIME_TYPES[params["format"]], "coalesced" if shared else "generated"
+
+    async def get(self, rel, kind=PAGE, width=None, fmt="jpeg"):
+        path, params, key = await self.prepare(rel, kind, width, fmt)
+        return await self.fetch(path, params, key)
+
+    def stats(self):
+        return {
+            "sources": len(self._sources),
+            "generated": self.generated,
+            "coalesced": self.coalesced,
+            "generateMs": round(self.generate_seconds * 1000, 1),
+            "cache": self.cache.stats(),
+        }
+
+    async def _source(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        known = self._sources.get(path)
+        if known is not None and known[0] == signature:
+            return known[1], known[2]
+        (digest, size), _ = await self._flight.do(("source", path, signature),
+                                                  lambda: asyncio.to_thread(inspect_source, path))
+        self._sources[path] = (signature, digest, size)
+        return digest, size
+
+    async def _generate(self, path, params, key):
+        start = time.perf_counter()
+        with metrics.stage("resize"):
+            data = await asyncio.to_thread(render, path, params)
+        await self.cache.aput(key, data, MIME_TYPES[params["format"]])
+        elapsed = time.perf_counter() - start
+        self.generated += 1
+        self.generate_seconds += elapsed
+        log.debug("derivative_generated", "已生成派生图片", file=os.path.relpath(path, self.root),
+                  key=key[:12], bytes=len(data), durationMs=round(elapsed * 1000, 1), **params)
+        return data
+
+
+def warm_targets(root, formats, page_widths=PAGE_WIDTHS, thumb_widths=THUMB_WIDTHS):
+    """预生成的全部 (相对路径, 类型, 宽度, 格式)：每页的各个宽度档位，封面另加缩略图"""
+    for rel in sorted(scan(root)):
+        for fmt in formats:
+            for width in page_widths:
+                yield rel, PAGE, width, fmt
+            if COVER_NAME in os.path.basename(rel):
+                for width in thumb_widths:
+                    yield rel, THUMB, width, fmt
+
+
+async def warm(store, formats, concurrency=None):
+    """预生成全部派生图，返回各来源的数量；同一张图的多个档位可能落到同一个缓存项，只生成一次"""
+    semaphore = asyncio.Semaphore(concurrency or os.cpu_count() or 1)
+    counts = {"hit": 0, "generated": 0, "coalesced": 0, "failed": 0}
+    seen = set()
+
+    async def one(rel, kind, width, fmt):
+        async with semaphore:
+            try:
+                path, params, key = await store.prepare(rel, kind, width, fmt)
+                if key in seen:
+                    return
+                seen.add(key)
+                _, _, source = await store.fetch(path, params, key)
+                counts[source] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"   ❌ {rel} ({kind} {width} {fmt}): {e}")
+
+    await asyncio.gather(*(one(*target) for target in warm_targets(store.root, formats,
+                                                                    store.widths[PAGE], store.widths[THUMB])))
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="预生成章节图片的缩放图和封面缩略图")
+    parser.add_argument("root", nargs="?", default=os.getenv("GEMINI_DATA_DIR", "data"))
+    parser.add_argument("--cache-dir", default=os.getenv("GEMINI_DERIVATIVE_CACHE_DIR", ".cache/derivatives"))
+    parser.add_argument("--max-mb", type=int, default=int(os.getenv("GEMINI_DERIVATIVE_CACHE_MAX_MB", "512")),
+                        help="缓存容量（MB），超出时按 LRU 淘汰")
+    parser.add_argument("--formats", default="webp,jpeg", help="逗号分隔的输出格式（默认 webp,jpeg）")
+    parser.add_argument("-q", "--quality", type=int, default=int(os.getenv("GEMINI_DERIVATIVE_QUALITY", "80")))
+    parser.add_argument("-j", "--concurrency", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+    args.formats = [name.strip().lower() for name in args.formats.split(",") if name.strip()]
+    for name in args.formats:
+        if name not in MIME_TYPES or name not in available_formats():
+            parser.error(f"不支持的输出格式: {name}")
+    if args.max_mb <= 0:
+        parser.error("max-mb 必须大于 0")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = DerivativeStore(args.root, ImageCache(args.cache_dir, args.max_mb * 1024 * 1024), args.quality)
+    start = time.perf_counter()
+    counts = asyncio.run(warm(store, args.formats, args.concurrency))
+    cache = store.cache.stats()
+    print(f"✅ 生成 {counts['generated']}，已在缓存 {counts['hit']}，失败 {counts['failed']} "
+          f"({(time.perf_counter() - start) * 1000:.0f}ms)")
+    print(f"   缓存 {cache['entries']} 个文件，{cache['bytes'] / 1e6:.1f} / {args.max_mb} MB，淘汰 {cache['evictions']}")
+    if cache["evictions"]:
+        print("   ⚠️ 容量不足以放下全部派生图，预生成的部分已被淘汰，可调大 --max-mb")
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+幂等键 (Idempotency-Key)
+相同的键再次到达时：原请求仍在进行则等待并共享其结果，已完成则在保留期内直接返回保存的响应，
+不会再次调用 Gemini。响应保存在内存中，按保留期和总字节数淘汰
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflictError(ValueError):
+    """同一个幂等键被用于内容不同的请求"""
+
+
+class StoredResponse:
+    """保存下来的完整响应"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class IdempotencyStore:
+    """幂等键 -> 进行中的计算或已保存的响应；ttl <= 0 表示禁用"""
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replayed = 0
+        self.attached = 0
+        self.conflicts = 0
+        self._in_flight = {}          # key -> (请求指纹, Future)
+        self._done = OrderedDict()    # key -> (保存时间, 请求指纹, StoredResponse)，按保存先后排列
+        self._total_bytes = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    async def run(self, key, fingerprint, factory):
+        """执行 factory()（返回 StoredResponse 的协程）并返回 (响应, 是否为重放)
+
+        factory 在独立的任务中执行，客户端断开不会中断它，结果仍会保存供重试使用；
+        5xx 响应和异常不保存，重试时会重新执行
+        """
+        self._expire()
+        entry = self._done.get(key)
+        if entry is not None:
+            self._check(entry[1], fingerprint)
+            self.replayed += 1
+            return entry[2], True
+
+        running = self._in_flight.get(key)
+        if running is not None:
+            self._check(running[0], fingerprint)
+            self.attached += 1
+            return await asyncio.shield(running[1]), True
+
+        future = asyncio.ensure_future(factory())
+        self._in_flight[key] = (fingerprint, future)
+        future.add_done_callback(lambda f: self._finish(key, fingerprint, f))
+        return await asyncio.shield(future), False
+
+    def _check(self, stored, fingerprint):
+        if stored != fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflictError("Idempotency-Key 已用于另一个不同的请求")
+
+    def _finish(self, key, fingerprint, future):
+        self._in_flight.pop(key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        if response.status >= 500 or len(response.body) > self.max_bytes:
+            return
+        self._done[key] = (time.monotonic(), fingerprint, response)
+        self._total_bytes += len(response.body)
+        while self._total_bytes > self.max_bytes:
+            self._pop_oldest()
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._done and next(iter(self._done.values()))[0] < cutoff:
+            self._pop_oldest()
+
+    def _pop_oldest(self):
+        _, (_, _, response) = self._done.popitem(last=False)
+        self._total_bytes -= len(response.body)
+
+    def stats(self):
+        self._expire()
+        return {
+            "enabled": self.enabled,
+            "inFlight": len(self._in_flight),
+            "stored": len(self._done),
+            "bytes": self._total_bytes,
+            "replayed": self.replayed,
+            "attached": self.attached,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,152 @@
+"""
+生成图片的本地磁盘缓存
+按内容寻址：键为 (模型, 完整提示词, 参考图摘要) 的哈希；超出容量时按 LRU 淘汰
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def image_cache_key(model, prompt_text, reference_digest):
+    """计算缓存键"""
+    h = hashlib.sha256()
+    for part in (model, prompt_text, reference_digest or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ImageCache:
+    """磁盘图片缓存，max_bytes <= 0 表示禁用"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()   # key -> (文件名, 字节数)，越靠后越新
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load_index(self):
+        """启动时扫描缓存目录，按修改时间恢复 LRU 顺序"""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            key = name.split(".", 1)[0]
+            self._entries[key] = (name, size)
+            self._total_bytes += size
+        self._evict()
+
+    def get(self, key):
+        """返回 (图片字节, MIME 类型)，未命中返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        name, _ = entry
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # 更新修改时间，重启后仍能恢复 LRU 顺序
+            os.utime(path)
+        except FileNotFoundError:
+            # 文件被外部删除，按未命中处理
+            with self._lock:
+                self._drop(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return data, _mime_from_name(name)
+
+    def put(self, key, data, mime_type):
+        """写入缓存（先写临时文件再原子替换）"""
+        if not self.enabled:
+            return
+        name = f"{key}.{_ext_from_mime(mime_type)}"
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            old = self._drop(key)
+            if old is not None and old[0] != name:
+                _remove_quietly(os.path.join(self.directory, old[0]))
+            self._entries[key] = (name, len(data))
+            self._total_bytes += len(data)
+            self._evict()
+
+    async def aget(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, data, mime_type):
+        await asyncio.to_thread(self.put, key, data, mime_type)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+        return entry
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            name, _ = self._drop(key)
+            self.evictions += 1
+            _remove_quietly(os.path.join(self.directory, name))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+_MIME_EXT = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp", "image/avif": "avif"}
+
+
+def _ext_from_mime(mime_type):
+    return _MIME_EXT.get(mime_type, "png")
+
+
+def _mime_from_name(name):
+    ext = name.rsplit(".", 1)[-1]
+    for mime_type, mime_ext in _MIME_EXT.items():
+        if mime_ext == ext:
+            return mime_type
+    return "image/png"
@@ -0,0 +1,99 @@
+"""
+图片返回方式协商与转码
+除默认的 Base64-in-JSON 外，支持直接返回图片字节或 multipart（JSON 元数据 + 图片）
+"""
+
+import io
+import json
+import uuid
+
+from PIL import Image
+
+# 可转码的目标格式 -> (PIL 格式名, MIME 类型)
+TRANSCODE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+_FORMAT_BY_MIME = {"image/png": "png", "image/jpeg": "jpeg", "image/webp": "webp"}
+
+
+class DeliveryError(ValueError):
+    """请求的返回方式或转码参数无效"""
+
+
+def negotiate_image_delivery(accept, data):
+    """根据 Accept 头和请求体决定返回方式
+
+    返回 (方式, 目标格式, 质量)：方式为 "json" / "binary" / "multipart"，
+    目标格式为 None 时不转码
+    """
+    accept = (accept or "").lower()
+    if "multipart/" in accept:
+        delivery = "multipart"
+    elif "image/" in accept:
+        delivery = "binary"
+    else:
+        delivery = "json"
+
+    target = data.get("format")
+    if target is None and delivery == "binary":
+        # Accept: image/webp 之类的具体类型也视为转码请求
+        for mime_type, name in _FORMAT_BY_MIME.items():
+            if mime_type in accept and mime_type != "image/png":
+                target = name
+                break
+    if target is not None:
+        target = str(target).lower()
+        if target not in TRANSCODE_FORMATS:
+            raise DeliveryError(f"不支持的图片格式: {target}")
+
+    quality = data.get("quality")
+    if quality is not None:
+        try:
+            quality = int(quality)
+        except (TypeError, ValueError):
+            raise DeliveryError("quality 必须是 1-100 的整数")
+        if not 1 <= quality <= 100:
+            raise DeliveryError("quality 必须是 1-100 的整数")
+
+    return delivery, target, quality
+
+
+def transcode_image(data, mime_type, target, quality=None):
+    """把图片转码为目标格式，返回 (字节, MIME 类型)；格式相同且未指定质量时原样返回"""
+    pil_format, target_mime = TRANSCODE_FORMATS[target]
+    if target_mime == mime_type and quality is None:
+        return data, mime_type
+
+    with Image.open(io.BytesIO(data)) as img:
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buf = io.BytesIO()
+        options = {"optimize": True} if pil_format != "WEBP" else {"method": 4}
+        if pil_format in ("JPEG", "WEBP"):
+            options["quality"] = quality or 85
+        img.save(buf, format=pil_format, **options)
+    return buf.getvalue(), target_mime
+
+
+def multipart_parts(metadata, data, mime_type):
+    """生成 multipart/mixed 响应：第一部分为 JSON 元数据，第二部分为图片
+
+    返回 (Content-Type, 分块生成器)；图片字节直接写出，不拼接成新的大缓冲区
+    """
+    boundary = uuid.uuid4().hex
+    meta = json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+
+    async def chunks():
+        yield (
+            f"--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+        ).encode("ascii") + meta + (
+            f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n"
+        ).encode("ascii")
+        yield data
+        yield f"\r\n--{boundary}--\r\n".encode("ascii")
+
+    return f"multipart/mixed; boundary={boundary}", chunks()
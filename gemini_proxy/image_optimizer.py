@@ -0,0 +1,596 @@
+"""
+章节图片批量优化
+扫描 data/ 下的章节图片，用进程池并行编码为 JPEG / WebP（可选 AVIF），写到镜像目录（默认 data/.optimized，
+以 . 开头的目录阅读器扫描时会跳过），原图不改动。
+
+清单 (manifest.json) 记录每张原图的 (mtime_ns, 大小)、内容哈希、编码参数和输出文件：
+文件属性和参数都没变的直接跳过，不读文件；属性变了但内容哈希相同（touch、重新拷贝）只更新清单。
+输出文件和清单都先写临时文件再改名，中途中断不会留下写了一半的文件。
+
+指定 --target-ssim 时不再用固定质量：对每种格式二分查找满足目标 SSIM 的最低质量（--quality 为上限），
+每张图选用的质量和得分记在清单里。实际上是灰度的页面按单通道编码（JPEG 体积更小，也不会出现色偏）。
+
+用法:
+    python -m gemini_proxy.image_optimizer data
+    python -m gemini_proxy.image_optimizer data --formats jpeg,webp,avif --quality 80 --dry-run
+    python -m gemini_proxy.image_optimizer data --target-ssim 0.985 --quality 90
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageChops, ImageOps, features
+
+# 与 lib/scanner.ts 一致：章节目录中这些扩展名的文件都是页面
+SOURCE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+
+# 输出格式 -> (PIL 格式名, 扩展名)
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+    "avif": ("AVIF", ".avif"),
+}
+_FORMAT_BY_EXTENSION = {".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp", ".png": "png"}
+
+OUTPUT_DIR = ".optimized"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# 最差区域允许的失真（1 - SSIM）为全图平均目标的倍数
+WORST_REGION_FACTOR = 3
+# 计算 SSIM 时页面缩小到的宽度：与缩放图的最大档位（derivatives.PAGE_WIDTHS）一致，0 表示按原尺寸
+METRIC_WIDTH = 1440
+# 查找质量：从起点向两侧找边界的初始步长，边界收窄到多少即停止（结果最多比最低达标质量高 QUALITY_TOLERANCE - 1），
+# 以及每张图每种格式最多编码的次数
+QUALITY_STEP = 4
+QUALITY_TOLERANCE = 2
+MAX_PROBES = 8
+
+# 本 worker 进程里每种格式、每种颜色模式上一张图选用的质量，作为下一张的查找起点（同一章节的页面相近）
+_recent_quality = {}
+
+
+def available_formats():
+    """当前 Pillow 支持的输出格式；AVIF 需要 Pillow 11.3+ 或 pillow-avif-plugin"""
+    return [name for name in FORMATS if name != "avif" or features.check("avif")]
+
+
+def encode_params(formats, quality, target_ssim=None, min_quality=30, grayscale=True, metric_width=METRIC_WIDTH):
+    """编码参数；任何一项变化都会重新编码。指定 target_ssim 时 quality 为查找的上限"""
+    params = {"formats": sorted(formats), "quality": quality, "grayscale": grayscale}
+    if target_ssim is not None:
+        params.update({"targetSsim": target_ssim, "minQuality": min_quality, "metricWidth": metric_width})
+    return params
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+
+def scan(root, output_dir=None):
+    """返回 {相对路径: (绝对路径, mtime_ns, 大小)}；跳过 . 开头的目录和文件（包括输出目录）"""
+    found = {}
+    output_dir = os.path.abspath(output_dir) if output_dir else None
+
+    def walk(directory, prefix):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    if output_dir is None or os.path.abspath(entry.path) != output_dir:
+                        walk(entry.path, prefix + entry.name + "/")
+                elif os.path.splitext(entry.name)[1].lower() in SOURCE_EXTENSIONS:
+                    stat = entry.stat()
+                    found[prefix + entry.name] = (entry.path, stat.st_mtime_ns, stat.st_size)
+
+    walk(root, "")
+    return found
+
+
+def output_name(rel, fmt):
+    """原图相对路径 -> 输出文件相对路径：去掉原扩展名，换成目标格式的扩展名"""
+    return os.path.splitext(rel)[0] + FORMATS[fmt][1]
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def atomic_write(path, data):
+    """先写临时文件再改名；读者要么看到旧文件，要么看到完整的新文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        # 清单损坏时当作首次运行，全部重新处理
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("entries", {})
+
+
+def save_manifest(path, entries):
+    payload = {"version": MANIFEST_VERSION, "entries": dict(sorted(entries.items()))}
+    atomic_write(path, json.dumps(payload, ensure_ascii=False, indent=1).encode("utf-8"))
+
+
+def flatten(img):
+    """透明背景铺白色，其余转为 RGB；按 EXIF 方向摆正（输出不保留 EXIF）"""
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def is_grayscale(img, tolerance=8, max_fraction=0.0005, sample_side=512):
+    """是否实际上是灰度图：缩小后统计色度偏离中性超过 tolerance 的像素比例
+
+    JPEG 压缩会给黑白页面带来少量色度噪声，用 tolerance 容忍；max_fraction 取得很小，
+    带一小块彩色（印章、强调色）的页面仍按彩色处理。只用 Pillow 的查表和直方图，不需要 NumPy
+    """
+    if img.mode in ("1", "L", "LA", "I", "F"):
+        return True
+    sample = img.convert("RGB")
+    sample.thumbnail((sample_side, sample_side), Image.BILINEAR)
+    _, cb, cr = sample.convert("YCbCr").split()
+    table = [255 if abs(value - 128) > tolerance else 0 for value in range(256)]
+    colored = ImageChops.lighter(cb.point(table), cr.point(table))
+    return colored.histogram()[255] / (sample.width * sample.height) <= max_fraction
+
+
+def encode(img, fmt, quality, final=True):
+    """编码为目标格式，返回字节
+
+    final=False 用于查找质量：JPEG 省去 optimize / progressive，它们只改变熵编码，解码出的像素相同
+    """
+    pil_format = FORMATS[fmt][0]
+    if pil_format == "JPEG":
+        options = {"quality": quality, "optimize": final, "progressive": final}
+    elif pil_format == "WEBP":
+        options = {"quality": quality, "method": 4}
+    else:
+        options = {"quality": quality}
+    buf = io.BytesIO()
+    img.save(buf, format=pil_format, **options)
+    return buf.getvalue()
+
+
+def search_quality(img, fmt, reference, target, min_quality, max_quality, timings, hint=None):
+    """查找平均 SSIM 和最差区域 SSIM 都达标的最低质量
+
+    从 hint（同一 worker 上一张同类页面选用的质量）或区间中点开始，按 QUALITY_STEP 倍增步长向两侧找到
+    达标与不达标的边界，再二分到相差 QUALITY_TOLERANCE 以内；向上一直不达标时很快试到上限，不再逐步二分。
+    最多编码 MAX_PROBES 次，用完时取已知达标的最低质量。
+    返回 (字节, {quality, ssim, worstSsim, met})；max_quality 仍不达标时使用 max_quality，met 为 False
+    """
+    floor = 1 - (1 - target) * WORST_REGION_FACTOR
+    probes = {}
+
+    def probe(quality):
+        if quality not in probes:
+            data = encode(img, fmt, quality, final=False)
+            with Image.open(io.BytesIO(data)) as decoded:
+                decoded.load()
+                start = time.perf_counter()
+                probes[quality] = (data,) + reference.compare(decoded)
+                timings["metric"] += time.perf_counter() - start
+        return probes[quality]
+
+    def passes(quality):
+        _, mean, worst = probe(quality)
+        return mean >= target and worst >= floor
+
+    # failing：已知不达标的最高质量（低于下限表示还没有）；passing：已知达标的最低质量
+    failing, passing = min_quality - 1, None
+    quality = hint if hint is not None and min_quality <= hint <= max_quality else (min_quality + max_quality) // 2
+    step = QUALITY_STEP
+    while True:
+        if passes(quality):
+            passing = quality
+        else:
+            failing = quality
+        if failing >= max_quality or (passing is not None and passing - failing <= QUALITY_TOLERANCE):
+            break
+        if len(probes) >= MAX_PROBES:
+            break
+        if passing is None:
+            quality = min(max_quality, failing + step)
+            step *= 2
+        elif failing < min_quality:
+            quality = max(min_quality, passing - step)
+            step *= 2
+        else:
+            quality = (failing + passing) // 2
+    best = max_quality if passing is None else passing
+    data, mean, worst = probe(best)
+    timings["probes"] += len(probes)
+    if fmt == "jpeg":
+        data = encode(img, fmt, best)
+    return data, {"quality": best, "ssim": round(mean, 5), "worstSsim": round(worst, 5), "met": passing is not None}
+
+
+def process_image(job):
+    """在 worker 进程中处理一张图：计算哈希，内容有变化时编码并写出全部格式
+
+    job 为 dict（可跨进程传递）；返回结果 dict，出错时带 error 字段
+    """
+    start = time.perf_counter()
+    result = {"rel": job["rel"], "sourceBytes": job["size"]}
+    try:
+        digest = file_digest(job["path"])
+        result["sha256"] = digest
+        if digest == job.get("previousDigest"):
+            # 只是文件属性变了，已有的输出仍然有效
+            result["unchanged"] = True
+            return result
+        with open(job["path"], "rb") as f:
+            data = f.read()
+        source_format = _FORMAT_BY_EXTENSION.get(os.path.splitext(job["path"])[1].lower())
+        params = job["params"]
+        target = params.get("targetSsim")
+        timings = {"metric": 0.0, "probes": 0}
+        outputs = {}
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            result["width"], result["height"] = img.size
+            img = flatten(img)
+            result["grayscale"] = params["grayscale"] and is_grayscale(img)
+            if result["grayscale"]:
+                img = img.convert("L")
+            reference = None
+            if target is not None:
+                # NumPy 只在按 SSIM 查找质量时才需要，不拖慢导入本模块的服务进程
+                from gemini_proxy.image_quality import SsimReference
+                reference = SsimReference(img, params.get("metricWidth"))
+            for fmt, dest in job["outputs"].items():
+                output = {"file": job["outputNames"][fmt]}
+                if reference is not None:
+                    hint_key = (fmt, img.mode)
+                    encoded, found = search_quality(
+                        img, fmt, reference, target, params["minQuality"], params["quality"], timings,
+                        hint=_recent_quality.get(hint_key)
+                    )
+                    if found["met"]:
+                        _recent_quality[hint_key] = found["quality"]
+                    output.update(found)
+                else:
+                    encoded = encode(img, fmt, params["quality"])
+                output["kept"] = fmt == source_format and len(encoded) >= len(data)
+                if output["kept"]:
+                    # 原图已经是同一格式且更小，再编码只会损失画质
+                    encoded = data
+                atomic_write(dest, encoded)
+                output["bytes"] = len(encoded)
+                outputs[fmt] = output
+        result["outputs"] = outputs
+        if reference is not None:
+            result["probes"] = timings["probes"]
+            result["metricMs"] = round(timings["metric"] * 1000, 1)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def plan(sources, entries, output_dir, params):
+    """对比扫描结果和清单
+
+    返回 (需要处理的 job 列表, 未变化的相对路径, 原图已删除的相对路径, 输出文件名冲突的相对路径)
+    """
+    key = params_key(params)
+    jobs, unchanged, conflicts = [], [], []
+    claimed = {}
+    for rel in sorted(sources):
+        path, mtime_ns, size = sources[rel]
+        names = {fmt: output_name(rel, fmt) for fmt in params["formats"]}
+        # 1.png 和 1.jpg 会写到同一个输出文件，只处理排在前面的
+        owner = claimed.setdefault(names[params["formats"][0]], rel)
+        if owner != rel:
+            conflicts.append(rel)
+            continue
+        entry = entries.get(rel)
+        # 参数相同、输出都在时，内容哈希没变就不必重新编码
+        reusable = (entry is not None and entry.get("params") == key
+                    and all(os.path.exists(os.path.join(output_dir, name)) for name in names.values()))
+        if reusable and entry.get("mtimeNs") == mtime_ns and entry.get("size") == size:
+            unchanged.append(rel)
+            continue
+        jobs.append({
+            "rel": rel,
+            "path": path,
+            "size": size,
+            "mtimeNs": mtime_ns,
+            "params": params,
+            "outputNames": names,
+            "outputs": {fmt: os.path.join(output_dir, name) for fmt, name in names.items()},
+            "previousDigest": entry.get("sha256") if reusable else None,
+        })
+    removed = sorted(rel for rel in entries if rel not in sources)
+    return jobs, unchanged, removed, conflicts
+
+
+def prune(output_dir, entries, removed):
+    """删除已不存在的原图对应的输出文件和清单记录"""
+    for rel in removed:
+        _remove_outputs(output_dir, entries.pop(rel, {}).get("outputs", {}).values())
+
+
+def _remove_outputs(output_dir, outputs):
+    for output in outputs:
+        try:
+            os.remove(os.path.join(output_dir, output["file"]))
+        except FileNotFoundError:
+            pass
+
+
+def _run_jobs(jobs, workers):
+    """逐个产出处理结果；只有一个任务或一个进程时在当前进程执行，省去启动进程池"""
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield job, process_image(job)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        futures = {pool.submit(process_image, job): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def optimize(root, output_dir=None, formats=("jpeg", "webp"), quality=80, workers=None,
+             dry_run=False, remove_stale=True, on_result=None, target_ssim=None, min_quality=30,
+             grayscale=True, metric_width=METRIC_WIDTH):
+    """优化 root 下的全部图片，返回汇总报告
+
+    on_result(结果 dict) 在每张图处理完后调用，可用来显示进度
+    """
+    start = time.perf_counter()
+    output_dir = os.path.abspath(output_dir or os.path.join(root, OUTPUT_DIR))
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    params = encode_params(formats, quality, target_ssim, min_quality, grayscale, metric_width)
+    entries = load_manifest(manifest_path)
+    sources = scan(root, output_dir)
+    jobs, unchanged, removed, conflicts = plan(sources, entries, output_dir, params)
+
+    report = {
+        "root": os.path.abspath(root),
+        "output": output_dir,
+        "params": params,
+        "dryRun": dry_run,
+        "scanned": len(sources),
+        "unchanged": len(unchanged),
+        "pending": [job["rel"] for job in jobs],
+        "removed": removed,
+        "conflicts": conflicts,
+        "encoded": 0,
+        "touched": 0,
+        "failed": [],
+        "sourceBytes": 0,
+        "outputBytes": {fmt: 0 for fmt in params["formats"]},
+        "grayscale": 0,
+        "chapters": {},
+        "images": [],
+    }
+    if dry_run:
+        report["elapsedMs"] = round((time.perf_counter() - start) * 1000, 1)
+        return report
+
+    encode_start = time.perf_counter()
+    try:
+        for job, result in _run_jobs(jobs, workers or os.cpu_count() or 1):
+            if on_result is not None:
+                on_result(result)
+            if "error" in result:
+                report["failed"].append({"rel": job["rel"], "error": result["error"]})
+                continue
+            previous = entries.get(job["rel"], {})
+            if result.get("unchanged"):
+                entry = previous
+            else:
+                entry = {}
+                # 换了输出格式时，删除不再生成的旧格式文件
+                current = {output["file"] for output in result["outputs"].values()}
+                _remove_outputs(output_dir, [output for output in previous.get("outputs", {}).values()
+                                             if output["file"] not in current])
+            entry.update({"mtimeNs": job["mtimeNs"], "size": job["size"], "sha256": result["sha256"],
+                          "params": params_key(params)})
+            if result.get("unchanged"):
+                report["touched"] += 1
+            else:
+                for field in ("width", "height", "grayscale", "outputs", "ms", "probes", "metricMs"):
+                    if field in result:
+                        entry[field] = result[field]
+                _add_result(report, job, result)
+            entries[job["rel"]] = entry
+    finally:
+        # 中断时也保存已完成的部分，下次从断点继续
+        if remove_stale:
+            prune(output_dir, entries, removed)
+        if jobs or removed or not os.path.exists(manifest_path):
+            save_manifest(manifest_path, entries)
+
+    encode_seconds = time.perf_counter() - encode_start
+    report["elapsedMs"] = round((time.perf_counter() - start) * 1000, 1)
+    if report["encoded"] and encode_seconds > 0:
+        report["imagesPerSecond"] = round(report["encoded"] / encode_seconds, 2)
+        report["sourceMBPerSecond"] = round(report["sourceBytes"] / 1e6 / encode_seconds, 2)
+    if report["sourceBytes"]:
+        report["savedPercent"] = {
+            fmt: round((1 - size / report["sourceBytes"]) * 100, 1) for fmt, size in report["outputBytes"].items()
+        }
+    if target_ssim is not None and report["images"]:
+        images = report["images"]
+        report["averageQuality"] = {
+            fmt: round(sum(image["outputs"][fmt]["quality"] for image in images) / len(images), 1)
+            for fmt in params["formats"]
+        }
+        report["metricMs"] = round(sum(image.get("metricMs", 0) for image in images), 1)
+        # 在质量上限仍未达标的页面，逐个列出便于单独调整（例如改用 JPEG 或提高上限）
+        report["targetMissedImages"] = {
+            fmt: [image["rel"] for image in images if not image["outputs"][fmt]["met"]] for fmt in params["formats"]
+        }
+        report["targetMissed"] = {fmt: len(rels) for fmt, rels in report["targetMissedImages"].items()}
+    return report
+
+
+def _add_result(report, job, result):
+    """把一张图的编码结果计入报告：总量、按章节（所在目录）汇总和逐张记录"""
+    report["encoded"] += 1
+    report["sourceBytes"] += job["size"]
+    report["grayscale"] += bool(result.get("grayscale"))
+    chapter = report["chapters"].setdefault(os.path.dirname(job["rel"]), {
+        "images": 0, "sourceBytes": 0, "outputBytes": {fmt: 0 for fmt in report["outputBytes"]}
+    })
+    chapter["images"] += 1
+    chapter["sourceBytes"] += job["size"]
+    for fmt, output in result["outputs"].items():
+        report["outputBytes"][fmt] += output["bytes"]
+        chapter["outputBytes"][fmt] += output["bytes"]
+    report["images"].append({
+        "rel": job["rel"],
+        "sourceBytes": job["size"],
+        "grayscale": result.get("grayscale", False),
+        "outputs": {fmt: {k: v for k, v in output.items() if k != "file"}
+                    for fmt, output in result["outputs"].items()},
+        "ms": result["ms"],
+        **({"metricMs": result["metricMs"]} if "metricMs" in result else {}),
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="并行、增量地优化章节图片")
+    parser.add_argument("root", nargs="?", default="data", help="图片根目录（默认 data）")
+    parser.add_argument("-o", "--output", help=f"输出目录（默认 <root>/{OUTPUT_DIR}）")
+    parser.add_argument("--formats", default="jpeg,webp",
+                        help=f"逗号分隔的输出格式，可选 {', '.join(FORMATS)}（默认 jpeg,webp）")
+    parser.add_argument("-q", "--quality", type=int, default=80,
+                        help="编码质量 1-100（默认 80）；指定 --target-ssim 时为查找的上限")
+    parser.add_argument("--target-ssim", type=float,
+                        help="按目标 SSIM 查找每张图的最低质量，例如 0.985（默认使用固定质量）")
+    parser.add_argument("--min-quality", type=int, default=30, help="查找质量的下限（默认 30）")
+    parser.add_argument("--metric-width", type=int, default=METRIC_WIDTH,
+                        help=f"计算 SSIM 前把更宽的页面缩小到该宽度（默认 {METRIC_WIDTH}，0 表示按原尺寸）")
+    parser.add_argument("--no-grayscale", dest="grayscale", action="store_false",
+                        help="不检测灰度页面，全部按彩色编码")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="进程数（默认 CPU 核数）")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="只列出需要处理的文件，不写任何东西")
+    parser.add_argument("--keep-stale", action="store_true", help="保留原图已删除的输出文件")
+    parser.add_argument("--report", help="把汇总报告写到 JSON 文件")
+    parser.add_argument("-v", "--verbose", action="store_true", help="逐个显示处理结果")
+    args = parser.parse_args(argv)
+    args.formats = [name.strip().lower() for name in args.formats.split(",") if name.strip()]
+    for name in args.formats:
+        if name not in FORMATS:
+            parser.error(f"不支持的输出格式: {name}")
+        if name not in available_formats():
+            parser.error(f"当前 Pillow 不支持 {name.upper()} 编码")
+    if not args.formats:
+        parser.error("至少指定一种输出格式")
+    if not 1 <= args.min_quality <= args.quality <= 100:
+        parser.error("quality 必须是 1-100 的整数，且不小于 min-quality")
+    if args.target_ssim is not None and not 0 < args.target_ssim < 1:
+        parser.error("target-ssim 必须在 0 到 1 之间")
+    if args.metric_width < 0:
+        parser.error("metric-width 不能为负数")
+    if not os.path.isdir(args.root):
+        parser.error(f"目录不存在: {args.root}")
+    return args
+
+
+def print_report(report, verbose=False):
+    if report["dryRun"]:
+        print(f"🔍 扫描 {report['scanned']} 张，未变化 {report['unchanged']} 张，"
+              f"需要处理 {len(report['pending'])} 张 ({report['elapsedMs']}ms)")
+        for rel in report["pending"]:
+            print(f"   + {rel}")
+        for rel in report["removed"]:
+            print(f"   - {rel}")
+    else:
+        print(f"✅ 扫描 {report['scanned']} 张：编码 {report['encoded']}，仅内容校验 {report['touched']}，"
+              f"未变化 {report['unchanged']}，失败 {len(report['failed'])}，"
+              f"清理 {len(report['removed'])} ({report['elapsedMs']}ms)")
+        if report["encoded"]:
+            print(f"   吞吐 {report['imagesPerSecond']} 张/秒，{report['sourceMBPerSecond']} MB/秒（按原图计）")
+            source_mb = report["sourceBytes"] / 1e6
+            for fmt, size in report["outputBytes"].items():
+                quality = report.get("averageQuality", {}).get(fmt)
+                missed = report.get("targetMissed", {}).get(fmt)
+                print(f"   {fmt:<5} {source_mb:.1f} MB -> {size / 1e6:.1f} MB "
+                      f"(节省 {report['savedPercent'][fmt]}%)" + (f"，平均质量 {quality}" if quality else "") +
+                      (f"，{missed} 张在质量上限仍未达到目标" if missed else ""))
+            for fmt, rels in report.get("targetMissedImages", {}).items():
+                for rel in rels:
+                    print(f"   ⚠️ {fmt} 未达到目标 SSIM: {rel}")
+            print(f"   灰度页面 {report['grayscale']} 张（单通道编码）" +
+                  (f"，SSIM 计算共 {report['metricMs']}ms" if "metricMs" in report else ""))
+            if verbose:
+                for name, chapter in sorted(report["chapters"].items()):
+                    sizes = "  ".join(f"{fmt} {size / 1e6:.2f}MB" for fmt, size in chapter["outputBytes"].items())
+                    print(f"   📁 {name or '.'}: {chapter['images']} 张 {chapter['sourceBytes'] / 1e6:.2f}MB -> {sizes}")
+        for failure in report["failed"]:
+            print(f"   ❌ {failure['rel']}: {failure['error']}")
+    for rel in report["conflicts"]:
+        print(f"   ⚠️ 与同名文件的输出冲突，已跳过: {rel}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    def on_result(result):
+        if "error" in result:
+            print(f"   ❌ {result['rel']}: {result['error']}")
+        elif args.verbose:
+            state = "内容未变" if result.get("unchanged") else ", ".join(
+                f"{fmt} {output['bytes'] // 1024}KB" + (
+                    f" q{output['quality']} ssim {output['ssim']:.4f}/{output['worstSsim']:.4f}" +
+                    ("" if output["met"] else " 未达标")
+                    if "quality" in output else ""
+                ) for fmt, output in result["outputs"].items()
+            )
+            gray = "  灰度" if result.get("grayscale") else ""
+            print(f"   {result['rel']}  {state}{gray}  {result['ms']}ms")
+
+    report = optimize(args.root, args.output, args.formats, args.quality, args.workers,
+                      dry_run=args.dry_run, remove_stale=not args.keep_stale, on_result=on_result,
+                      target_ssim=args.target_ssim, min_quality=args.min_quality, grayscale=args.grayscale,
+                      metric_width=args.metric_width)
+    print_report(report, args.verbose)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(json.dumps(report, ensure_ascii=False, indent=2) + "\n")
+        print(f"💾 报告已保存到 {args.report}")
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+"""
+持久化任务队列
+任务、脚本和每一格的出图结果保存在本地 SQLite；固定数量的 worker 按提交顺序执行任务。
+进程重启后未完成的任务自动恢复，已经生成成功的格子不会重新生成
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from gemini_proxy import structured_log as log
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+
+class JobFailedError(Exception):
+    """handler 抛出表示任务整体失败；原因已经写在消息里，不记录堆栈"""
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    concept TEXT NOT NULL,
+    style TEXT NOT NULL,
+    model TEXT NOT NULL,
+    concurrency INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    script TEXT,
+    raw_text TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS panels (
+    job_id TEXT NOT NULL,
+    panel_number INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    image BLOB,
+    mime_type TEXT,
+    error TEXT,
+    elapsed REAL,
+    PRIMARY KEY (job_id, panel_number)
+);
+"""
+
+
+class JobStore:
+    """SQLite 任务表；接口是同步的，由 JobQueue 放到线程里调用"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._inherited = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """首次使用时才打开数据库（调用方持有 _lock）
+
+        SQLite 连接不能跨 fork 使用：fork 出的 worker 各自打开自己的连接；
+        继承来的连接既不使用也不关闭（关闭会影响父进程），只保留引用
+        """
+        if self._conn is None or self._pid != os.getpid():
+            if self._conn is not None:
+                self._inherited.append(self._conn)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._connection().execute(sql, params)
+            return cursor.fetchall(), cursor.rowcount
+
+    def create(self, concept, style, model, concurrency):
+        job_id = uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, concept, style, model, concurrency, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, concept, style, model, concurrency, QUEUED, time.time())
+        )
+        return job_id
+
+    def get(self, job_id, include_images=False):
+        """任务详情：脚本中的每一格合并上已保存的出图结果；任务不存在返回 None"""
+        rows, _ = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        job = dict(rows[0])
+        columns = "panel_number, status, mime_type, error, elapsed" + (", image" if include_images else "")
+        results, _ = self._execute(f"SELECT {columns} FROM panels WHERE job_id = ?", (job_id,))
+        job["results"] = {row["panel_number"]: dict(row) for row in results}
+        job["script"] = json.loads(job["script"]) if job["script"] else None
+        return job
+
+    def claim(self, job_id):
+        """把排队中的任务标记为运行中，返回已尝试次数；任务已被取消或领取时返回 None"""
+        _, count = self._execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ? "
+            "WHERE id = ? AND status = ?",
+            (RUNNING, time.time(), job_id, QUEUED)
+        )
+        if not count:
+            return None
+        rows, _ = self._execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,))
+        return rows[0]["attempts"]
+
+    def save_script(self, job_id, panels, raw_text):
+        self._execute(
+            "UPDATE jobs SET script = ?, raw_text = ? WHERE id = ?",
+            (json.dumps(panels, ensure_ascii=False), raw_text, job_id)
+        )
+
+    def save_panel(self, job_id, panel_number, status, image=None, mime_type=None, error=None, elapsed=None):
+        """保存一格的结果（检查点）"""
+        self._execute(
+            "INSERT OR REPLACE INTO panels (job_id, panel_number, status, image, mime_type, error, elapsed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, panel_number, status, image, mime_type, error, elapsed)
+        )
+
+    def finish(self, job_id, status, error=None):
+        """结束任务；已取消的任务不会被覆盖"""
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+            (status, error, time.time(), job_id, RUNNING)
+        )
+
+    def cancel(self, job_id):
+        """取消排队中或运行中的任务，返回是否取消成功"""
+        _, count = self._execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+            (CANCELLED, time.time(), job_id, QUEUED, RUNNING)
+        )
+        return count > 0
+
+    def requeue_running(self):
+        """上次进程退出时仍在运行的任务重新排队，返回数量"""
+        _, count = self._execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        return count
+
+    def queued_ids(self):
+        rows, _ = self._execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,))
+        return [row["id"] for row in rows]
+
+    def statuses(self, job_ids):
+        """任务 ID -> 状态"""
+        if not job_ids:
+            return {}
+        placeholders = ", ".join("?" * len(job_ids))
+        rows, _ = self._execute(f"SELECT id, status FROM jobs WHERE id IN ({placeholders})", tuple(job_ids))
+        return {row["id"]: row["status"] for row in rows}
+
+    def counts(self):
+        rows, _ = self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+        return {row["status"]: row["n"] for row in rows}
+
+    def prune(self, ttl):
+        """删除结束超过 ttl 秒的任务及其图片"""
+        cutoff = time.time() - ttl
+        placeholders = ", ".join("?" * len(FINISHED))
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.execute(
+                    f"DELETE FROM panels WHERE job_id IN (SELECT id FROM jobs "
+                    f"WHERE status IN ({placeholders}) AND finished_at < ?)",
+                    (*FINISHED, cutoff)
+                )
+                count = conn.execute(
+                    f"DELETE FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?",
+                    (*FINISHED, cutoff)
+                ).rowcount
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return count
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+class JobQueue:
+    """worker 池：按提交顺序取出任务交给 handler(job_id) 执行
+
+    handler 正常返回即任务完成，抛出异常（包括 JobFailedError）即任务失败；超过 max_attempts 次仍未完成
+    （例如每次执行都导致进程退出）的任务直接标记为失败
+
+    多进程部署时只有一个进程调用 start()；poll_interval > 0 时该进程定期从数据库领取
+    其他进程提交的任务，并中断在其他进程里被取消的运行中任务
+    """
+
+    def __init__(self, store, handler, workers=2, max_attempts=3, ttl=7 * 86400, poll_interval=0.0):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._queue = asyncio.Queue()
+        self._enqueued = set()  # 已放进 _queue、还没被 worker 取出的任务
+        self._workers = []
+        self._running = {}      # job_id -> 执行中的 Task
+        self._cancelled = set()
+
+    async def start(self):
+        """恢复未完成的任务并启动 worker"""
+        resumed = await asyncio.to_thread(self.store.requeue_running)
+        for job_id in await asyncio.to_thread(self.store.queued_ids):
+            self._enqueue(job_id)
+        if resumed:
+            log.info("jobs_resumed", f"恢复 {resumed} 个中断的任务", count=resumed)
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        if self.poll_interval > 0:
+            self._workers.append(asyncio.ensure_future(self._poll()))
+        log.info("job_queue_started", "任务队列已启动", workers=self.workers, queued=self._queue.qsize())
+
+    async def stop(self):
+        """停止 worker；运行中的任务保持 running 状态，下次启动时恢复"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, concept, style, model, concurrency):
+        await asyncio.to_thread(self.store.prune, self.ttl)
+        job_id = await asyncio.to_thread(self.store.create, concept, style, model, concurrency)
+        if self._workers:
+            self._enqueue(job_id)
+        return job_id
+
+    async def get(self, job_id, include_images=False):
+        return await asyncio.to_thread(self.store.get, job_id, include_images)
+
+    async def cancel(self, job_id):
+        """取消任务；运行中的任务会被中断，已完成的格子保留"""
+        if not await asyncio.to_thread(self.store.cancel, job_id):
+            return False
+        # 任务可能刚被 worker 领取、还没开始执行，先记下，worker 开始前会检查
+        self._cancelled.add(job_id)
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        return True
+
+    def stats(self):
+        return {
+            "workers": self.workers if self._workers else 0,
+            "queued": self._queue.qsize(),
+            "running": len(self._running),
+        }
+
+    def _enqueue(self, job_id):
+        if job_id not in self._enqueued and job_id not in self._running:
+            self._enqueued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                for job_id in await asyncio.to_thread(self.store.queued_ids):
+                    self._enqueue(job_id)
+                statuses = await asyncio.to_thread(self.store.statuses, list(self._running))
+            except Exception as e:
+                log.warning("job_poll_failed", f"读取任务队列失败: {e}")
+                continue
+            for job_id, status in statuses.items():
+                task = self._running.get(job_id)
+                if status == CANCELLED and task is not None and job_id not in self._cancelled:
+                    self._cancelled.add(job_id)
+                    task.cancel()
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._enqueued.discard(job_id)
+            attempts = await asyncio.to_thread(self.store.claim, job_id)
+            if attempts is None or job_id in self._cancelled:
+                self._cancelled.discard(job_id)
+                continue
+            if attempts > self.max_attempts:
+                await asyncio.to_thread(self.store.finish, job_id, FAILED, f"任务已尝试 {attempts - 1} 次仍未完成")
+                continue
+            task = asyncio.ensure_future(self.handler(job_id))
+            self._running[job_id] = task
+            try:
+                await task
+            except asyncio.CancelledError:
+                if job_id not in self._cancelled:
+                    # worker 本身被停止：任务保持 running，下次启动时恢复
+                    raise
+                log.info("job_cancelled", "任务已取消", jobId=job_id)
+            except JobFailedError as e:
+                log.warning("job_failed", f"任务失败: {e}", jobId=job_id)
+                await asyncio.to_thread(self.store.finish, job_id, FAILED, str(e))
+            except Exception as e:
+                log.error("job_failed", f"任务失败: {e}", exc_info=e, jobId=job_id)
+                await asyncio.to_thread(self.store.finish, job_id, FAILED, str(e))
+            else:
+                await asyncio.to_thread(self.store.finish, job_id, COMPLETED)
+            finally:
+                self._running.pop(job_id, None)
+                self._cancelled.discard(job_id)
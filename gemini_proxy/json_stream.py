@@ -0,0 +1,71 @@
+"""
+增量 JSON 数组解析
+模型流式输出脚本时，每当数组中的一个对象完整出现就立即取出
+"""
+
+import json
+
+
+class IncrementalArrayParser:
+    """逐块喂入文本，返回已完整闭合的顶层数组元素（对象）
+
+    只跟踪字符串、转义和括号深度，不做完整的 JSON 语法检查；
+    每个元素闭合后再交给 json.loads 解析。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0             # 下一个待扫描字符的位置
+        self._started = False     # 是否已经遇到顶层的 '['
+        self._depth = 0           # 相对顶层数组的嵌套深度
+        self._in_string = False
+        self._escaped = False
+        self._item_start = None   # 当前元素在 buffer 中的起点
+        self.text = ""            # 迄今收到的完整原始文本
+
+    def feed(self, chunk):
+        """追加一段文本，返回本次新闭合的元素列表"""
+        self.text += chunk
+        self._buffer += chunk
+        items = []
+
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+
+            if not self._started:
+                # 跳过数组之前的任何内容（例如 ```json 代码块标记）
+                if ch == '[':
+                    self._started = True
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                if self._depth == 0:
+                    self._item_start = self._pos
+                self._depth += 1
+            elif ch in '}]':
+                if self._depth == 0:
+                    # 顶层数组结束
+                    self._started = False
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        items.append(json.loads(self._buffer[self._item_start:self._pos + 1]))
+                        # 丢弃已解析的部分，buffer 只保留未完成的元素
+                        self._buffer = self._buffer[self._pos + 1:]
+                        self._pos = -1
+                        self._item_start = None
+
+            self._pos += 1
+
+        if self._item_start is None and self._depth == 0:
+            self._buffer = ""
+            self._pos = 0
+
+        return items
@@ -0,0 +1,192 @@
+"""
+多 API Key 池
+每个 Key 可以有独立的令牌桶限速（rpm 为 0 时不限速）；请求调度到剩余额度最多的 Key，
+被限流 (429) 或鉴权失败的 Key 进入冷却，流量自动转移到其他 Key
+"""
+
+import asyncio
+import time
+
+from gemini_proxy import structured_log as log
+from gemini_proxy.resilience import api_error_code
+
+# 触发换 Key 重试的状态码：限流与鉴权/配额问题都只跟当前 Key 有关
+THROTTLE_CODES = {429}
+AUTH_CODES = {401, 403}
+
+
+class NoAvailableKeyError(RuntimeError):
+    """没有可用的 Key（模型不被允许或全部在冷却中）"""
+
+
+def parse_key_spec(spec):
+    """解析 GEMINI_API_KEYS：逗号分隔，每项为 key 或 key:模型1|模型2"""
+    keys = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        key, _, models = item.partition(":")
+        allowed = {m.strip() for m in models.split("|") if m.strip()} or None
+        keys.append((key.strip(), allowed))
+    return keys
+
+
+class LazyClient:
+    """google.genai.Client 的占位：第一次访问属性时才导入 google.genai 并创建 Client
+
+    导入 google.genai 约 0.8 秒，不放在启动路径上；服务进程在第一次调用上游前用 ensure_genai 在线程中导入
+    """
+
+    def __init__(self, api_key):
+        self._api_key = api_key
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            from google import genai
+            self._client = genai.Client(api_key=self._api_key)
+        return getattr(self._client, name)
+
+
+class ApiKey:
+    """一个 Key 及其令牌桶、冷却状态和统计"""
+
+    def __init__(self, api_key, client, rpm, burst, allowed_models=None):
+        self.api_key = api_key
+        self.client = client
+        self.allowed_models = allowed_models
+        # rpm 为 0 表示不限速，只按冷却状态调度
+        self.limited = rpm > 0
+        self.rate = rpm / 60.0
+        self.capacity = float(burst) if self.limited else float("inf")
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.cooldown_until = 0.0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.throttled = 0
+        self.failures = 0
+
+    @property
+    def label(self):
+        return f"...{self.api_key[-4:]}"
+
+    def allows(self, model):
+        return self.allowed_models is None or model in self.allowed_models
+
+    def refill(self, now):
+        if not self.limited:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until_ready(self, now):
+        """距离可以再发一个请求还需等待的秒数"""
+        wait = max(0.0, self.cooldown_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate if self.rate > 0 else float("inf"))
+        return wait
+
+    def state(self, now):
+        self.refill(now)
+        return {
+            "key": self.label,
+            "models": sorted(self.allowed_models) if self.allowed_models else "all",
+            "tokens": round(self.tokens, 2) if self.limited else None,
+            "capacity": self.capacity if self.limited else None,
+            "coolingDown": self.cooldown_until > now,
+            "cooldownRemaining": round(max(0.0, self.cooldown_until - now), 1),
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "failures": self.failures,
+        }
+
+
+class KeyPool:
+    """按剩余额度调度多个 Key，并在限流/鉴权失败时转移"""
+
+    def __init__(self, keys, cooldown=30.0, max_cooldown=600.0, max_wait=30.0):
+        self.keys = keys
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_wait = max_wait
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def __bool__(self):
+        return bool(self.keys)
+
+    async def acquire(self, model, exclude=()):
+        """取一个可用 Key 并消耗一个令牌；必要时等待，最长 max_wait 秒"""
+        candidates = [k for k in self.keys if k.allows(model) and k not in exclude]
+        if not candidates:
+            raise NoAvailableKeyError(f"没有可用于模型 {model} 的 API Key")
+
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            # 选 Key 和扣令牌之间没有 await，在事件循环内是原子的，不需要加锁；
+            # 等待时不持有任何锁，其他模型、其他 Key 的请求不会被排在后面
+            now = time.monotonic()
+            for key in candidates:
+                key.refill(now)
+            ready = [k for k in candidates if k.cooldown_until <= now and k.tokens >= 1]
+            if ready:
+                key = max(ready, key=lambda k: k.tokens)
+                key.tokens -= 1
+                key.requests += 1
+                return key
+            wait = min(k.seconds_until_ready(now) for k in candidates)
+            if now + wait > deadline:
+                raise NoAvailableKeyError(f"模型 {model} 的所有 API Key 都在限流冷却中")
+            # 醒来后重新选：等待期间令牌可能已被其他请求取走
+            self.waits += 1
+            self.wait_seconds += wait
+            await asyncio.sleep(wait)
+
+    def report_success(self, key):
+        key.consecutive_failures = 0
+
+    def report_failure(self, key, error):
+        """记录 Key 级别的失败，返回是否应换 Key 重试"""
+        code = api_error_code(error)
+        if code not in THROTTLE_CODES and code not in AUTH_CODES:
+            return False
+        key.failures += 1
+        key.consecutive_failures += 1
+        if code in THROTTLE_CODES:
+            key.throttled += 1
+        # 连续失败时冷却时间翻倍；鉴权问题通常不会自己恢复，直接用最长冷却
+        if code in AUTH_CODES:
+            cooldown = self.max_cooldown
+        else:
+            cooldown = min(self.max_cooldown, self.cooldown * 2 ** (key.consecutive_failures - 1))
+        key.cooldown_until = time.monotonic() + cooldown
+        key.tokens = 0.0
+        log.warning("api_key_cooldown", f"API Key 返回 {code}，进入冷却", key=key.label, cooldown=round(cooldown))
+        return True
+
+    async def run(self, model, call):
+        """用一个 Key 执行 call(client)；Key 被限流或鉴权失败时换下一个 Key"""
+        eligible = sum(1 for k in self.keys if k.allows(model))
+        tried = []
+        while True:
+            key = await self.acquire(model, exclude=tried)
+            try:
+                result = await call(key.client)
+            except Exception as e:
+                tried.append(key)
+                if self.report_failure(key, e) and len(tried) < eligible:
+                    continue
+                raise
+            self.report_success(key)
+            return result
+
+    def stats(self):
+        """等待令牌或冷却结束的次数和总时长（不计入上游延迟）"""
+        return {"waits": self.waits, "waitMs": round(self.wait_seconds * 1000, 1)}
+
+    def states(self):
+        now = time.monotonic()
+        return [key.state(now) for key in self.keys]
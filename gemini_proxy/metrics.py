@@ -0,0 +1,232 @@
+"""
+Prometheus 指标
+热路径上只有直方图 observe 和计数器 inc；缓存、并发限制、熔断器、Key 池等组件已有的统计
+在抓取 /metrics 时通过回调读取，不给请求增加额外开销
+"""
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from gemini_proxy.adaptive_limit import LimiterTimeoutError
+from gemini_proxy.circuit_breaker import CircuitOpenError
+from gemini_proxy.key_pool import NoAvailableKeyError
+from gemini_proxy.resilience import api_error_code
+
+registry = CollectorRegistry()
+
+# 覆盖从毫秒级的缓存命中到数分钟的图片生成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+REQUEST_SECONDS = Histogram(
+    "gemini_proxy_request_seconds", "接口耗时（到响应头发出为止）",
+    ["endpoint", "model", "status"], buckets=LATENCY_BUCKETS, registry=registry
+)
+STAGE_SECONDS = Histogram(
+    "gemini_proxy_stage_seconds",
+    "各阶段耗时：queue_wait / reference_load / asset_upload / upstream / parse / encode / serialize / resize",
+    ["stage", "model"], buckets=LATENCY_BUCKETS, registry=registry
+)
+BYTES = Counter(
+    "gemini_proxy_bytes_total", "请求体与响应体字节数（流式响应不计）",
+    ["endpoint", "direction"], registry=registry
+)
+TOKENS = Counter(
+    "gemini_proxy_tokens_total", "上游报告的 token 数：prompt（含缓存部分）/ cached / output",
+    ["model", "kind"], registry=registry
+)
+UPSTREAM_ERRORS = Counter(
+    "gemini_proxy_upstream_errors_total", "上游调用失败次数，按错误类别",
+    ["model", "error_class"], registry=registry
+)
+# 多 worker 时（设置了 PROMETHEUS_MULTIPROC_DIR）在飞数按存活进程求和
+REQUESTS_IN_FLIGHT = Gauge(
+    "gemini_proxy_requests_in_flight", "正在处理的请求数（流式响应到响应体发完为止）", ["endpoint"], registry=registry,
+    multiprocess_mode="livesum"
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "gemini_proxy_upstream_in_flight", "正在进行的上游调用数", ["model"], registry=registry,
+    multiprocess_mode="livesum"
+)
+
+
+# 当前请求的 RequestTiming；随任务上下文传递到批量生成等子任务
+_request_timing = ContextVar("request_timing", default=None)
+
+
+class RequestTiming:
+    """单个请求各阶段的累计耗时，用于 Server-Timing 响应头"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}    # 阶段 -> [累计秒数, 次数]
+        self.active = []    # 正在进行的阶段，采样分析器用来标注等待时间
+
+    def header(self):
+        """Server-Timing 头；同一阶段出现多次（批量生成的多格）时累加，desc 给出次数"""
+        parts = []
+        for name, (seconds, count) in self.stages.items():
+            part = f"{name};dur={seconds * 1000:.1f}"
+            if count > 1:
+                part += f';desc="x{count}"'
+            parts.append(part)
+        parts.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+def start_request_timing():
+    """为当前请求开始记录各阶段耗时"""
+    timing = RequestTiming()
+    _request_timing.set(timing)
+    return timing
+
+
+@contextmanager
+def stage(name, model=""):
+    """记录一个阶段的耗时"""
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.active.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(name, model).observe(elapsed)
+        if timing is not None:
+            timing.active.remove(name)
+            entry = timing.stages.setdefault(name, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+
+
+def record_usage(model, usage):
+    """记录响应的 usage_metadata"""
+    if usage is None:
+        return
+    for kind, value in (("prompt", usage.prompt_token_count), ("cached", usage.cached_content_token_count),
+                        ("output", usage.candidates_token_count)):
+        if value:
+            TOKENS.labels(model, kind).inc(value)
+
+
+def error_class(error):
+    """上游错误归类，标签取值有限"""
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(error, LimiterTimeoutError):
+        return "queue_timeout"
+    if isinstance(error, NoAvailableKeyError):
+        return "no_key"
+    code = api_error_code(error)
+    if code is not None:
+        if code == 429:
+            return "throttled"
+        if code in (401, 403):
+            return "auth"
+        return "server" if code >= 500 else "client"
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(error, (httpx.TransportError, ConnectionError)):
+        return "transport"
+    return "other"
+
+
+class _SnapshotCollector:
+    """抓取时调用各组件的回调生成指标"""
+
+    def __init__(self):
+        self._sources = []
+
+    def add(self, source):
+        self._sources.append(source)
+
+    def describe(self):
+        # 返回空列表，注册时不预先调用 collect
+        return []
+
+    def collect(self):
+        for source in self._sources:
+            yield from source()
+
+
+snapshots = _SnapshotCollector()
+registry.register(snapshots)
+
+
+def cache_metrics(caches):
+    """caches: 名称 -> stats()，取其中的 hits / misses（没有的不导出）"""
+    requests = CounterMetricFamily(
+        "gemini_proxy_cache_requests", "缓存查询次数", labels=["cache", "result"]
+    )
+    for name, stats in caches.items():
+        for key, result in (("hits", "hit"), ("misses", "miss")):
+            if key in stats:
+                requests.add_metric([name, result], stats[key])
+    yield requests
+
+
+def limiter_metrics(states):
+    """states: 模型 -> AdaptiveLimiter.state()"""
+    limit = GaugeMetricFamily("gemini_proxy_concurrency_limit", "自适应并发上限", labels=["model"])
+    queued = GaugeMetricFamily("gemini_proxy_queue_depth", "等待上游名额的请求数", labels=["model", "class"])
+    served = CounterMetricFamily("gemini_proxy_queue_served", "放行的请求数", labels=["model", "class"])
+    for model, state in states.items():
+        limit.add_metric([model], state["limit"])
+        for priority_class, stats in state["classes"].items():
+            queued.add_metric([model, priority_class], stats["queued"])
+            served.add_metric([model, priority_class], stats["served"])
+    yield limit
+    yield queued
+    yield served
+
+
+def breaker_metrics(snapshots_by_model):
+    """snapshots_by_model: 模型 -> CircuitBreaker.snapshot()"""
+    state = GaugeMetricFamily("gemini_proxy_circuit_open", "熔断器是否打开（半开记为 0.5）", labels=["model"])
+    rejected = CounterMetricFamily("gemini_proxy_circuit_rejected", "熔断拒绝的请求数", labels=["model"])
+    values = {"closed": 0, "half_open": 0.5, "open": 1}
+    for model, snapshot in snapshots_by_model.items():
+        state.add_metric([model], values.get(snapshot["state"], 0))
+        rejected.add_metric([model], snapshot["rejected"])
+    yield state
+    yield rejected
+
+
+def key_metrics(key_states):
+    """key_states: KeyPool.states()"""
+    tokens = GaugeMetricFamily("gemini_proxy_api_key_tokens", "API Key 令牌桶剩余额度", labels=["key"])
+    cooling = GaugeMetricFamily("gemini_proxy_api_key_cooling_down", "API Key 是否在冷却中", labels=["key"])
+    for state in key_states:
+        if state["tokens"] is not None:
+            tokens.add_metric([state["key"]], state["tokens"])
+        cooling.add_metric([state["key"]], 1 if state["coolingDown"] else 0)
+    yield tokens
+    yield cooling
+
+
+def counter_metrics(name, documentation, values):
+    """把一组计数（标签值 -> 数值）导出为单标签计数器"""
+    family = CounterMetricFamily(name, documentation, labels=["kind"])
+    for kind, value in values.items():
+        family.add_metric([kind], value)
+    yield family
+
+
+def render():
+    """返回 (响应体, Content-Type)
+    多 worker 时直方图、计数器从各进程写出的文件汇总；组件快照只反映处理本次抓取的 worker
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        merged.register(snapshots)
+        return generate_latest(merged), CONTENT_TYPE_LATEST
+    return generate_latest(registry), CONTENT_TYPE_LATEST
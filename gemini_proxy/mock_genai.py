@@ -0,0 +1,294 @@
+"""
+离线模拟的 Gemini 后端
+接口与 google.genai.Client 的异步部分一致（client.aio.models.generate_content / generate_content_stream / count_tokens / get，
+client.aio.files.upload / delete，client.aio.caches.create / update / delete），
+返回真实的 types.GenerateContentResponse（带 usage_metadata）；延迟、错误率、429 比例可配置，用于压测和回归测试，不消耗配额。
+上传的文件和上下文缓存按配置的有效期过期，引用过期或不存在的句柄时与真实 API 一样返回 403 / 404。
+
+配置为逗号分隔的 key=value，例如
+    script_latency=2.0,image_latency=8.0,sigma=0.4,error_rate=0.01,throttle_rate=0.02,image_size=1024
+"""
+
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import random
+import time
+import uuid
+
+from google.genai import errors, types
+from PIL import Image
+
+DEFAULTS = {
+    "script_latency": 2.0,   # 脚本请求的延迟中位数（秒）
+    "image_latency": 8.0,    # 图片请求的延迟中位数（秒）
+    "sigma": 0.35,           # 延迟按对数正态分布，sigma 越大长尾越重
+    "error_rate": 0.0,       # 返回 503 的比例
+    "throttle_rate": 0.0,    # 返回 429 的比例
+    "panels": 6,             # 脚本格数
+    "image_size": 1024,      # 图片边长（像素）
+    "stream_chunks": 12,     # 流式返回的分块数
+    "seed": None,            # 固定随机种子，便于复现
+    "file_ttl": 48 * 3600,   # 上传文件的有效期（秒）
+    "cache_min_tokens": 4096,  # 上下文缓存的最小 token 数，少于时创建失败（与真实模型一样，0 表示不限）
+}
+
+# 每张图片按固定 token 数计费（与真实 API 一致）
+IMAGE_TOKENS = 258
+
+
+def parse_mock_config(spec):
+    """解析 key=value 配置；spec 为 "1" / "true" 时使用默认值"""
+    config = dict(DEFAULTS)
+    spec = (spec or "").strip()
+    if spec.lower() in ("", "1", "true", "yes"):
+        return config
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, sep, value = item.partition("=")
+        key = key.strip()
+        if not sep or key not in DEFAULTS:
+            raise ValueError(f"无效的模拟后端配置项: {item!r}（可用: {', '.join(DEFAULTS)}）")
+        int_keys = ("panels", "image_size", "stream_chunks", "seed", "file_ttl", "cache_min_tokens")
+        config[key] = int(value) if key in int_keys else float(value)
+    return config
+
+
+def _synthetic_png(size, seed):
+    """带噪点的 PNG，压缩后的大小接近真实生成图"""
+    rng = random.Random(seed)
+    base = Image.new("RGB", (size, size), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    noise = Image.effect_noise((size, size), 48).convert("RGB")
+    buf = io.BytesIO()
+    Image.blend(base, noise, 0.35).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _tokens(text):
+    """粗略估算 token 数"""
+    return max(1, len(text.encode("utf-8")) // 4)
+
+
+def _expiry(seconds):
+    return datetime.datetime.fromtimestamp(time.time() + seconds, tz=datetime.timezone.utc)
+
+
+def _api_error(code, status, message):
+    return errors.APIError(code, {"error": {"code": code, "message": f"{message} (mock)", "status": status}})
+
+
+class _MockStore:
+    """模拟的服务端状态：上传的文件、上下文缓存和收到的字节数"""
+
+    def __init__(self):
+        self.files = {}     # uri -> types.File
+        self.caches = {}    # name -> (types.CachedContent, token 数)
+        self.uploaded_bytes = 0
+        self.inline_bytes = 0
+
+    def file(self, uri):
+        file = self.files.get(uri)
+        if file is None or file.expiration_time.timestamp() <= time.time():
+            raise _api_error(403, "PERMISSION_DENIED",
+                             f"You do not have permission to access the File {uri} or it may not exist")
+        return file
+
+    def cache(self, name):
+        entry = self.caches.get(name)
+        if entry is None or entry[0].expire_time.timestamp() <= time.time():
+            raise _api_error(404, "NOT_FOUND", f"CachedContent not found: {name}")
+        return entry
+
+
+class _MockModels:
+    def __init__(self, config, store):
+        self.config = config
+        self.store = store
+        self.calls = 0
+        self._random = random.Random(config["seed"])
+        # 生成图片比较耗时，预先生成几张轮流返回
+        self._images = [_synthetic_png(config["image_size"], i) for i in range(4)]
+
+    async def _simulate(self, model):
+        """等待一段随机延迟，按比例抛出 503 / 429"""
+        self.calls += 1
+        median = self.config["image_latency"] if "image" in model else self.config["script_latency"]
+        await asyncio.sleep(median * self._random.lognormvariate(0, self.config["sigma"]))
+        roll = self._random.random()
+        if roll < self.config["throttle_rate"]:
+            raise _api_error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted")
+        if roll < self.config["throttle_rate"] + self.config["error_rate"]:
+            raise _api_error(503, "UNAVAILABLE", "The model is overloaded")
+
+    def _usage(self, contents, config):
+        """检查引用的文件和缓存，统计输入 token 数和内联字节数"""
+        items = contents if isinstance(contents, list) else [contents]
+        prompt = cached = 0
+        for item in items:
+            if isinstance(item, str):
+                prompt += _tokens(item)
+            elif isinstance(item, types.Part) and item.inline_data is not None:
+                self.store.inline_bytes += len(item.inline_data.data)
+                prompt += IMAGE_TOKENS
+            elif isinstance(item, types.Part) and item.file_data is not None:
+                self.store.file(item.file_data.file_uri)
+                prompt += IMAGE_TOKENS
+            elif isinstance(item, types.Part) and item.text:
+                prompt += _tokens(item.text)
+        if config is not None:
+            if config.cached_content:
+                cached = self.store.cache(config.cached_content)[1]
+            if isinstance(config.system_instruction, str):
+                prompt += _tokens(config.system_instruction)
+        return prompt + cached, cached
+
+    def _script_text(self, contents):
+        digest = hashlib.sha256(str(contents).encode("utf-8")).hexdigest()[:8]
+        panels = [
+            {
+                "panelNumber": i,
+                "sceneDescription": f"Mock scene {i} ({digest}): a cute robot explains the concept to a grumpy cat.",
+                "dialogue": f"机器人：这是第 {i} 格的台词。猫：哼。"
+            }
+            for i in range(1, self.config["panels"] + 1)
+        ]
+        return json.dumps(panels, ensure_ascii=False)
+
+    async def generate_content(self, model, contents, config=None):
+        prompt, cached = self._usage(contents, config)
+        await self._simulate(model)
+        if "image" in model:
+            part = types.Part(inline_data=types.Blob(
+                data=self._images[self.calls % len(self._images)], mime_type="image/png"
+            ))
+            output = IMAGE_TOKENS
+        else:
+            part = types.Part(text=self._script_text(contents))
+            output = _tokens(part.text)
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[part]), finish_reason="STOP")],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt, cached_content_token_count=cached or None,
+                candidates_token_count=output, total_token_count=prompt + output
+            )
+        )
+
+    async def generate_content_stream(self, model, contents, config=None):
+        # 与真实 SDK 一样：建立流之前的失败直接抛出，之后逐块产出
+        prompt, cached = self._usage(contents, config)
+        await self._simulate(model)
+        text = self._script_text(contents)
+        chunks = max(1, self.config["stream_chunks"])
+        step = max(1, -(-len(text) // chunks))
+        pause = self.config["script_latency"] / chunks
+        usage = types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt, cached_content_token_count=cached or None,
+            candidates_token_count=_tokens(text), total_token_count=prompt + _tokens(text)
+        )
+
+        async def stream():
+            for i in range(0, len(text), step):
+                await asyncio.sleep(pause)
+                last = i + step >= len(text)
+                yield types.GenerateContentResponse(candidates=[types.Candidate(
+                    content=types.Content(role="model", parts=[types.Part(text=text[i:i + step])])
+                )], usage_metadata=usage if last else None)
+
+        return stream()
+
+    async def count_tokens(self, model, contents, config=None):
+        items = contents if isinstance(contents, list) else [contents]
+        return types.CountTokensResponse(total_tokens=sum(_tokens(item) for item in items if isinstance(item, str)))
+
+    async def get(self, model, config=None):
+        return types.Model(name=f"models/{model}", display_name=f"{model} (mock)")
+
+
+class _MockFiles:
+    def __init__(self, config, store):
+        self.config = config
+        self.store = store
+
+    async def upload(self, file, config=None):
+        if hasattr(file, "read"):
+            data = file.read()
+        else:
+            with open(file, "rb") as f:
+                data = f.read()
+        if isinstance(config, dict):
+            config = types.UploadFileConfig(**config)
+        file_id = uuid.uuid4().hex[:12]
+        uploaded = types.File(
+            name=f"files/{file_id}", uri=f"mock://files/{file_id}",
+            display_name=config.display_name if config else None,
+            mime_type=config.mime_type if config else "application/octet-stream",
+            size_bytes=len(data), expiration_time=_expiry(self.config["file_ttl"]), state=types.FileState.ACTIVE
+        )
+        self.store.files[uploaded.uri] = uploaded
+        self.store.uploaded_bytes += len(data)
+        return uploaded
+
+    async def delete(self, name, config=None):
+        for uri, file in list(self.store.files.items()):
+            if file.name == name:
+                del self.store.files[uri]
+                return types.DeleteFileResponse()
+        raise _api_error(404, "NOT_FOUND", f"File not found: {name}")
+
+
+def _ttl_seconds(ttl):
+    return float(str(ttl).rstrip("s"))
+
+
+class _MockCaches:
+    def __init__(self, config, store):
+        self.config = config
+        self.store = store
+
+    async def create(self, model, config=None):
+        if isinstance(config, dict):
+            config = types.CreateCachedContentConfig(**config)
+        text = config.system_instruction if isinstance(config.system_instruction, str) else str(config.system_instruction)
+        tokens = _tokens(text)
+        if tokens < self.config["cache_min_tokens"]:
+            raise _api_error(400, "INVALID_ARGUMENT", f"Cached content is too small. total_token_count={tokens}, "
+                                                      f"min_total_token_count={self.config['cache_min_tokens']}")
+        cached = types.CachedContent(
+            name=f"cachedContents/{uuid.uuid4().hex[:12]}", model=f"models/{model}",
+            display_name=config.display_name, expire_time=_expiry(_ttl_seconds(config.ttl or "3600s")),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens)
+        )
+        self.store.caches[cached.name] = (cached, tokens)
+        return cached
+
+    async def update(self, name, config=None):
+        if isinstance(config, dict):
+            config = types.UpdateCachedContentConfig(**config)
+        cached, tokens = self.store.cache(name)
+        cached = cached.model_copy(update={"expire_time": _expiry(_ttl_seconds(config.ttl or "3600s"))})
+        self.store.caches[name] = (cached, tokens)
+        return cached
+
+    async def delete(self, name, config=None):
+        if self.store.caches.pop(name, None) is None:
+            raise _api_error(404, "NOT_FOUND", f"CachedContent not found: {name}")
+        return types.DeleteCachedContentResponse()
+
+
+class _MockAio:
+    def __init__(self, config):
+        self.store = _MockStore()
+        self.models = _MockModels(config, self.store)
+        self.files = _MockFiles(config, self.store)
+        self.caches = _MockCaches(config, self.store)
+
+
+class MockClient:
+    """替代 genai.Client 的模拟客户端"""
+
+    def __init__(self, config=None):
+        self.config = config or dict(DEFAULTS)
+        self.aio = _MockAio(self.config)
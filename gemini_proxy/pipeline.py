@@ -0,0 +1,123 @@
+"""
+"脚本 + 图片" 流水线任务的状态与订阅
+脚本还在生成时，已完成的格子就开始出图；进度可以轮询也可以订阅
+"""
+
+import asyncio
+import time
+import uuid
+
+
+class PipelineJob:
+    """一次流水线任务：按格记录脚本与出图进度，并把变化推送给订阅者"""
+
+    def __init__(self, concept, style, model):
+        self.id = uuid.uuid4().hex
+        self.concept = concept
+        self.style = style
+        self.model = model
+        self.status = "scripting"    # scripting -> rendering -> completed / failed
+        self.panels = []
+        self.raw_text = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self._subscribers = set()
+
+    @property
+    def done(self):
+        return self.status in ("completed", "failed")
+
+    def add_panel(self, panel):
+        """脚本新完成一格"""
+        entry = {**panel, "status": "pending"}
+        self.panels.append(entry)
+        self._publish("panel", dict(entry))
+        return entry
+
+    def set_image_result(self, entry, result):
+        """某一格出图结束（成功或失败）"""
+        entry.update(result)
+        self._publish("image", result)
+
+    def finish_script(self, raw_text):
+        self.raw_text = raw_text
+        self.status = "rendering"
+        self._publish("script_done", {"totalPanels": len(self.panels)})
+
+    def finish(self):
+        self.status = "completed"
+        self.finished_at = time.time()
+        self._publish("done", self.progress())
+
+    def fail(self, error):
+        self.status = "failed"
+        self.error = error
+        self.finished_at = time.time()
+        self._publish("error", {"error": error, **self.progress()})
+
+    def progress(self):
+        succeeded = sum(1 for p in self.panels if p["status"] == "success")
+        failed = sum(1 for p in self.panels if p["status"] == "failed")
+        end = self.finished_at or time.time()
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "totalPanels": len(self.panels),
+            "scriptDone": self.status != "scripting",
+            "succeeded": succeeded,
+            "failed": failed,
+            "pending": len(self.panels) - succeeded - failed,
+            "elapsed": round(end - self.created_at, 3),
+        }
+
+    def snapshot(self, include_images=False):
+        """当前完整状态；默认不带图片数据"""
+        panels = self.panels
+        if not include_images:
+            panels = [{k: v for k, v in p.items() if k != "imageData"} for p in panels]
+        return {
+            **self.progress(),
+            "concept": self.concept,
+            "style": self.style,
+            "error": self.error,
+            "panels": panels,
+        }
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def _publish(self, event, payload):
+        for queue in self._subscribers:
+            queue.put_nowait((event, payload))
+
+
+class JobRegistry:
+    """内存中的任务表，已结束的任务保留 ttl 秒"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._jobs = {}
+
+    def add(self, job):
+        self.prune()
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def prune(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.done and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,262 @@
+"""
+生产环境入口：python -m gemini_proxy.prefork
+
+启动顺序：先绑定监听端口，再在 master 进程里导入应用、加载只读状态（风格参考图等），然后 fork 出 worker。
+worker 通过写时复制共享已导入的模块和预加载的数据，各自完成预热（上游连接等）后才开始 accept；
+这期间到达的连接留在监听队列里等待，不会被拒绝。
+
+master 不处理请求，只负责监督：
+- worker 退出后重新 fork（从预加载好的状态 fork，不用重新导入，频繁崩溃时退避）
+- SIGHUP：替换全部 worker，不中断服务；代码改动不会生效，需要重启整个进程
+- SIGTERM / SIGINT：通知 worker 处理完在途请求后退出
+"""
+
+import time
+
+BOOTED_AT = time.time()
+
+import argparse
+import gc
+import glob
+import importlib
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+
+from dotenv import load_dotenv
+
+# 这里只导入标准库和轻量模块，尽早绑定端口；hypercorn 和应用在绑定之后再导入
+from gemini_proxy import structured_log as log
+
+# 频繁崩溃的 worker 重新 fork 前的退避（秒），存活超过 MIN_UPTIME 秒后重置
+MIN_UPTIME = 10.0
+MAX_BACKOFF = 30.0
+
+
+def parse_args(argv=None):
+    # 与 gemini_proxy_server 一样先加载环境变量文件，GEMINI_WORKERS 等也可以写在里面
+    load_dotenv('.env.local') or load_dotenv('.env') or load_dotenv()
+    parser = argparse.ArgumentParser(description="Gemini 代理服务器（prefork）")
+    parser.add_argument("--app", default=os.getenv("GEMINI_APP", "gemini_proxy_server:app"))
+    parser.add_argument("--bind", default=os.getenv("GEMINI_BIND", "127.0.0.1:3001"))
+    parser.add_argument("-w", "--workers", type=int, default=int(os.getenv("GEMINI_WORKERS", "1")))
+    parser.add_argument("--backlog", type=int, default=int(os.getenv("GEMINI_BACKLOG", "1024")))
+    parser.add_argument("--graceful-timeout", type=float,
+                        default=float(os.getenv("GEMINI_GRACEFUL_TIMEOUT", "30")),
+                        help="停止时等待在途请求的秒数（图片生成可能很慢）")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        default=os.getenv("GEMINI_PRELOAD", "1") != "0",
+                        help="worker 各自导入应用（不共享内存，启动更慢）")
+    return parser.parse_args(argv)
+
+
+def listen(bind, backlog):
+    """绑定 host:port（IPv6 写成 [::1]:3001）"""
+    host, _, port = bind.rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(backlog)
+    return sock
+
+
+def load_app(path):
+    module, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module), attr or "app")
+
+
+def prepare_metrics_dir():
+    """多 worker 时 Prometheus 指标写到共享目录汇总；必须在导入 prometheus_client 之前设置"""
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+        return None
+    directory = tempfile.mkdtemp(prefix="gemini-proxy-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directory
+    return directory
+
+
+class Master:
+    def __init__(self, args, sock, app):
+        self.args = args
+        self.sock = sock
+        self.app = app
+        self.workers = {}       # pid -> [worker 序号, fork 时间]
+        self.retiring = set()   # SIGHUP 后被替换、正在退出的 worker
+        self.restarting = set()  # SIGHUP 后退出即重新 fork 的 worker
+        self.failures = {}      # worker 序号 -> 连续过早退出次数
+        self.pending = {}       # worker 序号 -> 计划重新 fork 的时间
+        self.signals = []
+        self.stopping = False
+        self.deadline = 0.0
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, lambda signum, frame: self.signals.append(signum))
+        for index in range(self.args.workers):
+            self.spawn(index)
+        while self.workers or not self.stopping:
+            while self.signals:
+                self.handle(self.signals.pop(0))
+            self.reap()
+            now = time.monotonic()
+            for index, at in list(self.pending.items()):
+                if at <= now and not self.stopping:
+                    del self.pending[index]
+                    self.spawn(index)
+            time.sleep(0.1)
+        log.info("master_stopped", "所有 worker 已退出")
+
+    def handle(self, signum):
+        if signum == signal.SIGHUP:
+            if self.stopping:
+                return
+            log.info("workers_reloading", "收到 SIGHUP，替换全部 worker", workers=len(self.workers))
+            for pid, (index, _) in list(self.workers.items()):
+                if pid in self.retiring:
+                    continue
+                if index == 0:
+                    # 0 号 worker 执行持久化任务，旧进程退出后再启动新的，避免同一任务被两边同时执行
+                    self.restarting.add(pid)
+                else:
+                    self.retiring.add(pid)
+                    self.spawn(index)
+                os.kill(pid, signal.SIGTERM)
+            return
+        if not self.stopping:
+            self.stopping = True
+            self.pending.clear()
+            log.info("master_stopping", "等待 worker 处理完在途请求", workers=len(self.workers))
+            for pid in self.workers:
+                os.kill(pid, signal.SIGTERM)
+            self.deadline = time.monotonic() + self.args.graceful_timeout + 5
+        elif time.monotonic() > self.deadline or signum == signal.SIGINT:
+            for pid in self.workers:
+                os.kill(pid, signal.SIGKILL)
+
+    def reap(self):
+        if self.stopping and self.workers and time.monotonic() > self.deadline:
+            self.handle(signal.SIGTERM)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            entry = self.workers.pop(pid, None)
+            if entry is None:
+                continue
+            index, forked_at = entry
+            self.mark_dead(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if pid in self.restarting:
+                self.restarting.discard(pid)
+                if not self.stopping:
+                    self.pending[index] = time.monotonic()
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                log.info("worker_exited", "worker 已退出", worker=index, pid=pid, code=code)
+                continue
+            uptime = time.monotonic() - forked_at
+            failures = self.failures.get(index, 0) + 1 if uptime < MIN_UPTIME else 0
+            self.failures[index] = failures
+            delay = min(MAX_BACKOFF, 0.5 * 2 ** (failures - 1)) if failures else 0.0
+            log.warning("worker_exited", "worker 意外退出，重新启动", worker=index, pid=pid, code=code,
+                        uptime=round(uptime, 1), restartIn=delay)
+            self.pending[index] = time.monotonic() + delay
+
+    def mark_dead(self, pid):
+        if self.args.workers > 1:
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = [index, time.monotonic()]
+            return
+        run_worker(index, self.sock, self.app, self.args)
+
+
+def run_worker(index, sock, app, args):
+    """fork 出的 worker；不会返回"""
+    os.environ["GEMINI_WORKER_INDEX"] = str(index)
+    os.environ["GEMINI_WORKER_STARTED_AT"] = repr(time.time())
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+    code = 0
+    try:
+        if app is None:
+            log.shutdown()  # 应用导入时会建立自己的日志管道
+            app = load_app(args.app)
+        serve_app(app, sock, args)
+    except BaseException as e:
+        log.error("worker_crashed", f"worker 异常退出: {e}", exc_info=e, worker=index)
+        code = 1
+    finally:
+        log.shutdown()
+        os._exit(code)
+
+
+def serve_app(app, sock, args):
+    import asyncio
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    # hypercorn 接管传入的文件描述符，传一份副本
+    config.bind = [f"fd://{os.dup(sock.fileno())}"]
+    config.backlog = args.backlog
+    config.graceful_timeout = args.graceful_timeout
+    asyncio.run(serve(app, config))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.workers = max(1, args.workers)
+    os.environ["GEMINI_WORKERS"] = str(args.workers)
+    os.environ["GEMINI_BOOTED_AT"] = repr(BOOTED_AT)
+    # 先占住端口：导入、预热期间到达的连接在监听队列里等待
+    sock = listen(args.bind, args.backlog)
+    metrics_dir = prepare_metrics_dir() if args.workers > 1 else None
+
+    app = None
+    if args.preload:
+        start = time.perf_counter()
+        app = load_app(args.app)
+        module = sys.modules[args.app.partition(":")[0]]
+        if hasattr(module, "preload"):
+            module.preload()
+        os.environ["GEMINI_PRELOADED"] = "1"
+        log.info("app_preloaded", "应用已在 master 进程加载", app=args.app,
+                 importMs=round((time.perf_counter() - start) * 1000, 1))
+    else:
+        log.LogPipeline(os.getenv("GEMINI_LOG_LEVEL", "INFO"), os.getenv("GEMINI_LOG_FORMAT", "json"))
+    # worker 共用 master 里已导入的 hypercorn
+    import hypercorn.asyncio  # noqa: F401
+    # 预加载的对象不再参与 GC 扫描，worker 里的 GC 不会写这些对象所在的内存页，写时复制得以保持
+    gc.freeze()
+
+    log.info("master_started", "prefork master 已启动", bind=args.bind, workers=args.workers,
+             preload=args.preload, pid=os.getpid())
+    try:
+        Master(args, sock, app).run()
+    finally:
+        sock.close()
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+        log.shutdown()
+
+
+if __name__ == "__main__":
+    main()
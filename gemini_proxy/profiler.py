@@ -0,0 +1,172 @@
+"""
+按需启用的采样分析器
+启用后对接下来的 N 个请求（或按比例抽样的请求）定时采样事件循环线程的调用栈，
+请求结束时把采样结果写成 folded 格式（flamegraph.pl、speedscope 可直接读取）。
+被分析的请求的任务没有在运行时（在等上游、等线程池），采样记为 <waiting:阶段名>，
+这样火焰图的宽度对应的是墙钟时间而不只是 CPU 时间
+"""
+
+import asyncio
+import os
+import random
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from gemini_proxy import structured_log as log
+
+# 当前任务所属的分析会话；子任务创建时据此登记到同一个会话
+_session = ContextVar("profile_session", default=None)
+
+
+class _Session:
+    def __init__(self, label, timing):
+        self.label = label
+        self.timing = timing
+        self.tasks = weakref.WeakSet()
+        self.samples = Counter()
+        self.started_at = time.time()
+
+
+class SamplingProfiler:
+    """采样分析器；arm() 之前不做任何事，对请求没有额外开销"""
+
+    def __init__(self, directory, interval=0.005, keep=20):
+        self.directory = directory
+        self.interval = interval
+        self.remaining = 0          # 还要分析的请求数
+        self.rate = 0.0             # 按比例抽样
+        self.until = 0.0            # 按比例抽样的截止时间
+        self.written = deque(maxlen=keep)
+        self._sessions = set()
+        self._loop = None
+        self._loop_thread = None
+        self._previous_factory = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def armed(self):
+        return self.remaining > 0 or (self.rate > 0 and time.monotonic() < self.until)
+
+    def arm(self, requests=0, rate=0.0, duration=300.0):
+        """分析接下来的 requests 个请求，或在 duration 秒内按 rate 比例抽样"""
+        self.remaining = max(0, int(requests))
+        self.rate = min(max(float(rate), 0.0), 1.0)
+        self.until = time.monotonic() + duration if self.rate > 0 else 0.0
+        self._install_task_factory(asyncio.get_running_loop())
+
+    def disarm(self):
+        self.remaining = 0
+        self.rate = 0.0
+        self.until = 0.0
+
+    def begin(self, label, timing=None):
+        """请求开始时调用；需要分析时返回会话，否则返回 None"""
+        if not self.armed:
+            return None
+        if self.remaining > 0:
+            self.remaining -= 1
+        elif random.random() >= self.rate:
+            return None
+        session = _Session(label, timing)
+        task = asyncio.current_task()
+        if task is not None:
+            session.tasks.add(task)
+        _session.set(session)
+        with self._lock:
+            self._sessions.add(session)
+        self._ensure_sampler()
+        return session
+
+    async def end(self, session):
+        """请求结束时调用，写出采样结果并返回文件路径"""
+        with self._lock:
+            self._sessions.discard(session)
+        if not session.samples:
+            return None
+        path = await asyncio.to_thread(self._write, session)
+        self.written.append(path)
+        log.info("profile_written", "已写出分析结果", path=path, samples=sum(session.samples.values()))
+        return path
+
+    def status(self):
+        return {
+            "armed": self.armed,
+            "remainingRequests": self.remaining,
+            "rate": self.rate,
+            "secondsLeft": round(max(0.0, self.until - time.monotonic()), 1) if self.rate > 0 else 0,
+            "active": len(self._sessions),
+            "intervalMs": self.interval * 1000,
+            "directory": self.directory,
+            "recent": list(self.written),
+        }
+
+    def _install_task_factory(self, loop):
+        """子任务（批量生成的各格、幂等执行等）登记到创建它的请求的会话"""
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._previous_factory = loop.get_task_factory()
+
+        def factory(loop, coro, **kwargs):
+            if self._previous_factory is not None:
+                task = self._previous_factory(loop, coro, **kwargs)
+            else:
+                task = asyncio.Task(coro, loop=loop, **kwargs)
+            session = _session.get()
+            if session is not None:
+                session.tasks.add(task)
+            return task
+
+        loop.set_task_factory(factory)
+
+    def _ensure_sampler(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self._thread.start()
+
+    def _sample_loop(self):
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+            if not sessions:
+                return
+            frame = sys._current_frames().get(self._loop_thread)
+            task = asyncio.current_task(self._loop)
+            stack = None
+            for session in sessions:
+                if task is not None and task in session.tasks and frame is not None:
+                    if stack is None:
+                        stack = _fold(frame)
+                    session.samples[stack] += 1
+                else:
+                    active = session.timing.active if session.timing is not None else []
+                    session.samples[f"<waiting:{active[-1] if active else 'other'}>"] += 1
+            time.sleep(self.interval)
+
+    def _write(self, session):
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", session.label).strip("-") or "request"
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started_at))
+        path = os.path.join(self.directory, f"{stamp}-{slug}-{id(session) & 0xffff:04x}.folded")
+        root = session.label.replace(";", ":")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in session.samples.most_common():
+                f.write(f"{root};{stack} {count}\n")
+        return path
+
+
+def _fold(frame):
+    """调用栈 -> folded 格式（从外到内，用分号连接）"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
@@ -0,0 +1,32 @@
+"""
+上游请求速率限制
+"""
+
+import asyncio
+import time
+from collections import deque
+
+
+class RequestsPerMinuteLimiter:
+    """滑动窗口限速：任意 60 秒内最多放行 rpm 个请求，rpm <= 0 表示不限速"""
+
+    WINDOW = 60.0
+
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self._sent = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """等待直到可以再发出一个请求"""
+        if self.rpm <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= self.WINDOW:
+                    self._sent.popleft()
+                if len(self._sent) < self.rpm:
+                    self._sent.append(now)
+                    return
+                await asyncio.sleep(self.WINDOW - (now - self._sent[0]))
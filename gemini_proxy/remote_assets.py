@@ -0,0 +1,307 @@
+"""
+上游共享内容复用
+风格参考图通过 Files API 上传一次，之后的请求只带文件 URI；脚本的系统提示词创建为上下文缓存 (cached content)，
+之后的请求只带缓存名。文件和缓存属于 API Key 所在的项目，所以按 Client 分别维护。
+
+句柄在过期前由后台任务续期：文件不能延长有效期，重新上传；上下文缓存延长 TTL。
+一段时间没用过的句柄不再续期，到期后丢弃（上下文缓存按存储时长计费）。
+创建上下文缓存前先统计系统提示词的 token 数，短于模型的最小缓存长度时直接内联发送，不去创建注定失败的缓存。
+上传或创建失败时（网络、权限等）退回内联发送，并在 retry_after 秒内不再尝试
+"""
+
+import asyncio
+import hashlib
+import io
+import time
+
+from gemini_proxy import metrics
+from gemini_proxy import structured_log as log
+from gemini_proxy.resilience import api_error_code
+from gemini_proxy.single_flight import SingleFlight
+from gemini_proxy.style_registry import StyleReference
+
+FILE = "file"
+CONTEXT = "context"
+TOKENS = "tokens"
+
+# Files API 上传的文件保存 48 小时，响应里没有过期时间时按这个估算
+FILE_LIFETIME = 48 * 3600
+
+
+class _Handle:
+    """一个上传的文件或上下文缓存"""
+
+    def __init__(self, client, kind, name, expires_at, source, part=None):
+        self.client = client
+        self.kind = kind
+        self.name = name                # files/... 或 cachedContents/...
+        self.expires_at = expires_at    # time.time() 时间点
+        self.source = source            # 续期时用：文件为 StyleReference，上下文缓存为 (模型, 系统提示词)
+        self.part = part                # 文件：引用 URI 的 Part
+        self.last_used = time.monotonic()
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+
+def _expires_at(value, default_seconds):
+    return value.timestamp() if value is not None else time.time() + default_seconds
+
+
+class RemoteAssets:
+    """按 Client 缓存上传的参考图和系统提示词的上下文缓存"""
+
+    def __init__(self, upload_files=True, cache_context=True, context_ttl=3600, min_context_tokens=4096,
+                 refresh_before=600, min_remaining=300, idle_after=3600, retry_after=600, refresh_interval=60):
+        self.upload_files = upload_files
+        self.cache_context = cache_context
+        self.context_ttl = context_ttl
+        self.min_context_tokens = min_context_tokens    # 上下文缓存的最小 token 数，短于该值的系统提示词不缓存
+        self.refresh_before = refresh_before    # 剩余有效期少于该秒数时后台续期
+        self.min_remaining = min_remaining      # 剩余有效期少于该秒数时请求不再使用（图片生成可能要几分钟）
+        self.idle_after = idle_after            # 超过该秒数没用过的句柄不再续期
+        self.retry_after = retry_after
+        self.refresh_interval = refresh_interval
+        self._handles = {}      # (client, 类型, 内容摘要) -> _Handle
+        self._failed = {}       # (client, 类型, 内容摘要) -> 重新尝试的 time.monotonic() 时间点
+        self._context_tokens = {}   # (模型, 系统提示词摘要) -> token 数；与 Key 无关，统计一次即可
+        self._flight = SingleFlight()
+        self._task = None
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.reused_bytes = 0       # 复用文件而没有内联发送的字节数
+        self.inline_bytes = 0       # 没有可用文件、内联发送的字节数
+        self.contexts_created = 0
+        self.contexts_skipped = 0   # 系统提示词太短、没有创建上下文缓存的请求数
+        self.refreshed = 0
+        self.fallbacks = 0
+        self.invalidated = 0
+
+    async def generate(self, client, model, contents, config=None, stream=False, timings=None):
+        """调用 generate_content(_stream)，共享内容换成句柄；句柄失效时作废并内联重发一次
+
+        timings 为 dict 时写入成功那次调用本身的耗时（"generate"，秒），不含上传参考图、创建上下文缓存
+        """
+        method = client.aio.models.generate_content_stream if stream else client.aio.models.generate_content
+        resolved, resolved_config, handles = await self.prepare(client, model, contents, config)
+        start = time.monotonic()
+        try:
+            response = await method(model=model, contents=resolved, config=resolved_config)
+        except Exception as e:
+            # 文件或缓存被删除、提前过期时上游返回 403 / 404
+            if not handles or api_error_code(e) not in (403, 404):
+                raise
+            self.invalidate(handles)
+            log.warning("remote_asset_invalid", f"上传的内容已失效，改为内联发送: {e}",
+                        handles=[handle.name for handle in handles])
+            start = time.monotonic()
+            response = await method(model=model, contents=self.inline(contents), config=config)
+        if timings is not None:
+            timings["generate"] = time.monotonic() - start
+        return response
+
+    async def prepare(self, client, model, contents, config=None):
+        """返回 (contents, config, 用到的句柄)
+
+        contents 中的 StyleReference 换成文件引用，config.system_instruction 换成上下文缓存；
+        没有可用句柄的仍内联发送
+        """
+        handles = []
+        if isinstance(contents, list):
+            resolved = []
+            for item in contents:
+                if not isinstance(item, StyleReference):
+                    resolved.append(item)
+                    continue
+                handle = await self._file(client, item) if self.upload_files else None
+                if handle is not None:
+                    handles.append(handle)
+                    resolved.append(handle.part)
+                    self.reused_bytes += len(item.data)
+                else:
+                    resolved.append(item.part)
+                    self.inline_bytes += len(item.data)
+            contents = resolved
+        if self.cache_context and config is not None and isinstance(config.system_instruction, str):
+            handle = await self._context(client, model, config.system_instruction)
+            if handle is not None:
+                handles.append(handle)
+                config = config.model_copy(update={"system_instruction": None, "cached_content": handle.name})
+        return contents, config, handles
+
+    def inline(self, contents):
+        """不使用句柄的 contents"""
+        if not isinstance(contents, list):
+            return contents
+        resolved = []
+        for item in contents:
+            if isinstance(item, StyleReference):
+                self.inline_bytes += len(item.data)
+                item = item.part
+            resolved.append(item)
+        return resolved
+
+    def invalidate(self, handles):
+        for handle in handles:
+            for key, current in list(self._handles.items()):
+                if current is handle:
+                    del self._handles[key]
+                    self.invalidated += 1
+
+    def stats(self):
+        return {
+            "files": sum(1 for key in self._handles if key[1] == FILE),
+            "contexts": sum(1 for key in self._handles if key[1] == CONTEXT),
+            "uploads": self.uploads,
+            "uploadedBytes": self.uploaded_bytes,
+            "reusedBytes": self.reused_bytes,
+            "inlineBytes": self.inline_bytes,
+            "contextsCreated": self.contexts_created,
+            "contextsSkipped": self.contexts_skipped,
+            "refreshed": self.refreshed,
+            "fallbacks": self.fallbacks,
+            "invalidated": self.invalidated,
+        }
+
+    def start(self):
+        """启动后台续期"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._refresh_loop())
+
+    async def stop(self):
+        """停止续期，删除创建的上下文缓存（按存储时长计费）；上传的文件到期自动删除"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        contexts = [handle for key, handle in self._handles.items() if key[1] == CONTEXT]
+        self._handles = {key: handle for key, handle in self._handles.items() if key[1] != CONTEXT}
+        await asyncio.gather(*(self._delete(handle) for handle in contexts), return_exceptions=True)
+
+    async def _file(self, client, reference):
+        key = (client, FILE, reference.digest)
+        return await self._acquire(key, lambda: self._upload(client, reference))
+
+    async def _context(self, client, model, system_instruction):
+        digest = hashlib.sha256(f"{model}\n{system_instruction}".encode("utf-8")).hexdigest()
+        if not await self._long_enough(client, model, system_instruction, digest):
+            self.contexts_skipped += 1
+            return None
+        key = (client, CONTEXT, digest)
+        return await self._acquire(key, lambda: self._create_context(client, model, system_instruction))
+
+    async def _long_enough(self, client, model, system_instruction, digest):
+        """系统提示词是否达到上下文缓存的最小长度；统计失败时照常尝试创建"""
+        if self.min_context_tokens <= 0:
+            return True
+        tokens = self._context_tokens.get(digest)
+        if tokens is None:
+            try:
+                tokens, _ = await self._flight.do(
+                    (TOKENS, digest), lambda: self._count_tokens(client, model, system_instruction)
+                )
+            except Exception as e:
+                log.debug("context_tokens_failed", f"统计系统提示词 token 数失败: {e}", model=model)
+                return True
+            if digest not in self._context_tokens and tokens < self.min_context_tokens:
+                log.info("context_cache_skipped", "系统提示词短于上下文缓存的最小长度，改为内联发送",
+                         model=model, tokens=tokens, minTokens=self.min_context_tokens)
+            self._context_tokens[digest] = tokens
+        return tokens >= self.min_context_tokens
+
+    async def _count_tokens(self, client, model, system_instruction):
+        with metrics.stage("asset_upload", model):
+            response = await client.aio.models.count_tokens(model=model, contents=system_instruction)
+        return response.total_tokens
+
+    async def _acquire(self, key, create):
+        handle = self._handles.get(key)
+        if handle is not None and handle.remaining() > self.min_remaining:
+            handle.last_used = time.monotonic()
+            return handle
+        if time.monotonic() < self._failed.get(key, 0.0):
+            return None
+        try:
+            handle, _ = await self._flight.do(key, create)
+        except Exception as e:
+            self.fallbacks += 1
+            self._failed[key] = time.monotonic() + self.retry_after
+            event = "file_upload_failed" if key[1] == FILE else "context_cache_failed"
+            log.warning(event, f"上传共享内容失败，{self.retry_after:.0f} 秒内改为内联发送: {e}",
+                        error=metrics.error_class(e))
+            return None
+        self._handles[key] = handle
+        self._failed.pop(key, None)
+        return handle
+
+    async def _upload(self, client, reference):
+        # 只在已经创建了 Client 之后才会走到这里，google.genai 已导入（见 ensure_genai）
+        from google.genai import types
+        with metrics.stage("asset_upload"):
+            uploaded = await client.aio.files.upload(
+                file=io.BytesIO(reference.data),
+                config=types.UploadFileConfig(
+                    mime_type=reference.mime_type,
+                    display_name=f"style-{reference.style}-{reference.digest[:12]}"
+                )
+            )
+        if uploaded.state == types.FileState.FAILED:
+            raise RuntimeError(f"文件处理失败: {uploaded.error}")
+        self.uploads += 1
+        self.uploaded_bytes += len(reference.data)
+        log.info("file_uploaded", "已上传风格参考图", style=reference.style, file=uploaded.name,
+                 bytes=len(reference.data))
+        return _Handle(
+            client, FILE, uploaded.name, _expires_at(uploaded.expiration_time, FILE_LIFETIME), reference,
+            part=types.Part.from_uri(file_uri=uploaded.uri, mime_type=reference.mime_type)
+        )
+
+    async def _create_context(self, client, model, system_instruction):
+        from google.genai import types
+        with metrics.stage("asset_upload", model):
+            cached = await client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                ttl=f"{int(self.context_ttl)}s",
+                display_name="script-system-prompt"
+            ))
+        self.contexts_created += 1
+        log.info("context_cached", "已创建系统提示词的上下文缓存", model=model, cache=cached.name)
+        return _Handle(client, CONTEXT, cached.name, _expires_at(cached.expire_time, self.context_ttl),
+                       (model, system_instruction))
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for key, handle in list(self._handles.items()):
+                if time.monotonic() - handle.last_used > self.idle_after:
+                    if handle.remaining() <= 0:
+                        self._handles.pop(key, None)
+                    continue
+                if handle.remaining() > self.refresh_before:
+                    continue
+                try:
+                    await self._refresh(key, handle)
+                except Exception as e:
+                    # 下一轮再试；真正过期后请求会同步重新创建
+                    log.warning("remote_asset_refresh_failed", f"续期失败: {e}", handle=handle.name,
+                                error=metrics.error_class(e))
+
+    async def _refresh(self, key, handle):
+        if handle.kind == FILE:
+            # 旧文件可能还被进行中的请求引用，不删除，到期后自动清理
+            fresh, _ = await self._flight.do(key, lambda: self._upload(handle.client, handle.source))
+            fresh.last_used = handle.last_used
+            self._handles[key] = fresh
+        else:
+            from google.genai import types
+            updated = await handle.client.aio.caches.update(
+                name=handle.name, config=types.UpdateCachedContentConfig(ttl=f"{int(self.context_ttl)}s")
+            )
+            handle.expires_at = _expires_at(updated.expire_time, self.context_ttl)
+        self.refreshed += 1
+
+    async def _delete(self, handle):
+        try:
+            await handle.client.aio.caches.delete(name=handle.name)
+        except Exception as e:
+            log.debug("remote_asset_delete_failed", f"删除失败: {e}", handle=handle.name)
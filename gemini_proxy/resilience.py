@@ -0,0 +1,159 @@
+"""
+上游调用的重试与对冲 (hedging)
+可重试的错误按指数退避 + 随机抖动重试；单次调用慢于历史延迟的某个分位数时，
+再并行发起一次相同请求，取先返回的结果。全部尝试都受调用方给出的截止时间约束
+"""
+
+import asyncio
+import random
+import sys
+import time
+from collections import deque
+
+import httpx
+
+from gemini_proxy import structured_log as log
+
+# 上游临时性故障：超时、限流、服务端错误
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class DeadlineExceededError(TimeoutError):
+    """超过请求的截止时间仍未拿到结果"""
+
+
+def api_error_code(error):
+    """error 是 google-genai 的 APIError 时返回状态码，否则返回 None
+
+    不为此导入 google.genai（约 0.8 秒，见 ensure_genai）：它还没被导入时也不可能抛出它的异常
+    """
+    errors = sys.modules.get("google.genai.errors")
+    if errors is not None and isinstance(error, errors.APIError):
+        return error.code
+    return None
+
+
+def is_retryable(error):
+    """判断错误是否值得重试"""
+    code = api_error_code(error)
+    if code is not None:
+        return code in RETRYABLE_CODES
+    return isinstance(error, (httpx.TransportError, ConnectionError, asyncio.TimeoutError))
+
+
+class LatencyTracker:
+    """记录最近若干次成功调用的耗时，用于计算对冲阈值"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, latency):
+        self._samples.append(latency)
+
+    def percentile(self, p):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class RetryPolicy:
+    """重试与对冲策略；attempts 为总尝试次数（含第一次）"""
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=20.0,
+                 hedge_percentile=0.0, hedge_min_samples=20):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+
+    def backoff(self, retry):
+        """第 retry 次重试前的等待秒数（full jitter）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def hedge_delay(self, tracker):
+        """返回发起对冲请求前的等待秒数，未启用或样本不足时返回 None"""
+        if self.hedge_percentile <= 0 or len(tracker) < self.hedge_min_samples:
+            return None
+        return tracker.percentile(self.hedge_percentile)
+
+    async def run(self, attempt, deadline=None, hedge_after=None, label="上游调用"):
+        """执行 attempt()（返回协程的函数），按策略重试/对冲，deadline 为 time.monotonic() 时间点"""
+        retry = 0
+        while True:
+            try:
+                return await self._within_deadline(self._hedged(attempt, hedge_after), deadline)
+            except DeadlineExceededError:
+                self.deadline_exceeded += 1
+                raise
+            except Exception as e:
+                if retry + 1 >= self.attempts or not is_retryable(e):
+                    raise
+                delay = self.backoff(retry)
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    # 等不到下一次尝试就会超时，直接返回原始错误
+                    raise
+                retry += 1
+                self.retries += 1
+                log.warning("upstream_retry", f"{label}失败 ({e})，{delay:.1f}s 后重试", attempt=retry)
+                await asyncio.sleep(delay)
+
+    async def _within_deadline(self, coro, deadline):
+        if deadline is None:
+            return await coro
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            coro.close()
+            raise DeadlineExceededError("已超过请求截止时间")
+        try:
+            return await asyncio.wait_for(coro, remaining)
+        except asyncio.TimeoutError:
+            if time.monotonic() >= deadline:
+                raise DeadlineExceededError(f"请求在 {remaining:.1f}s 内未完成")
+            raise
+
+    async def _hedged(self, attempt, hedge_after):
+        """第一次尝试超过 hedge_after 秒仍未返回时再发起一次，取先成功的结果"""
+        first = asyncio.ensure_future(attempt())
+        tasks = {first}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.hedges += 1
+                    tasks.add(asyncio.ensure_future(attempt()))
+            error = winner = None
+            while tasks and winner is None:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                    else:
+                        error = task.exception()
+            if winner is None:
+                raise error
+            if winner is not first:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "attempts": self.attempts,
+            "hedgePercentile": self.hedge_percentile,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedgeWins": self.hedge_wins,
+            "deadlineExceeded": self.deadline_exceeded,
+        }
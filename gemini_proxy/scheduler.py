@@ -0,0 +1,145 @@
+"""
+上游请求的优先级调度
+等待上游名额的请求分为三类：交互式单格出图 > 交互式脚本 > 批量任务。
+同一类内按用户轮转，一个用户的大批量请求不会挡住其他用户；
+低优先级请求等待超过 starvation_timeout 后提前放行，不会被无限期饿死
+"""
+
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+
+from gemini_proxy.resilience import LatencyTracker
+
+INTERACTIVE = "interactive"   # 单格出图 / 重新生成
+SCRIPT = "script"             # 交互式脚本生成
+BULK = "bulk"                 # 整部漫画批量出图、流水线、后台任务
+PRIORITY_CLASSES = (INTERACTIVE, SCRIPT, BULK)
+
+# 当前请求的 (优先级类别, 用户)；由接口设置，随任务上下文传递到上游调用
+_current_priority = ContextVar("upstream_priority", default=(BULK, None))
+
+
+def set_priority(priority_class, user=None):
+    """设置当前请求（及其后创建的任务）的优先级类别和用户"""
+    _current_priority.set((priority_class, user))
+
+
+def current_priority():
+    return _current_priority.get()
+
+
+class _Waiter:
+    __slots__ = ("future", "priority_class", "user", "enqueued_at")
+
+    def __init__(self, future, priority_class, user):
+        self.future = future
+        self.priority_class = priority_class
+        self.user = user
+        self.enqueued_at = time.monotonic()
+
+
+class _ClassStats:
+    def __init__(self):
+        self.served = 0
+        self.timeouts = 0
+        self.promoted = 0
+        self.waits = LatencyTracker(window=500)
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.served += 1
+        self.waits.add(wait)
+        self.max_wait = max(self.max_wait, wait)
+
+
+class FairQueue:
+    """按优先级类别和用户组织的等待队列"""
+
+    def __init__(self, starvation_timeout=10.0):
+        self.starvation_timeout = starvation_timeout
+        # 类别 -> 用户 -> 等待者；用户按轮转顺序排列
+        self._classes = {c: OrderedDict() for c in PRIORITY_CLASSES}
+        self._stats = {c: _ClassStats() for c in PRIORITY_CLASSES}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, future, priority_class, user):
+        if priority_class not in self._classes:
+            priority_class = BULK
+        waiter = _Waiter(future, priority_class, user)
+        self._classes[priority_class].setdefault(user, deque()).append(waiter)
+        self._size += 1
+        return waiter
+
+    def remove(self, waiter, timed_out=False):
+        """等待者超时或被取消时移出队列"""
+        users = self._classes[waiter.priority_class]
+        queue = users.get(waiter.user)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del users[waiter.user]
+        self._size -= 1
+        if timed_out:
+            self._stats[waiter.priority_class].timeouts += 1
+
+    def record_immediate(self, priority_class):
+        """无需排队直接拿到名额的请求也计入统计"""
+        self._stats.get(priority_class, self._stats[BULK]).record(0.0)
+
+    def pop(self):
+        """取出下一个应放行的等待者，队列为空时返回 None"""
+        priority_class = self._next_class()
+        if priority_class is None:
+            return None
+        users = self._classes[priority_class]
+        # 同一类内按用户轮转：取第一个用户的最早请求，然后把该用户移到末尾
+        user, queue = next(iter(users.items()))
+        waiter = queue.popleft()
+        if queue:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        self._size -= 1
+        self._stats[priority_class].record(time.monotonic() - waiter.enqueued_at)
+        return waiter
+
+    def _next_class(self):
+        now = time.monotonic()
+        first = None
+        for priority_class in PRIORITY_CLASSES:
+            if not self._classes[priority_class]:
+                continue
+            if first is None:
+                first = priority_class
+                continue
+            # 低优先级类别里等待最久的请求超时后优先放行
+            oldest = min(q[0].enqueued_at for q in self._classes[priority_class].values())
+            if now - oldest >= self.starvation_timeout:
+                self._stats[priority_class].promoted += 1
+                return priority_class
+        return first
+
+    def stats(self):
+        now = time.monotonic()
+        result = {}
+        for priority_class in PRIORITY_CLASSES:
+            users = self._classes[priority_class]
+            stats = self._stats[priority_class]
+            heads = [q[0].enqueued_at for q in users.values()]
+            result[priority_class] = {
+                "queued": sum(len(q) for q in users.values()),
+                "users": len(users),
+                "oldestWait": round(now - min(heads), 3) if heads else 0.0,
+                "served": stats.served,
+                "waitP50": round(stats.waits.percentile(50) or 0.0, 3),
+                "waitP95": round(stats.waits.percentile(95) or 0.0, 3),
+                "maxWait": round(stats.max_wait, 3),
+                "timeouts": stats.timeouts,
+                "promoted": stats.promoted,
+            }
+        return result
@@ -0,0 +1,94 @@
+"""
+脚本结果缓存
+内存 LRU + TTL，可选持久化到磁盘 JSON 文件，重启后继续使用
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def script_cache_key(concept, model, prompt_version):
+    """缓存键：(概念, 模型, 提示词版本)"""
+    return "\0".join((concept.strip(), model, prompt_version))
+
+
+class ScriptCache:
+    """已解析脚本的 LRU 缓存，max_entries <= 0 表示禁用"""
+
+    def __init__(self, max_entries, ttl, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (写入时间, 值)，越靠后越新
+        if self.enabled and persist_path:
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        """返回缓存值，过期或不存在时返回 None"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def save(self):
+        """把当前内容写回磁盘（原子替换），未配置持久化时不做任何事"""
+        if not (self.enabled and self.persist_path):
+            return
+        # 在事件循环里取快照，写文件放到线程里
+        payload = [[key, written_at, value] for key, (written_at, value) in self._entries.items()]
+        await asyncio.to_thread(self._write, payload)
+
+    def _write(self, payload):
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.persist_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False)
+        os.replace(tmp_path, self.persist_path)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _load(self):
+        try:
+            with open(self.persist_path, encoding="utf-8") as f:
+                payload = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        now = time.time()
+        for key, written_at, value in payload:
+            if now - written_at <= self.ttl:
+                self._entries[key] = (written_at, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,31 @@
+"""
+并发请求合并 (single-flight)
+同一个键同时只执行一次，其余并发调用等待并共享同一个结果
+"""
+
+import asyncio
+
+
+class SingleFlight:
+    """按键合并并发中的相同调用"""
+
+    def __init__(self):
+        self._in_flight = {}
+
+    def __contains__(self, key):
+        return key in self._in_flight
+
+    async def do(self, key, factory):
+        """执行 factory() 并返回 (结果, 是否复用了他人的调用)
+
+        factory 返回协程；它抛出的异常会同样传给所有等待者。
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            # shield：某个等待者被取消不应取消共享的调用
+            return await asyncio.shield(future), True
+
+        future = asyncio.ensure_future(factory())
+        self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future), False
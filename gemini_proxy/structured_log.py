@@ -0,0 +1,209 @@
+"""
+结构化日志
+日志记录先放进有界队列，由后台线程统一写出，请求处理中不会阻塞在 stdout 上；队列满时丢弃并计数。
+每个请求默认只写一行汇总（方法、路径、状态码、耗时、各阶段耗时和处理过程中附加的字段），
+过程中的 debug 事件按请求抽样写出，同一个请求要么全部写出要么全部不写
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import traceback
+import uuid
+from contextvars import ContextVar
+
+logger = logging.getLogger("gemini_proxy")
+
+# 当前请求的 RequestLog；随任务上下文传递到子任务
+_current = ContextVar("request_log", default=None)
+
+# 当前生效的 LogPipeline
+_pipeline = None
+
+
+class RequestLog:
+    """单个请求的日志上下文"""
+
+    def __init__(self, request_id, sampled):
+        self.request_id = request_id
+        self.sampled = sampled      # 是否写出本请求的 debug 事件
+        self.fields = {}
+
+
+def start_request(request_id=None, debug_sample_rate=0.0):
+    """开始一个请求；request_id 为空时生成新的"""
+    entry = RequestLog(request_id or uuid.uuid4().hex[:16], random.random() < debug_sample_rate)
+    _current.set(entry)
+    return entry
+
+
+def annotate(**fields):
+    """给当前请求的汇总行附加字段；不在请求中时忽略"""
+    entry = _current.get()
+    if entry is not None:
+        entry.fields.update(fields)
+
+
+def log(level, event, message="", exc_info=None, **fields):
+    """写一条事件；fields 作为 JSON 字段输出"""
+    is_debug = level == logging.DEBUG
+    if is_debug:
+        if not _debug_enabled():
+            return
+        # 被抽样的请求在 INFO 级别下也要写出：按当前级别提交，输出时仍标为 debug
+        level = max(level, logger.getEffectiveLevel())
+    elif not logger.isEnabledFor(level):
+        return
+    logger.log(level, message, exc_info=exc_info, extra={"event": event, "fields": fields, "debug": is_debug})
+
+
+def debug(event, message="", **fields):
+    log(logging.DEBUG, event, message, **fields)
+
+
+def info(event, message="", **fields):
+    log(logging.INFO, event, message, **fields)
+
+
+def warning(event, message="", **fields):
+    log(logging.WARNING, event, message, **fields)
+
+
+def error(event, message="", exc_info=None, **fields):
+    log(logging.ERROR, event, message, exc_info=exc_info, **fields)
+
+
+def level_for_status(status):
+    """请求汇总行的级别：5xx 记为 warning，便于按级别过滤"""
+    return logging.WARNING if status >= 500 else logging.INFO
+
+
+def _debug_enabled():
+    if logger.isEnabledFor(logging.DEBUG):
+        return True
+    entry = _current.get()
+    return entry is not None and entry.sampled
+
+
+class JsonFormatter(logging.Formatter):
+    """一条记录一行 JSON"""
+
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": "debug" if getattr(record, "debug", False) else record.levelname.lower(),
+            "event": getattr(record, "event", record.name),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            payload["requestId"] = request_id
+        message = record.getMessage()
+        if message:
+            payload["msg"] = message
+        payload.update(getattr(record, "fields", None) or {})
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地开发用的可读格式"""
+
+    def format(self, record):
+        stamp = time.strftime("%H:%M:%S", time.localtime(record.created))
+        parts = [stamp, record.levelname if not getattr(record, "debug", False) else "DEBUG",
+                 getattr(record, "event", record.name)]
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            parts.append(f"[{request_id}]")
+        message = record.getMessage()
+        if message:
+            parts.append(message)
+        fields = dict(getattr(record, "fields", None) or {})
+        exc = fields.pop("exc", None)
+        if fields:
+            parts.append(" ".join(f"{k}={v}" for k, v in fields.items()))
+        line = " ".join(parts)
+        if exc:
+            line += "\n" + exc
+        return line
+
+
+class _BoundedQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录并计数，不阻塞调用方"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 请求 ID 要在调用方的上下文里取；异常堆栈也在这里格式化成字段，后台线程不持有 traceback
+        entry = _current.get()
+        record.request_id = entry.request_id if entry is not None else None
+        if record.exc_info:
+            exc = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.fields = {**(getattr(record, "fields", None) or {}), "exc": exc}
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def shutdown():
+    """写完队列中剩余的日志；用 os._exit 退出的进程（fork 出的 worker）不会执行 atexit，需要显式调用"""
+    if _pipeline is not None:
+        _pipeline.stop()
+
+
+class LogPipeline:
+    """有界队列 + 后台写出线程"""
+
+    def __init__(self, level="INFO", fmt="json", max_queue=10000, stream=None):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.handler = _BoundedQueueHandler(self.queue)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, output, respect_handler_level=False)
+        logger.handlers = [self.handler]
+        logger.setLevel(level.upper())
+        logger.propagate = False
+        self.listener.start()
+        self._running = True
+        self._paused = False
+        # 预加载后 fork worker 时，先停下写出线程，fork 完成后父子进程各自重新启动
+        os.register_at_fork(before=self._before_fork, after_in_parent=self._after_fork,
+                            after_in_child=self._after_fork)
+        global _pipeline
+        _pipeline = self
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+    def stop(self):
+        """写完队列中剩余的记录"""
+        if self._running:
+            self._running = False
+            self.listener.stop()
+
+    def _before_fork(self):
+        if _pipeline is not self:
+            return
+        self._paused = self._running
+        self.stop()
+
+    def _after_fork(self):
+        if self._paused:
+            self._paused = False
+            self.listener.start()
+            self._running = True
@@ -0,0 +1,131 @@
+"""
+风格参考图注册表
+启动时扫描 STYLE_DIR 下所有 {style}-reference.* 图片，缩放到模型实际需要的尺寸，
+编码一次后缓存为可直接上传的 Part；文件变化时自动重新加载
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import threading
+import time
+
+from PIL import Image
+
+from gemini_proxy import structured_log as log
+
+REFERENCE_SUFFIX = "-reference"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp"}
+
+
+class StyleReference:
+    """一张预处理好的风格参考图"""
+
+    def __init__(self, style, path, data, mime_type, size, source_size, signature):
+        self.style = style
+        self.path = path
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size                # 缩放后的 (宽, 高)
+        self.source_size = source_size  # 原图字节数
+        self.signature = signature      # (mtime_ns, 文件大小)，用于判断文件是否变化
+        self.digest = hashlib.sha256(data).hexdigest()
+        self._part = None
+
+    @property
+    def part(self):
+        """内联发送用的 Part，第一次使用时创建（启动时不导入 google.genai）"""
+        if self._part is None:
+            from google.genai import types
+            self._part = types.Part.from_bytes(data=self.data, mime_type=self.mime_type)
+        return self._part
+
+    def describe(self):
+        return {
+            "file": os.path.basename(self.path),
+            "width": self.size[0],
+            "height": self.size[1],
+            "bytes": len(self.data),
+            "sourceBytes": self.source_size,
+        }
+
+
+def encode_reference(path, max_side, jpeg_quality):
+    """读取并缩放参考图，返回 (编码后字节, MIME 类型, 尺寸)"""
+    with Image.open(path) as img:
+        img.load()
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        img = img.convert("RGBA" if has_alpha else "RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        buf = io.BytesIO()
+        if has_alpha:
+            # 带透明度的保留 PNG，其余统一编码为 JPEG
+            img.save(buf, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            img.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
+            mime_type = "image/jpeg"
+        return buf.getvalue(), mime_type, img.size
+
+
+class StyleRegistry:
+    """风格名 -> StyleReference；最多每 reload_interval 秒检查一次文件变化"""
+
+    def __init__(self, directory, max_side=1024, jpeg_quality=90, reload_interval=5.0):
+        self.directory = directory
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.reload_interval = reload_interval
+        self._styles = {}
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """扫描目录，只重新处理新增或修改过的文件"""
+        with self._lock:
+            found = {}
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                names = []
+            for name in sorted(names):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() not in IMAGE_EXTENSIONS or not stem.endswith(REFERENCE_SUFFIX):
+                    continue
+                style = stem[:-len(REFERENCE_SUFFIX)]
+                if style in found:
+                    log.warning("style_duplicate", "风格有多张参考图，忽略多余的", style=style, ignored=name)
+                    continue
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                signature = (stat.st_mtime_ns, stat.st_size)
+                current = self._styles.get(style)
+                if current and current.path == path and current.signature == signature:
+                    found[style] = current
+                    continue
+                try:
+                    data, mime_type, size = encode_reference(path, self.max_side, self.jpeg_quality)
+                except Exception as e:
+                    log.warning("style_load_failed", f"风格参考图加载失败: {e}", path=path)
+                    continue
+                found[style] = StyleReference(style, path, data, mime_type, size, stat.st_size, signature)
+                log.info("style_loaded", "已加载风格参考图", style=style, file=name, size=f"{size[0]}x{size[1]}",
+                         originalKB=round(stat.st_size / 1024), encodedKB=round(len(data) / 1024))
+            self._styles = found
+            self._last_scan = time.monotonic()
+
+    def get(self, style):
+        """返回风格参考图，不存在时返回 None"""
+        if time.monotonic() - self._last_scan >= self.reload_interval:
+            self.reload()
+        return self._styles.get(style)
+
+    async def aget(self, style):
+        # 需要重新扫描时放到线程里，避免解码图片阻塞事件循环
+        if time.monotonic() - self._last_scan >= self.reload_interval:
+            await asyncio.to_thread(self.reload)
+        return self._styles.get(style)
+
+    def styles(self):
+        return {style: ref.describe() for style, ref in self._styles.items()}
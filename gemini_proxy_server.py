@@ -1,59 +1,394 @@
 """
 Gemini API 代理服务器
 使用 Python Google SDK，自动支持系统代理
+基于 Quart (ASGI) 运行，上游调用走 SDK 的异步客户端 client.aio，
+慢请求不会再占住 worker，单进程即可同时挂起大量上游调用
+生产环境通过 python -m gemini_proxy.prefork 启动（多 worker、预加载、预热）
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import google.genai as genai
+import time
+
+# 模块开始导入的时间；不经 prefork 直接启动时据此计算冷启动耗时
+STARTED_AT = time.time()
+
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
+import asyncio
+import atexit
 import os
+import resource
+import sys
 import base64
-from PIL import Image
-from google.genai import types
+import functools
+import hashlib
+import hmac
+import importlib
 import io
+import json
+import re
 from dotenv import load_dotenv
-from datetime import datetime
 
-def get_current_time():
-    """获取当前时间字符串"""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+from gemini_proxy.adaptive_limit import AdaptiveLimiter, LimiterTimeoutError
+from gemini_proxy.circuit_breaker import CircuitBreaker, CircuitOpenError, UpstreamProbe
+from gemini_proxy.derivatives import (
+    PAGE, THUMB, DerivativeError, DerivativeStore, SourceNotFoundError, negotiate_format
+)
+from gemini_proxy.idempotency import IdempotencyConflictError, IdempotencyStore, StoredResponse
+from gemini_proxy.image_cache import ImageCache, image_cache_key
+from gemini_proxy.image_delivery import (
+    DeliveryError, multipart_parts, negotiate_image_delivery, transcode_image
+)
+from gemini_proxy.job_queue import JobFailedError, JobQueue, JobStore
+from gemini_proxy.json_stream import IncrementalArrayParser
+from gemini_proxy.key_pool import ApiKey, KeyPool, LazyClient, parse_key_spec
+from gemini_proxy import metrics
+from gemini_proxy import structured_log as log
+from gemini_proxy.pipeline import JobRegistry, PipelineJob
+from gemini_proxy.profiler import SamplingProfiler
+from gemini_proxy.remote_assets import RemoteAssets
+from gemini_proxy.resilience import DeadlineExceededError, LatencyTracker, RetryPolicy
+from gemini_proxy.rate_limit import RequestsPerMinuteLimiter
+from gemini_proxy.scheduler import BULK, INTERACTIVE, SCRIPT, set_priority
+from gemini_proxy.script_cache import ScriptCache, script_cache_key
+from gemini_proxy.single_flight import SingleFlight
+from gemini_proxy.style_registry import StyleRegistry
 
 # 加载环境变量
 # 尝试加载多个可能的环境变量文件
 env_loaded = load_dotenv('.env.local') or load_dotenv('.env') or load_dotenv()
 
+# 日志：后台线程写出，默认每个请求一行 JSON 汇总；
+# GEMINI_LOG_FORMAT=text 为本地开发用的可读格式，GEMINI_LOG_DEBUG_SAMPLE 为写出过程细节的请求比例
+LOG_LEVEL = os.getenv('GEMINI_LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('GEMINI_LOG_FORMAT', 'json')
+LOG_DEBUG_SAMPLE = float(os.getenv('GEMINI_LOG_DEBUG_SAMPLE', '0'))
+LOG_QUEUE_SIZE = int(os.getenv('GEMINI_LOG_QUEUE_SIZE', '10000'))
+log_pipeline = log.LogPipeline(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE)
+atexit.register(log_pipeline.stop)
+
 if not env_loaded:
-    print("⚠️  警告: 未找到环境变量文件 (.env.local 或 .env)")
+    log.warning("env_missing", "未找到环境变量文件 (.env.local 或 .env)")
 else:
-    print("✅ 环境变量文件加载成功")
+    log.info("env_loaded", "环境变量文件加载成功")
+
+app = Quart(__name__)
+app = cors(app, allow_origin="*")  # 允许跨域请求
+# 图片生成可能超过 60 秒，不使用 Quart 默认的响应超时
+app.config['RESPONSE_TIMEOUT'] = None
+
+# 同时在途的上游调用上限（超出的请求在本进程内排队等待）
+# 每个模型的实际上限在 [最小值, 最大值] 之间按 AIMD 自动调整：
+# 上游健康时逐步放开，遇到 429 或延迟突增时减半
+MAX_CONCURRENT_UPSTREAM = int(os.getenv('GEMINI_MAX_CONCURRENCY', '64'))
+MIN_CONCURRENT_UPSTREAM = int(os.getenv('GEMINI_MIN_CONCURRENCY', '1'))
+INITIAL_CONCURRENT_UPSTREAM = int(os.getenv('GEMINI_INITIAL_CONCURRENCY', '8'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', '60'))
+LATENCY_SPIKE_RATIO = float(os.getenv('GEMINI_LATENCY_SPIKE_RATIO', '2.0'))
+# 排队时按优先级放行：单格出图 > 脚本 > 批量；低优先级请求排队超过该秒数后提前放行
+STARVATION_TIMEOUT = float(os.getenv('GEMINI_STARVATION_TIMEOUT', '10'))
+upstream_limiters = {}
+upstream_in_flight = 0
+
+
+def get_limiter(model):
+    """获取模型对应的自适应并发限制（不同模型的配额和延迟互不相关）"""
+    limiter = upstream_limiters.get(model)
+    if limiter is None:
+        limiter = upstream_limiters[model] = AdaptiveLimiter(
+            initial=INITIAL_CONCURRENT_UPSTREAM,
+            minimum=MIN_CONCURRENT_UPSTREAM,
+            maximum=MAX_CONCURRENT_UPSTREAM,
+            latency_ratio=LATENCY_SPIKE_RATIO,
+            max_wait=UPSTREAM_QUEUE_TIMEOUT,
+            starvation_timeout=STARVATION_TIMEOUT
+        )
+    return limiter
+
+
+# 临时性上游错误（408/429/5xx、网络错误）按指数退避 + 抖动重试；
+# 配置了对冲分位数时，单次调用慢于该分位数的历史耗时会并行再发一次，取先返回的结果
+REQUEST_DEADLINE = float(os.getenv('GEMINI_REQUEST_DEADLINE', '300'))
+retry_policy = RetryPolicy(
+    attempts=int(os.getenv('GEMINI_RETRY_ATTEMPTS', '3')),
+    base_delay=float(os.getenv('GEMINI_RETRY_BASE_DELAY', '1.0')),
+    max_delay=float(os.getenv('GEMINI_RETRY_MAX_DELAY', '20')),
+    hedge_percentile=float(os.getenv('GEMINI_HEDGE_PERCENTILE', '0')),
+    hedge_min_samples=int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+)
+upstream_latency = {}
+
+
+def request_deadline(data):
+    """根据请求体中的 deadline（秒）计算截止时间点，未提供或无效时使用默认值"""
+    seconds = REQUEST_DEADLINE
+    if data and data.get('deadline') is not None:
+        try:
+            seconds = float(data['deadline'])
+        except (TypeError, ValueError):
+            log.warning("invalid_deadline", f"无效的 deadline，使用默认值 {REQUEST_DEADLINE:g}s",
+                        deadline=str(data['deadline'])[:64])
+    return time.monotonic() + max(0.0, seconds)
+
+
+# 熔断：某个模型连续失败（5xx、网络错误、超时）达到阈值后立即返回 503，
+# 冷却结束后放行探测请求，成功即恢复
+BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv('GEMINI_BREAKER_PROBES', '1'))
+circuit_breakers = {}
+
+
+def get_breaker(model):
+    """获取模型对应的熔断器"""
+    breaker = circuit_breakers.get(model)
+    if breaker is None:
+        breaker = circuit_breakers[model] = CircuitBreaker(
+            model,
+            failure_threshold=BREAKER_THRESHOLD,
+            reset_timeout=BREAKER_RESET_TIMEOUT,
+            half_open_probes=BREAKER_HALF_OPEN_PROBES
+        )
+    return breaker
+
+
+def request_user():
+    """发起请求的用户，用于同一优先级内按用户公平排队：X-User-Id 头，未提供时用客户端地址"""
+    return request.headers.get('X-User-Id') or request.remote_addr
+
+
+def circuit_open_response(error):
+    """熔断时的 503 响应，带 Retry-After"""
+    return jsonify({
+        "success": False,
+        "error": str(error),
+        "retryAfter": error.retry_after
+    }), 503, {"Retry-After": str(error.retry_after)}
+
+
+# 幂等键：客户端超时后带相同的 Idempotency-Key 重试时，共享进行中的调用或直接返回保存的响应
+IDEMPOTENCY_TTL = float(os.getenv('GEMINI_IDEMPOTENCY_TTL', '600'))
+IDEMPOTENCY_MAX_BYTES = int(os.getenv('GEMINI_IDEMPOTENCY_MAX_MB', '256')) * 1024 * 1024
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_BYTES)
+
+
+def idempotent(handler):
+    """为接口加上 Idempotency-Key 支持；键按接口路径区分，同一个键只能用于内容相同的请求"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key or not idempotency_store.enabled:
+            return await handler(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"success": False, "error": "Idempotency-Key 过长（最多 255 个字符）"}), 400
+
+        body = await request.get_data()
+        fingerprint = hashlib.sha256(b"\0".join((
+            request.path.encode('utf-8'),
+            request.headers.get('Accept', '').encode('utf-8'),
+            body
+        ))).hexdigest()
+
+        async def produce():
+            response = await app.make_response(await handler(*args, **kwargs))
+            headers = [(k, v) for k, v in response.headers.items() if k.lower() != 'content-length']
+            return StoredResponse(response.status_code, headers, await response.get_data())
+
+        try:
+            stored, replayed = await idempotency_store.run(f"{request.path}\0{key}", fingerprint, produce)
+        except IdempotencyConflictError as e:
+            return jsonify({"success": False, "error": str(e)}), 422
+
+        response = Response(stored.body, status=stored.status, headers=stored.headers)
+        if replayed:
+            log.annotate(idempotentReplay=True)
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapper
 
-app = Flask(__name__)
-CORS(app)  # 允许跨域请求
 
 # 获取 API Key
+# GEMINI_API_KEYS 可配置多个 Key（逗号分隔，key:模型1|模型2 限定可用模型），未配置时使用 GEMINI_API_KEY
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_API_KEYS = os.getenv('GEMINI_API_KEYS') or GEMINI_API_KEY or ''
+key_specs = parse_key_spec(GEMINI_API_KEYS)
+
+# 离线模拟后端：设置 GEMINI_MOCK（1 或 key=value 配置）后不访问 Gemini，用于压测和回归测试
+GEMINI_MOCK = os.getenv('GEMINI_MOCK', '')
+mock_config = None
+mock_client = None
+if GEMINI_MOCK:
+    # 只在启用时导入（会预先生成模拟图片）
+    from gemini_proxy.mock_genai import MockClient, parse_mock_config
+    mock_config = parse_mock_config(GEMINI_MOCK)
+    mock_client = MockClient(mock_config)
+    if not key_specs:
+        key_specs = [("mock-key-0000", None)]
 
 # 调试信息
-if GEMINI_API_KEY:
-    print(f"✅ GEMINI_API_KEY 已加载 (长度: {len(GEMINI_API_KEY)})")
+if key_specs:
+    log.info("api_keys_loaded", f"已加载 {len(key_specs)} 个 API Key")
 else:
-    print("❌ GEMINI_API_KEY 未设置！")
-    print("   请检查 .env.local 文件中是否包含 GEMINI_API_KEY")
-
-# 初始化 Gemini Client
-client = None
-try:
-    if GEMINI_API_KEY:
-        # 使用 API Key 初始化 Client
-        client = genai.Client(api_key=GEMINI_API_KEY)
-        print("✅ Gemini Client 初始化成功")
-    else:
-        print("❌ 无法初始化 Gemini Client：缺少 API Key")
-except Exception as e:
-    print(f"❌ Gemini Client 初始化失败: {e}")
-    import traceback
-    traceback.print_exc()
-    client = None
+    log.error("api_key_missing", "GEMINI_API_KEY 未设置！请检查 .env.local 文件中是否包含 GEMINI_API_KEY")
+
+# 每个 Key 的限速（每分钟请求数，0 表示不限，只靠 429 后的冷却；突发量）与限流后的冷却时间
+KEY_RPM = float(os.getenv('GEMINI_KEY_RPM', '0'))
+KEY_BURST = int(os.getenv('GEMINI_KEY_BURST', '10'))
+KEY_COOLDOWN = float(os.getenv('GEMINI_KEY_COOLDOWN', '30'))
+
+# 初始化 Gemini Client（每个 Key 一个）；真正的 Client 在第一次调用上游时才创建，见 ensure_genai
+key_pool = KeyPool([], cooldown=KEY_COOLDOWN)
+for api_key, allowed_models in key_specs:
+    key_pool.keys.append(ApiKey(
+        api_key, mock_client or LazyClient(api_key), KEY_RPM, KEY_BURST, allowed_models
+    ))
+
+client = key_pool.keys[0].client if key_pool else None
+if mock_client:
+    log.warning("mock_backend", "使用离线模拟后端，不会访问 Gemini", **mock_config)
+elif client:
+    log.info("client_ready", f"Gemini Client 已配置 ({len(key_pool.keys)} 个，第一次调用上游时创建)")
+else:
+    log.error("client_missing", "无法初始化 Gemini Client：缺少 API Key")
+
+
+# google.genai 的导入约 0.8 秒（主要是 types 中的 pydantic 模型），占了冷启动的大半；
+# 不在启动时导入，第一次调用上游（或后台预热）时在线程中导入，期间事件循环照常处理其他请求
+genai_import = None
+
+
+async def ensure_genai():
+    """确保 google.genai 已导入；并发调用共享同一次导入，失败后下次调用重试"""
+    global genai_import
+    if genai_import is None or (genai_import.done() and genai_import.exception() is not None):
+        genai_import = asyncio.ensure_future(asyncio.to_thread(importlib.import_module, 'google.genai'))
+    if not genai_import.done():
+        # shield：某个请求被取消时不取消其他请求共享的导入
+        await asyncio.shield(genai_import)
+
+
+# 风格参考图通过 Files API 上传一次、脚本系统提示词创建上下文缓存，之后的请求只带句柄；
+# 句柄按 Key 分别维护，过期前后台续期，失败时退回内联发送
+remote_assets = RemoteAssets(
+    upload_files=os.getenv('GEMINI_UPLOAD_REFERENCES', '1') != '0',
+    cache_context=os.getenv('GEMINI_CONTEXT_CACHE', '1') != '0',
+    context_ttl=int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', '3600')),
+    # 上下文缓存的最小 token 数：按模型不同为 1024–4096，默认取最大值，短于该值的系统提示词不去创建缓存
+    min_context_tokens=int(os.getenv('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '4096')),
+    refresh_before=float(os.getenv('GEMINI_ASSET_REFRESH_BEFORE', '600')),
+    idle_after=float(os.getenv('GEMINI_ASSET_IDLE', '3600')),
+    retry_after=float(os.getenv('GEMINI_ASSET_RETRY_AFTER', '600'))
+)
+
+
+async def call_gemini_once(model, contents, config=None):
+    """在熔断器和自适应并发上限内调用一次 Gemini（异步客户端）"""
+    global upstream_in_flight
+    await ensure_genai()
+    breaker = get_breaker(model)
+    limiter = get_limiter(model)
+    try:
+        probe = breaker.before_call()
+        with metrics.stage("queue_wait", model):
+            await limiter.acquire()
+    except Exception as e:
+        metrics.UPSTREAM_ERRORS.labels(model, metrics.error_class(e)).inc()
+        if not isinstance(e, CircuitOpenError):
+            breaker.release(probe)
+        raise
+    except BaseException:
+        # 排队期间截止时间到期或请求被取消：还没有调用上游，不计入熔断
+        breaker.release(probe)
+        raise
+    upstream_in_flight += 1
+    metrics.UPSTREAM_IN_FLIGHT.labels(model).inc()
+    # 延迟样本只取 generate_content 本身：等 Key 的令牌、首次上传参考图不反映上游负载
+    timings = {}
+    try:
+        with metrics.stage("upstream", model):
+            response = await key_pool.run(
+                model, lambda c: remote_assets.generate(c, model, contents, config, timings=timings)
+            )
+    except BaseException as e:
+        if isinstance(e, Exception):
+            metrics.UPSTREAM_ERRORS.labels(model, metrics.error_class(e)).inc()
+        limiter.release(error=e)
+        breaker.record(probe, e)
+        raise
+    finally:
+        upstream_in_flight -= 1
+        metrics.UPSTREAM_IN_FLIGHT.labels(model).dec()
+    latency = timings["generate"]
+    limiter.release(latency=latency)
+    breaker.record(probe)
+    upstream_latency.setdefault(model, LatencyTracker()).add(latency)
+    metrics.record_usage(model, response.usage_metadata)
+    return response
+
+
+async def call_gemini(model, contents, config=None, deadline=None):
+    """调用 Gemini，临时性错误自动重试，慢请求按配置对冲；deadline 为 time.monotonic() 截止时间点"""
+    if deadline is None:
+        deadline = time.monotonic() + REQUEST_DEADLINE
+    limiter = get_limiter(model)
+    hedge_after = None
+    # 已经在排队时不再对冲，避免额外请求加重拥塞
+    if limiter.in_flight < int(limiter.limit):
+        hedge_after = retry_policy.hedge_delay(upstream_latency.setdefault(model, LatencyTracker()))
+    # 截止时间到期不计入熔断：它由调用方给的时间决定，未必说明上游故障
+    return await retry_policy.run(
+        lambda: call_gemini_once(model, contents, config),
+        deadline=deadline,
+        hedge_after=hedge_after,
+        label=f"调用 {model} "
+    )
+
+
+async def stream_gemini(model, contents, config=None):
+    """在熔断器和自适应并发上限内流式调用 Gemini，逐块产出文本"""
+    global upstream_in_flight
+    await ensure_genai()
+    breaker = get_breaker(model)
+    limiter = get_limiter(model)
+    try:
+        probe = breaker.before_call()
+        with metrics.stage("queue_wait", model):
+            await limiter.acquire()
+    except Exception as e:
+        metrics.UPSTREAM_ERRORS.labels(model, metrics.error_class(e)).inc()
+        if not isinstance(e, CircuitOpenError):
+            breaker.release(probe)
+        raise
+    except BaseException:
+        # 排队期间截止时间到期或请求被取消：还没有调用上游，不计入熔断
+        breaker.release(probe)
+        raise
+    upstream_in_flight += 1
+    metrics.UPSTREAM_IN_FLIGHT.labels(model).inc()
+    error = None
+    usage = None
+    try:
+        # 只有建立流之前的失败会换 Key 重试；upstream 阶段只记到建立流为止
+        with metrics.stage("upstream", model):
+            stream = await key_pool.run(
+                model, lambda c: remote_assets.generate(c, model, contents, config, stream=True)
+            )
+        async for chunk in stream:
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                yield chunk.text
+        metrics.record_usage(model, usage)
+    except BaseException as e:
+        error = e
+        if isinstance(e, Exception):
+            metrics.UPSTREAM_ERRORS.labels(model, metrics.error_class(e)).inc()
+        raise
+    finally:
+        upstream_in_flight -= 1
+        metrics.UPSTREAM_IN_FLIGHT.labels(model).dec()
+        # 流的总耗时取决于输出长度，不作为延迟样本，只反馈错误
+        limiter.release(error=error)
+        breaker.record(probe, error)
+
 
 # 脚本生成的系统提示词
 SCRIPT_SYSTEM_PROMPT = """**角色设定：**
@@ -87,247 +422,809 @@ JSON 格式示例：
 """
 
 
+# 脚本的结构约束
+SCRIPT_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "panelNumber": {"type": "INTEGER"},
+            "sceneDescription": {"type": "STRING"},
+            "dialogue": {"type": "STRING"}
+        },
+        "required": ["panelNumber", "sceneDescription", "dialogue"]
+    }
+}
+
+
+def build_script_prompt(concept):
+    """构建用户提示词；系统提示词放在 system_instruction 中，由 remote_assets 换成上下文缓存"""
+    return f"请为以下AI概念创作漫画脚本：{concept}"
+
+
+async def build_script_config():
+    """脚本生成的请求配置"""
+    await ensure_genai()
+    from google.genai import types
+    return types.GenerateContentConfig(
+        system_instruction=SCRIPT_SYSTEM_PROMPT,
+        max_output_tokens=8192,
+        temperature=1.0,
+        top_p=0.95,
+        response_mime_type="application/json",  # <--- 关键：强制返回 JSON
+        response_schema=SCRIPT_SCHEMA           # <--- 关键：约束字段结构
+    )
+
+
+# 提示词版本：系统提示词或结构约束变化后，旧的脚本缓存自动失效
+SCRIPT_PROMPT_VERSION = hashlib.sha256(
+    (SCRIPT_SYSTEM_PROMPT + json.dumps(SCRIPT_SCHEMA, sort_keys=True)).encode('utf-8')
+).hexdigest()[:12]
+
+# 脚本缓存：条数上限（0 表示禁用）、有效期（秒）、可选的持久化文件
+SCRIPT_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_SCRIPT_CACHE_MAX_ENTRIES', '256'))
+SCRIPT_CACHE_TTL = int(os.getenv('GEMINI_SCRIPT_CACHE_TTL', '86400'))
+SCRIPT_CACHE_FILE = os.getenv('GEMINI_SCRIPT_CACHE_FILE') or None
+script_cache = ScriptCache(SCRIPT_CACHE_MAX_ENTRIES, SCRIPT_CACHE_TTL, SCRIPT_CACHE_FILE)
+script_flight = SingleFlight()
+
+
+def is_valid_panel(panel):
+    """按 SCRIPT_SCHEMA 校验单格脚本"""
+    if not isinstance(panel, dict):
+        return False
+    item_schema = SCRIPT_SCHEMA["items"]
+    expected_types = {"INTEGER": int, "STRING": str}
+    for field in item_schema["required"]:
+        value = panel.get(field)
+        expected = expected_types[item_schema["properties"][field]["type"]]
+        # bool 是 int 的子类，需要单独排除
+        if isinstance(value, bool) or not isinstance(value, expected):
+            return False
+    return True
+
+
+def encode_stream_event(event, payload, use_sse):
+    """编码一条流式事件：SSE 或 NDJSON"""
+    line = json.dumps({"event": event, **payload}, ensure_ascii=False)
+    if use_sse:
+        return f"event: {event}\ndata: {line}\n\n"
+    return line + "\n"
+
+
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def stream_response(events, use_sse):
+    """把事件生成器包装成流式响应
+
+    请求上下文在响应头发出前就结束了，在途计数、汇总日志等收尾动作登记在 g.stream_finish 里，
+    等响应体发完或客户端断开时再执行，生成过程中 annotate 的字段和完整耗时才能写进汇总行
+    """
+    mimetype = "text/event-stream" if use_sse else "application/x-ndjson"
+    finish = g.stream_finish = []
+
+    async def body():
+        try:
+            async for chunk in events:
+                yield chunk
+        finally:
+            try:
+                await events.aclose()
+            finally:
+                for callback in finish:
+                    await callback()
+
+    return Response(body(), mimetype=mimetype, headers=STREAM_HEADERS)
+
+
+# ============================================
+# 请求耗时与日志：Prometheus 指标、Server-Timing 响应头、按需采样分析、每请求一行汇总日志
+# ============================================
+
+# 每个响应带上 Server-Timing 头（各阶段耗时，毫秒）
+SERVER_TIMING = os.getenv('GEMINI_SERVER_TIMING', '1') == '1'
+# 采样分析接口的访问令牌；未设置时 /debug/profile 不可用
+PROFILE_TOKEN = os.getenv('GEMINI_PROFILE_TOKEN', '')
+PROFILE_DIR = os.getenv('GEMINI_PROFILE_DIR', os.path.join('.cache', 'profiles'))
+PROFILE_INTERVAL = float(os.getenv('GEMINI_PROFILE_INTERVAL_MS', '5')) / 1000
+
+profiler = SamplingProfiler(PROFILE_DIR, PROFILE_INTERVAL)
+
+# 探针类接口的汇总日志按 debug 处理，避免淹没业务请求
+QUIET_PATHS = ('/health', '/ready', '/metrics')
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+@app.before_request
+async def start_request_metrics():
+    incoming_id = request.headers.get('X-Request-Id', '')
+    g.request_log = log.start_request(
+        incoming_id if REQUEST_ID_PATTERN.match(incoming_id) else None, LOG_DEBUG_SAMPLE
+    )
+    g.metrics_start = time.perf_counter()
+    g.metrics_endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+    g.request_timing = metrics.start_request_timing()
+    if request.path.startswith('/api/'):
+        g.profile_session = profiler.begin(f"{request.method} {request.path}", g.request_timing)
+
+
+@app.after_request
+async def record_request_metrics(response):
+    endpoint = g.metrics_endpoint
+    metrics.REQUEST_SECONDS.labels(endpoint, g.get('metrics_model', ''), str(response.status_code)).observe(
+        time.perf_counter() - g.metrics_start
+    )
+    if request.content_length:
+        metrics.BYTES.labels(endpoint, "in").inc(request.content_length)
+    if response.content_length:
+        metrics.BYTES.labels(endpoint, "out").inc(response.content_length)
+    if SERVER_TIMING:
+        # 流式响应只包含发出响应头之前的阶段
+        response.headers['Server-Timing'] = g.request_timing.header()
+    response.headers['X-Request-Id'] = g.request_log.request_id
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+async def finish_request_metrics(exc):
+    finish = request_finisher(exc)
+    deferred = g.get('stream_finish')
+    if deferred is not None and exc is None:
+        deferred.append(finish)
+    else:
+        await finish()
+
+
+def request_finisher(exc):
+    """取出收尾需要的请求状态，返回可在请求上下文结束后调用的收尾协程"""
+    endpoint = g.get('metrics_endpoint')
+    entry = g.get('request_log')
+    summary = request_summary() if entry is not None else None
+    timing = g.get('request_timing')
+    session = g.get('profile_session')
+
+    async def finish():
+        if endpoint is not None:
+            metrics.REQUESTS_IN_FLIGHT.labels(endpoint).dec()
+        if entry is not None:
+            log_request_summary(summary, timing, entry, exc)
+        if session is not None:
+            await profiler.end(session)
+
+    return finish
+
+
+def request_summary():
+    """汇总行中请求上下文里才能取到的字段"""
+    fields = {"method": request.method, "path": request.path, "status": g.get('response_status', 500)}
+    if g.get('metrics_model'):
+        fields["model"] = g.metrics_model
+    return fields
+
+
+def log_request_summary(summary, timing, entry, exc):
+    """每个请求一行汇总：状态码、耗时、各阶段耗时（毫秒）和处理过程中 annotate 的字段"""
+    fields = {**summary, "durationMs": round((time.perf_counter() - timing.start) * 1000, 1)}
+    if timing.stages:
+        fields["stages"] = {name: round(seconds * 1000, 1) for name, (seconds, _) in timing.stages.items()}
+    fields.update(entry.fields)
+    if exc is not None:
+        log.error("request", f"未处理的异常: {exc}", exc_info=exc, **fields)
+    elif summary["path"] in QUIET_PATHS:
+        log.debug("request", **fields)
+    else:
+        log.log(log.level_for_status(fields["status"]), "request", **fields)
+
+
+def profile_authorized():
+    """校验 Authorization: Bearer <GEMINI_PROFILE_TOKEN>"""
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(supplied.encode(), PROFILE_TOKEN.encode())
+
+
+@app.route('/debug/profile', methods=['GET', 'POST', 'DELETE'])
+async def debug_profile():
+    """启用 / 查看 / 停止采样分析
+
+    POST {"requests": 5} 分析接下来的 5 个请求；
+    POST {"rate": 0.05, "duration": 600} 在 600 秒内抽样 5% 的请求
+    """
+    if not PROFILE_TOKEN:
+        return jsonify({"success": False, "error": "采样分析未启用（未设置 GEMINI_PROFILE_TOKEN）"}), 404
+    if not profile_authorized():
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+
+    if request.method == 'POST':
+        data = await request.get_json(silent=True) or {}
+        try:
+            requests_count = int(data.get('requests', 0))
+            rate = float(data.get('rate', 0))
+            duration = float(data.get('duration', 300))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "requests / rate / duration 必须是数字"}), 400
+        if requests_count <= 0 and rate <= 0:
+            return jsonify({"success": False, "error": "需要提供 requests 或 rate"}), 400
+        profiler.arm(requests_count, rate, duration)
+        log.info("profiler_armed", "采样分析已启用", requests=requests_count, rate=rate, duration=duration)
+    elif request.method == 'DELETE':
+        profiler.disarm()
+        log.info("profiler_disarmed", "采样分析已停止")
+
+    return jsonify({"success": True, "profiler": profiler.status()})
+
+
+def component_metrics():
+    """各组件已有的统计，抓取 /metrics 时读取"""
+    yield from metrics.cache_metrics({
+        "image": image_cache.stats(),
+        "derivative": derivatives.cache.stats(),
+        "script": script_cache.stats(),
+        "idempotency": {"hits": idempotency_store.replayed + idempotency_store.attached},
+    })
+    yield from metrics.limiter_metrics({model: limiter.state() for model, limiter in upstream_limiters.items()})
+    yield from metrics.breaker_metrics({model: breaker.snapshot() for model, breaker in circuit_breakers.items()})
+    yield from metrics.key_metrics(key_pool.states())
+    yield from metrics.counter_metrics("gemini_proxy_retries", "上游重试与对冲次数", {
+        "retry": retry_policy.retries,
+        "hedge": retry_policy.hedges,
+        "hedge_win": retry_policy.hedge_wins,
+        "deadline_exceeded": retry_policy.deadline_exceeded,
+    })
+    yield from metrics.counter_metrics("gemini_proxy_log_records", "日志队列满时丢弃的记录数", {
+        "dropped": log_pipeline.dropped,
+    })
+    assets = remote_assets.stats()
+    yield from metrics.counter_metrics("gemini_proxy_reference_bytes", "风格参考图字节数：上传 / 复用已上传文件 / 内联发送", {
+        "uploaded": assets["uploadedBytes"],
+        "reused": assets["reusedBytes"],
+        "inline": assets["inlineBytes"],
+    })
+    yield from metrics.counter_metrics("gemini_proxy_remote_assets", "共享内容的上传、续期与失败次数", {
+        "upload": assets["uploads"],
+        "context_created": assets["contextsCreated"],
+        "refreshed": assets["refreshed"],
+        "fallback": assets["fallbacks"],
+        "invalidated": assets["invalidated"],
+    })
+    yield from metrics.counter_metrics("gemini_proxy_derivatives", "派生图片的生成与合并次数", {
+        "generated": derivatives.generated,
+        "coalesced": derivatives.coalesced,
+    })
+
+
+metrics.snapshots.add(component_metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Prometheus 指标"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def max_rss_mb():
+    """进程内存峰值 (MB)；ru_maxrss 在 Linux 上单位为 KB，macOS 上为字节"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """健康检查"""
     return jsonify({
         "status": "ok",
         "client_initialized": client is not None,
-        "has_api_key": bool(GEMINI_API_KEY)
+        "has_api_key": bool(key_specs),
+        "mock_backend": mock_config is not None,
+        "max_rss_mb": max_rss_mb(),
+        "api_keys": key_pool.states(),
+        "api_key_waits": key_pool.stats(),
+        "upstream_in_flight": upstream_in_flight,
+        "max_concurrent_upstream": MAX_CONCURRENT_UPSTREAM,
+        "concurrency": {model: limiter.state() for model, limiter in upstream_limiters.items()},
+        "retry": {
+            **retry_policy.stats(),
+            "hedgeAfter": {model: retry_policy.hedge_delay(tracker) for model, tracker in upstream_latency.items()}
+        },
+        "circuit_breakers": {model: breaker.snapshot() for model, breaker in circuit_breakers.items()},
+        "idempotency": idempotency_store.stats(),
+        "jobs": {**job_queue.stats(), "byStatus": await asyncio.to_thread(job_store.counts)},
+        "logging": log_pipeline.stats(),
+        "remote_assets": remote_assets.stats(),
+        "startup": startup,
+        "image_cache": image_cache.stats(),
+        "derivatives": derivatives.stats(),
+        "script_cache": script_cache.stats(),
+        "styles": style_registry.styles()
     })
 
 
+async def probe_upstream():
+    """轻量上游探测：读取模型元数据，验证网络出口、代理和 API Key，不消耗生成额度"""
+    await ensure_genai()
+    await client.aio.models.get(model=READY_PROBE_MODEL or IMAGE_MODEL)
+
+
+# /ready 的上游探测结果缓存 GEMINI_READY_PROBE_TTL 秒，避免负载均衡器的频繁检查打到上游
+READY_PROBE_MODEL = os.getenv('GEMINI_READY_PROBE_MODEL')
+ready_probe = UpstreamProbe(
+    probe_upstream,
+    ttl=float(os.getenv('GEMINI_READY_PROBE_TTL', '30')),
+    timeout=float(os.getenv('GEMINI_READY_PROBE_TIMEOUT', '5'))
+)
+
+
+@app.route('/ready', methods=['GET'])
+async def ready():
+    """就绪检查：熔断器全部未熔断且上游探测成功时返回 200，否则返回 503"""
+    if not client:
+        return jsonify({"ready": False, "reason": "Gemini Client 未初始化"}), 503
+
+    breakers = {model: breaker.snapshot() for model, breaker in circuit_breakers.items()}
+    open_models = [model for model, breaker in circuit_breakers.items() if breaker.rejecting()]
+    probe = await ready_probe.check()
+
+    reasons = []
+    if open_models:
+        reasons.append(f"熔断中: {', '.join(open_models)}")
+    if not probe["ok"]:
+        reasons.append(f"上游探测失败: {probe['error']}")
+    body = {
+        "ready": not reasons,
+        "circuitBreakers": breakers,
+        "probe": probe
+    }
+    if reasons:
+        body["reason"] = "；".join(reasons)
+        return jsonify(body), 503
+    return jsonify(body)
+
+
+class ScriptFormatError(Exception):
+    """模型返回的脚本无法解析"""
+
+    def __init__(self, raw_text):
+        super().__init__("生成的脚本格式错误")
+        self.raw_text = raw_text
+
+
+async def produce_script(concept, model, cache_key, deadline=None):
+    """调用 Gemini 生成并解析脚本，返回 {"panels", "rawText"}，成功后写入缓存"""
+    # 构建完整提示词
+    prompt = build_script_prompt(concept)
+
+    log.debug("script_request_sent", "发送请求到 Gemini API", model=model)
+
+    generate_config = await build_script_config()
+
+    # 调用 Gemini API
+    response = await call_gemini(
+        model=model,
+        contents=prompt,
+        config=generate_config,
+        deadline=deadline
+    )
+
+    # 提取生成的文本
+    generated_text = response.text
+    log.debug("script_response", "收到 Gemini API 响应", chars=len(generated_text))
+
+    # 尝试解析 JSON
+    try:
+        # 提取 JSON 部分（可能包含 markdown 代码块）
+        with metrics.stage("parse", model):
+            json_match = re.search(r'\[[\s\S]*\]', generated_text)
+            if json_match:
+                panels = json.loads(json_match.group(0))
+            else:
+                panels = json.loads(generated_text)
+    except json.JSONDecodeError as e:
+        log.warning("script_parse_failed", f"JSON 解析失败: {e}", chars=len(generated_text))
+        log.debug("script_raw_response", "原始响应前500字符", head=generated_text[:500])
+        raise ScriptFormatError(generated_text)
+
+    # 重新编号
+    for i, panel in enumerate(panels):
+        panel['panelNumber'] = i + 1
+
+    log.debug("script_parsed", "JSON 解析成功", panels=len(panels), regex=bool(json_match))
+
+    result = {"panels": panels, "rawText": generated_text}
+    script_cache.put(cache_key, result)
+    await script_cache.save()
+    return result
+
+
+async def load_script(concept, model, deadline=None, bypass_cache=False):
+    """取脚本：优先读缓存，相同请求并发到达时只调用一次 Gemini
+
+    返回 (结果, 是否来自缓存, 是否合并到了进行中的相同请求)
+    """
+    cache_key = script_cache_key(concept, model, SCRIPT_PROMPT_VERSION)
+    result = None if bypass_cache else script_cache.get(cache_key)
+    if result is not None:
+        return result, True, False
+    result, coalesced = await script_flight.do(
+        cache_key, lambda: produce_script(concept, model, cache_key, deadline)
+    )
+    return result, False, coalesced
+
+
 @app.route('/api/generate-script', methods=['POST'])
-def generate_script():
+@idempotent
+async def generate_script():
     """生成漫画脚本"""
+    set_priority(SCRIPT, request_user())
     if not client:
-        print("❌ [API] Gemini Client 未初始化")
+        log.error("client_missing", "Gemini Client 未初始化")
         return jsonify({
             "success": False,
             "error": "Gemini Client 未初始化"
         }), 500
 
     try:
-        data = request.json
+        data = await request.get_json()
         concept = data.get('concept')
         model = data.get('model', 'gemini-3-pro-preview')
 
         if not concept:
-            print("❌ [API] 缺少 concept 参数")
             return jsonify({
                 "success": False,
                 "error": "请提供 AI 概念"
             }), 400
 
-        print(f"\n{'='*60}")
-        print(f"📝 [API] /api/generate-script 请求")
-        print(f"{'='*60}")
-        print(f"📝 概念: {concept}")
-        print(f"🤖 模型: {model}")
-        print(f"⏰ 时间: {get_current_time()}")
-
-        # 构建完整提示词
-        prompt = f"{SCRIPT_SYSTEM_PROMPT}\n\n请为以下AI概念创作漫画脚本：{concept}"
-
-        print(f"📤 发送请求到 Gemini API...")
-
-        script_schema = {
-            "type": "ARRAY",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "panelNumber": {"type": "INTEGER"},
-                    "sceneDescription": {"type": "STRING"},
-                    "dialogue": {"type": "STRING"}
-                },
-                "required": ["panelNumber", "sceneDescription", "dialogue"]
-            }
-        }
-
-        generate_config = types.GenerateContentConfig(
-            max_output_tokens=8192,
-            temperature=1.0,
-            top_p=0.95,
-            response_mime_type="application/json",  # <--- 关键：强制返回 JSON
-            response_schema=script_schema           # <--- 关键：约束字段结构
+        log.debug("script_concept", "生成脚本", concept=concept[:200])
+        g.metrics_model = model
+        result, cached, coalesced = await load_script(
+            concept, model, request_deadline(data), bool(data.get('bypassCache'))
         )
+        log.annotate(panels=len(result["panels"]), cached=cached, coalesced=coalesced)
 
-        # 调用 Gemini API
-        response = client.models.generate_content(
-            model=model,
-            contents=prompt,
-            config=generate_config
-        )
+        with metrics.stage("serialize", model):
+            return jsonify({
+                "success": True,
+                "panels": result["panels"],
+                "totalPanels": len(result["panels"]),
+                "rawText": result["rawText"],
+                "cached": cached,
+                "coalesced": coalesced
+            })
 
-        print(f"📥 收到 Gemini API 响应")
+    except ScriptFormatError as e:
+        log.annotate(error="script_format")
+        return jsonify({
+            "success": False,
+            "error": str(e),
+            "rawText": e.raw_text
+        }), 500
 
-        # 提取生成的文本
-        generated_text = response.text
-        print(f"✅ 脚本生成成功")
-        print(f"📊 生成文本长度: {len(generated_text)} 字符")
-        print(f"⏰ 完成时间: {get_current_time()}")
+    except CircuitOpenError as e:
+        log.annotate(error="circuit_open")
+        return circuit_open_response(e)
+
+    except LimiterTimeoutError as e:
+        log.annotate(error="queue_timeout")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
+
+    except DeadlineExceededError as e:
+        log.annotate(error="deadline_exceeded")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 504
+
+    except Exception as e:
+        log.error("script_failed", f"脚本生成失败: {e}", exc_info=e)
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
 
-        # 尝试解析 JSON
-        import json
-        try:
-            print(f"🔍 尝试解析 JSON...")
-            # 提取 JSON 部分（可能包含 markdown 代码块）
-            import re
-            json_match = re.search(r'\[[\s\S]*\]', generated_text)
-            if json_match:
-                panels = json.loads(json_match.group(0))
-                print(f"✅ 通过正则提取 JSON")
-            else:
-                panels = json.loads(generated_text)
-                print(f"✅ 直接解析 JSON")
 
+async def stream_script_panels(concept, model, parser):
+    """流式生成脚本，逐格产出已校验、已重新编号的格子
+
+    命中脚本缓存时直接产出缓存内容；生成完成后写入缓存
+    """
+    cache_key = script_cache_key(concept, model, SCRIPT_PROMPT_VERSION)
+    cached = script_cache.get(cache_key)
+    if cached:
+        log.annotate(cached=True)
+        parser.text = cached["rawText"]
+        for panel in cached["panels"]:
+            yield dict(panel)
+        return
+
+    panels = []
+    async for text in stream_gemini(model, build_script_prompt(concept), await build_script_config()):
+        for panel in parser.feed(text):
+            if not is_valid_panel(panel):
+                raise ValueError(f"生成的脚本格式错误: {panel}")
             # 重新编号
-            for i, panel in enumerate(panels):
-                panel['panelNumber'] = i + 1
+            panel['panelNumber'] = len(panels) + 1
+            panels.append(dict(panel))
+            yield panel
 
-            print(f"✅ JSON 解析成功")
-            print(f"📊 解析面板数: {len(panels)} 格")
-            print(f"⏰ 解析完成时间: {get_current_time()}")
-            print(f"{'='*60}\n")
+    if panels:
+        script_cache.put(cache_key, {"panels": panels, "rawText": parser.text})
+        await script_cache.save()
 
-            return jsonify({
-                "success": True,
-                "panels": panels,
-                "totalPanels": len(panels),
-                "rawText": generated_text
-            })
 
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON 解析失败: {e}")
-            print(f"📄 原始响应前500字符: {generated_text[:500]}")
-            print(f"{'='*60}\n")
-            return jsonify({
-                "success": False,
-                "error": "生成的脚本格式错误",
-                "rawText": generated_text
-            }), 500
+@app.route('/api/generate-script/stream', methods=['POST'])
+async def generate_script_stream():
+    """流式生成漫画脚本，每完成一格立即推送 (默认 NDJSON，Accept: text/event-stream 时为 SSE)"""
+    set_priority(SCRIPT, request_user())
+    if not client:
+        return jsonify({"success": False, "error": "Gemini Client 未初始化"}), 500
 
-    except Exception as e:
-        print(f"❌ 脚本生成失败: {e}")
-        print(f"⏰ 错误时间: {get_current_time()}")
-        import traceback
-        traceback.print_exc()
-        print(f"{'='*60}\n")
+    data = await request.get_json()
+    concept = data.get('concept') if data else None
+    model = data.get('model', 'gemini-3-pro-preview') if data else None
+    g.metrics_model = model or ""
+
+    if not concept:
         return jsonify({
             "success": False,
-            "error": str(e)
-        }), 500
+            "error": "请提供 AI 概念"
+        }), 400
+
+    use_sse = 'text/event-stream' in request.headers.get('Accept', '')
+    log.debug("script_concept", "流式生成脚本", concept=concept[:200], sse=use_sse)
+
+    async def event_stream():
+        start = time.monotonic()
+        parser = IncrementalArrayParser()
+        total = 0
+        yield encode_stream_event("start", {"concept": concept, "model": model}, use_sse)
+        try:
+            async for panel in stream_script_panels(concept, model, parser):
+                total += 1
+                if total == 1:
+                    log.annotate(firstPanelMs=round((time.monotonic() - start) * 1000, 1))
+                yield encode_stream_event("panel", panel, use_sse)
+        except Exception as e:
+            log.warning("script_stream_failed", f"流式脚本生成失败: {e}", panels=total)
+            yield encode_stream_event("error", {"error": str(e), "totalPanels": total}, use_sse)
+            return
+
+        if total == 0:
+            yield encode_stream_event("error", {"error": "生成的脚本格式错误", "rawText": parser.text}, use_sse)
+            return
+
+        log.info("script_stream_done", "流式脚本生成完成", panels=total,
+                 elapsedMs=round((time.monotonic() - start) * 1000, 1))
+        yield encode_stream_event("done", {
+            "totalPanels": total,
+            "rawText": parser.text,
+            "elapsed": round(time.monotonic() - start, 3)
+        }, use_sse)
+
+    return stream_response(event_stream(), use_sse)
 
 
 # 确保 style_images 文件夹存在，并且里面有图片
 STYLE_DIR = "public/styles/"
 
+# 风格参考图：启动时全部预处理，之后按需热加载
+STYLE_MAX_SIDE = int(os.getenv('GEMINI_STYLE_MAX_SIDE', '1024'))
+STYLE_RELOAD_INTERVAL = float(os.getenv('GEMINI_STYLE_RELOAD_INTERVAL', '5'))
+# 参考图在 preload()（prefork 的 master 进程）或 worker 预热时加载，导入模块时不做
+style_registry = StyleRegistry(STYLE_DIR, max_side=STYLE_MAX_SIDE, reload_interval=STYLE_RELOAD_INTERVAL)
+
+IMAGE_MODEL = "gemini-3-pro-image-preview" # 或者 "gemini-2.5-flash-image" 如果你有权限
+
+# 批量生成：单个漫画同时生成的格数，以及图片模型每分钟请求数上限（0 表示不限）
+BATCH_CONCURRENCY = int(os.getenv('GEMINI_BATCH_CONCURRENCY', '4'))
+IMAGE_RPM_LIMIT = int(os.getenv('GEMINI_IMAGE_RPM', '0'))
+image_rate_limiter = RequestsPerMinuteLimiter(IMAGE_RPM_LIMIT)
+
+# 生成图片的磁盘缓存（容量为 0 表示禁用）
+IMAGE_CACHE_DIR = os.getenv('GEMINI_IMAGE_CACHE_DIR', '.cache/images')
+IMAGE_CACHE_MAX_MB = int(os.getenv('GEMINI_IMAGE_CACHE_MAX_MB', '1024'))
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_MB * 1024 * 1024)
+
+# 章节图片的派生版本（按宽度分档的缩放图、封面缩略图），首次请求时生成并缓存
+DATA_DIR = os.getenv('GEMINI_DATA_DIR', 'data')
+DERIVATIVE_CACHE_DIR = os.getenv('GEMINI_DERIVATIVE_CACHE_DIR', '.cache/derivatives')
+DERIVATIVE_CACHE_MAX_MB = int(os.getenv('GEMINI_DERIVATIVE_CACHE_MAX_MB', '512'))
+DERIVATIVE_QUALITY = int(os.getenv('GEMINI_DERIVATIVE_QUALITY', '80'))
+derivatives = DerivativeStore(
+    DATA_DIR, ImageCache(DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_MB * 1024 * 1024), quality=DERIVATIVE_QUALITY
+)
+
+
+class ImageGenerationError(Exception):
+    """模型没有返回图片"""
+
+
+def extract_image(response):
+    """从响应中取出图片，返回 (二进制数据, MIME 类型)，没有图片时返回 (None, None)"""
+    # --- 修改开始：使用更稳健的路径获取 parts ---
+    try:
+        # 检查是否有 candidates
+        if response.candidates and len(response.candidates) > 0:
+            # 获取第一个候选内容的 parts
+            # 路径: response -> candidates[0] -> content -> parts
+            parts = response.candidates[0].content.parts
+
+            for part in parts:
+                # 检查是否有 inline_data (二进制图片数据)
+                if part.inline_data:
+                    log.debug("image_received", "收到图片数据", mimeType=part.inline_data.mime_type)
+                    return part.inline_data.data, part.inline_data.mime_type
+
+                # 某些旧版本或特定情况可能返回 image 对象（保留此逻辑以防万一）
+                elif hasattr(part, 'image') and part.image:
+                     log.debug("image_received", "收到图片对象 (PIL)")
+                     buf = io.BytesIO()
+                     part.image.save(buf, format='PNG')
+                     return buf.getvalue(), "image/png"
+        else:
+            log.warning("image_no_candidates", "响应中没有 candidates")
+
+    except AttributeError as e:
+        log.warning("image_response_malformed", f"解析响应结构时出错: {e}")
+        # 完整响应结构只在抽样的 debug 日志中输出
+        log.debug("image_raw_response", "响应结构", response=str(response)[:2000])
+    # --- 修改结束 ---
+    return None, None
+
+
+async def render_panel_image(panel, style_name, bypass_cache=False, deadline=None):
+    """调用 Gemini 为单格生成图片，返回 (图片字节, MIME 类型)
+
+    相同模型、提示词和参考图的结果会命中磁盘缓存；bypass_cache=True 时强制重新生成并覆盖缓存；
+    deadline 为 time.monotonic() 截止时间点，包含重试在内
+    """
+    # 1. 从注册表取预处理好的风格参考图（已缩放、已编码）
+    with metrics.stage("reference_load", IMAGE_MODEL):
+        reference = await style_registry.aget(style_name)
+
+    if reference:
+        log.debug("style_reference", "使用风格参考图", path=reference.path)
+    else:
+        log.debug("style_missing", "未找到风格图，将不使用参考图生成", style=style_name)
+
+    # 2. 构建提示词
+    # 注意：Prompt 需要明确告诉 AI 这是一个"风格参考"
+    prompt_text = (
+        f"Create a manga panel based on this style reference image. "
+        f"Scene: {panel.get('sceneDescription')}. "
+        f"Characters: A cute robot and a grumpy cat. "
+        f"Dialogue context: {panel.get('dialogue')}. "
+        f"Make sure the visual style matches the reference image provided."
+    )
+
+    cache_key = image_cache_key(IMAGE_MODEL, prompt_text, reference.digest if reference else None)
+    if not bypass_cache:
+        cached = await image_cache.aget(cache_key)
+        if cached:
+            log.debug("image_cache_hit", "命中图片缓存", key=cache_key[:12])
+            return cached
+
+    # 3. 构建请求内容
+    # 根据 Google 示例，contents 是一个列表，可以包含文本和图片对象
+    contents = [prompt_text]
+    if reference:
+        # 发送时由 remote_assets 换成已上传文件的引用
+        contents.append(reference)
+
+    log.debug("image_request_sent", "发送图片生成请求", model=IMAGE_MODEL)
+
+    # 4. 调用 API
+    # 注意：你需要确认你的 API Key 有权限访问支持图片输出的模型
+    # 目前如果是标准的 Gemini 2.0 Flash，它主要是多模态输入，文本输出。
+    # 如果你使用的是支持生图的模型（如 Imagen 3 或特定的 gemini-image 模型），请修改 IMAGE_MODEL
+    await image_rate_limiter.acquire()
+    response = await call_gemini(
+        model=IMAGE_MODEL,
+        contents=contents,
+        deadline=deadline
+    )
+
+    # 5. 处理响应 (解析图片)
+    with metrics.stage("parse", IMAGE_MODEL):
+        image_bytes, mime_type = extract_image(response)
+
+    if not image_bytes:
+        # 如果没生成图片，可能是模型拒绝了或者输出了文本拒绝理由
+        text_response = response.text if response.text else "未知错误"
+        log.warning("image_missing", "未收到图片数据，模型返回文本", text=text_response[:500])
+        raise ImageGenerationError(f"生成失败，模型未返回图片。模型回复: {text_response}")
+
+    await image_cache.aput(cache_key, image_bytes, mime_type)
+    return image_bytes, mime_type
+
+
 @app.route('/api/generate-image', methods=['POST'])
-def generate_image():
+@idempotent
+async def generate_image(bypass_cache=False):
     """真实调用 Gemini 生成图片 (带风格参考)"""
+    set_priority(INTERACTIVE, request_user())
+    g.metrics_model = IMAGE_MODEL
     if not client:
         return jsonify({"success": False, "error": "Client未初始化"}), 500
 
     try:
-        data = request.json
+        data = await request.get_json()
         panel = data.get('panel')
         style_name = data.get('style', 'default') # 获取风格名称，例如 "cat"
-        
-        # 1. 自动加载服务器端的风格图片
-        style_image_path = os.path.join(STYLE_DIR, f"{style_name}-reference.png")
-        reference_image = None
-        
-        if os.path.exists(style_image_path):
-            print(f"🎨 加载风格参考图: {style_image_path}")
-            # 打开图片对象
-            reference_image = Image.open(style_image_path)
-        else:
-            print(f"⚠️ 未找到风格图: {style_image_path}，将不使用参考图生成")
-
-        # 2. 构建提示词
-        # 注意：Prompt 需要明确告诉 AI 这是一个"风格参考"
-        prompt_text = (
-            f"Create a manga panel based on this style reference image. "
-            f"Scene: {panel.get('sceneDescription')}. "
-            f"Characters: A cute robot and a grumpy cat. "
-            f"Dialogue context: {panel.get('dialogue')}. "
-            f"Make sure the visual style matches the reference image provided."
-        )
+        bypass_cache = bypass_cache or bool(data.get('bypassCache'))
+        # 返回方式：默认 Base64 JSON；Accept: image/* 返回图片字节；Accept: multipart/mixed 返回元数据 + 图片
+        delivery, target_format, quality = negotiate_image_delivery(request.headers.get('Accept'), data)
 
-        # 3. 构建请求内容
-        # 根据 Google 示例，contents 是一个列表，可以包含文本和图片对象
-        contents = [prompt_text]
-        if reference_image:
-            contents.append(reference_image)
-
-        print(f"📤 发送图片生成请求 (Model: gemini-3-pro-image-preview)...")
-
-        # 4. 调用 API
-        # 注意：你需要确认你的 API Key 有权限访问支持图片输出的模型
-        # 目前如果是标准的 Gemini 2.0 Flash，它主要是多模态输入，文本输出。
-        # 如果你使用的是支持生图的模型（如 Imagen 3 或特定的 gemini-image 模型），请修改 model 参数
-        response = client.models.generate_content(
-            model="gemini-3-pro-image-preview", # 或者 "gemini-2.5-flash-image" 如果你有权限
-            contents=contents
+        image_bytes, mime_type = await render_panel_image(
+            panel, style_name, bypass_cache, request_deadline(data)
         )
+        if target_format:
+            with metrics.stage("encode", IMAGE_MODEL):
+                image_bytes, mime_type = await asyncio.to_thread(
+                    transcode_image, image_bytes, mime_type, target_format, quality
+                )
 
-        # 5. 处理响应 (解析图片)
-        generated_image_b64 = None
-        
-        # --- 修改开始：使用更稳健的路径获取 parts ---
-        try:
-            # 检查是否有 candidates
-            if response.candidates and len(response.candidates) > 0:
-                # 获取第一个候选内容的 parts
-                # 路径: response -> candidates[0] -> content -> parts
-                parts = response.candidates[0].content.parts
-                
-                for part in parts:
-                    # 检查是否有 inline_data (二进制图片数据)
-                    if part.inline_data:
-                        print(f"✅ 收到图片数据 (MimeType: {part.inline_data.mime_type})")
-                        
-                        # 获取二进制数据
-                        image_bytes = part.inline_data.data
-                        
-                        # 转换为 Base64
-                        generated_image_b64 = base64.b64encode(image_bytes).decode('utf-8')
-                        break
-                    
-                    # 某些旧版本或特定情况可能返回 image 对象（保留此逻辑以防万一）
-                    elif hasattr(part, 'image') and part.image:
-                         print("✅ 收到图片对象 (PIL)")
-                         buf = io.BytesIO()
-                         part.image.save(buf, format='PNG')
-                         generated_image_b64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-                         break
-            else:
-                print("⚠️ 响应中没有 candidates")
+        if delivery == "binary":
+            return Response(image_bytes, mimetype=mime_type, headers={
+                "X-Panel-Number": str(panel.get('panelNumber', ''))
+            })
 
-        except AttributeError as e:
-            print(f"⚠️ 解析响应结构时出错: {e}")
-            # 再次打印结构以便调试
-            print(response)
-        # --- 修改结束 ---
+        if delivery == "multipart":
+            content_type, parts = multipart_parts({
+                "success": True,
+                "panelNumber": panel.get('panelNumber'),
+                "mimeType": mime_type,
+                "bytes": len(image_bytes)
+            }, image_bytes, mime_type)
+            return Response(parts, content_type=content_type)
 
-        if generated_image_b64:
+        # 转换为 Base64
+        with metrics.stage("encode", IMAGE_MODEL):
+            generated_image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+        del image_bytes
+        with metrics.stage("serialize", IMAGE_MODEL):
             return jsonify({
                 "success": True,
-                "imageData": generated_image_b64
+                "imageData": generated_image_b64,
+                "mimeType": mime_type
             })
-        else:
-            # 如果没生成图片，可能是模型拒绝了或者输出了文本拒绝理由
-            text_response = response.text if response.text else "未知错误"
-            print(f"❌ 未收到图片数据，模型返回文本: {text_response}")
-            return jsonify({
-                "success": False,
-                "error": f"生成失败，模型未返回图片。模型回复: {text_response}"
-            }), 500
+
+    except DeliveryError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    except ImageGenerationError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+    except CircuitOpenError as e:
+        log.annotate(error="circuit_open")
+        return circuit_open_response(e)
+
+    except LimiterTimeoutError as e:
+        log.annotate(error="queue_timeout")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 503
+
+    except DeadlineExceededError as e:
+        log.annotate(error="deadline_exceeded")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 504
 
     except Exception as e:
-        print(f"❌ 图片生成异常: {e}")
-        import traceback
-        traceback.print_exc()
+        log.error("image_failed", f"图片生成异常: {e}", exc_info=e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -335,10 +1232,562 @@ def generate_image():
 
 
 @app.route('/api/regenerate-image', methods=['POST'])
-def regenerate_image():
+async def regenerate_image():
     """重新生成图片"""
-    # 复用生成图片的逻辑
-    return generate_image()
+    # generate_image 已带幂等键支持，键按请求路径区分，不会与生成接口的同名键混用
+    # 复用生成图片的逻辑，跳过缓存强制重新生成
+    return await generate_image(bypass_cache=True)
+
+
+@app.route('/api/derivatives/<path:image_path>', methods=['GET'])
+async def get_derivative(image_path):
+    """章节图片的缩放图（?w=720）或封面缩略图（?thumb=320）
+
+    格式由 format 参数指定（jpeg / webp / avif），未指定时按 Accept 头选择；路径相对于 GEMINI_DATA_DIR
+    """
+    kind = THUMB if 'thumb' in request.args else PAGE
+    width = request.args.get('thumb' if kind == THUMB else 'w')
+    if width and not width.isdigit():
+        return jsonify({"success": False, "error": "宽度必须是正整数"}), 400
+    fmt = request.args.get('format')
+    try:
+        path, params, key = await derivatives.prepare(
+            image_path, kind, int(width) if width else None,
+            fmt.lower() if fmt else negotiate_format(request.headers.get('Accept'))
+        )
+    except SourceNotFoundError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    except DerivativeError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    headers = {
+        # 缓存键由原图内容哈希和参数决定，可直接作为 ETag
+        "ETag": f'"{key}"',
+        "Cache-Control": "public, max-age=300",
+    }
+    if not fmt:
+        headers["Vary"] = "Accept"
+    if key in request.if_none_match:
+        log.annotate(derivative="not_modified")
+        return Response(status=304, headers=headers)
+
+    data, mime_type, source = await derivatives.fetch(path, params, key)
+    log.annotate(derivative=source, width=params["width"], format=params["format"])
+    headers["X-Derivative-Cache"] = source
+    return Response(data, mimetype=mime_type, headers=headers)
+
+
+async def render_panel_outcome(panel_number, panel, style_name):
+    """生成单格图片，失败不抛出，统一返回结果字典；成功时 image 为原始图片字节，写出前由 encode_panel_result 转成 base64"""
+    start = time.monotonic()
+    try:
+        image_bytes, _ = await render_panel_image(panel, style_name)
+        result = {"panelNumber": panel_number, "success": True, "status": "success", "image": image_bytes}
+    except Exception as e:
+        log.warning("panel_failed", f"第 {panel_number} 格生成失败: {e}", panel=panel_number)
+        result = {"panelNumber": panel_number, "success": False, "status": "failed", "error": str(e)}
+    result["elapsed"] = round(time.monotonic() - start, 3)
+    return result
+
+
+def encode_panel_result(result):
+    """把结果中的原始图片字节换成 base64 的 imageData（原地修改并返回）"""
+    image_bytes = result.pop("image", None)
+    if image_bytes is not None:
+        with metrics.stage("encode", IMAGE_MODEL):
+            result["imageData"] = base64.b64encode(image_bytes).decode('utf-8')
+    return result
+
+
+async def render_panel_result(panel_number, panel, style_name):
+    """生成单格图片，返回带 base64 imageData 的结果字典"""
+    return encode_panel_result(await render_panel_outcome(panel_number, panel, style_name))
+
+
+async def render_comic_panels(panels, style_name, concurrency):
+    """并发生成所有格的图片，按完成先后逐格产出 (序号, 结果)；结果中的图片为原始字节（见 encode_panel_result）
+
+    只保留进行中的任务，产出后即不再引用，已写出的格不会随格数累积在内存中
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def render_one(index, panel):
+        async with semaphore:
+            return index, await render_panel_outcome(panel.get('panelNumber', index + 1), panel, style_name)
+
+    pending = {asyncio.ensure_future(render_one(i, p)) for i, p in enumerate(panels)}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            while done:
+                yield done.pop().result()
+    finally:
+        # 客户端断开时取消尚未完成的格，避免继续消耗配额
+        for task in pending:
+            task.cancel()
+
+
+def parse_comic_request(data):
+    """校验批量生成请求，返回 (panels, style, concurrency, 错误信息)"""
+    panels = data.get('panels') if isinstance(data, dict) else None
+    if not panels or not isinstance(panels, list):
+        return None, None, None, "请提供 panels 数组"
+    # 每格都要是对象，否则会在并发生成途中才出错，拖垮整批
+    invalid = [index + 1 for index, panel in enumerate(panels) if not isinstance(panel, dict)]
+    if invalid:
+        return None, None, None, f"panels 中的每一项都必须是对象（第 {', '.join(map(str, invalid[:10]))} 项不是）"
+    try:
+        concurrency = int(data.get('concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return None, None, None, "concurrency 必须是整数"
+    concurrency = max(1, min(concurrency, MAX_CONCURRENT_UPSTREAM))
+    return panels, data.get('style', 'default'), concurrency, None
+
+
+@app.route('/api/generate-comic', methods=['POST'])
+async def generate_comic():
+    """批量并发生成整部漫画的所有图片"""
+    set_priority(BULK, request_user())
+    g.metrics_model = IMAGE_MODEL
+    if not client:
+        return jsonify({"success": False, "error": "Client未初始化"}), 500
+
+    panels, style_name, concurrency, error = parse_comic_request(await request.get_json())
+    if error:
+        return jsonify({
+            "success": False,
+            "error": error
+        }), 400
+
+    batch_start = time.monotonic()
+    results = [None] * len(panels)
+    async for index, result in render_comic_panels(panels, style_name, concurrency):
+        results[index] = encode_panel_result(result)
+    succeeded = sum(1 for r in results if r["success"])
+    elapsed = round(time.monotonic() - batch_start, 3)
+
+    log.annotate(panels=len(results), succeeded=succeeded, concurrency=concurrency)
+
+    return jsonify({
+        "success": succeeded > 0,
+        "results": results,
+        "totalPanels": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "elapsed": elapsed
+    })
+
+
+@app.route('/api/generate-comic/stream', methods=['POST'])
+async def generate_comic_stream():
+    """批量生成，每完成一格立即推送 (默认 NDJSON，Accept: text/event-stream 时为 SSE)"""
+    set_priority(BULK, request_user())
+    g.metrics_model = IMAGE_MODEL
+    if not client:
+        return jsonify({"success": False, "error": "Client未初始化"}), 500
+
+    panels, style_name, concurrency, error = parse_comic_request(await request.get_json())
+    if error:
+        return jsonify({
+            "success": False,
+            "error": error
+        }), 400
+
+    use_sse = 'text/event-stream' in request.headers.get('Accept', '')
+
+    def encode_event(event, payload):
+        return encode_stream_event(event, payload, use_sse)
+
+    log.debug("comic_stream", "批量生成（流式）", panels=len(panels), concurrency=concurrency, sse=use_sse)
+
+    async def event_stream():
+        batch_start = time.monotonic()
+        succeeded = 0
+        yield encode_event("start", {"totalPanels": len(panels)})
+        async for _, result in render_comic_panels(panels, style_name, concurrency):
+            succeeded += result["success"]
+            # 在写出前才转成 base64，写出后立即释放：常驻内存只有进行中的格的原始图片
+            chunk = encode_event("panel", encode_panel_result(result))
+            del result
+            yield chunk
+            del chunk
+        yield encode_event("done", {
+            "totalPanels": len(panels),
+            "succeeded": succeeded,
+            "failed": len(panels) - succeeded,
+            "elapsed": round(time.monotonic() - batch_start, 3)
+        })
+
+    return stream_response(event_stream(), use_sse)
+
+
+# 流水线任务：已结束的任务在内存中保留的秒数
+PIPELINE_JOB_TTL = int(os.getenv('GEMINI_PIPELINE_JOB_TTL', '3600'))
+pipeline_jobs = JobRegistry(PIPELINE_JOB_TTL)
+
+
+async def run_pipeline(job, concurrency):
+    """流式生成脚本，每完成一格立即交给出图 worker，两个阶段重叠进行"""
+    semaphore = asyncio.Semaphore(concurrency)
+    render_tasks = []
+
+    async def render(entry):
+        async with semaphore:
+            entry["status"] = "rendering"
+            result = await render_panel_result(entry["panelNumber"], entry, job.style)
+            job.set_image_result(entry, result)
+
+    parser = IncrementalArrayParser()
+    try:
+        async for panel in stream_script_panels(job.concept, job.model, parser):
+            entry = job.add_panel(panel)
+            render_tasks.append(asyncio.ensure_future(render(entry)))
+        if not job.panels:
+            raise ValueError("生成的脚本格式错误")
+        job.finish_script(parser.text)
+        await asyncio.gather(*render_tasks)
+        job.finish()
+        progress = job.progress()
+        log.info("pipeline_done", "流水线任务完成", jobId=job.id, succeeded=progress['succeeded'],
+                 panels=progress['totalPanels'], elapsed=progress['elapsed'])
+    except Exception as e:
+        for task in render_tasks:
+            task.cancel()
+        log.warning("pipeline_failed", f"流水线任务失败: {e}", jobId=job.id)
+        job.fail(str(e))
+
+
+@app.route('/api/pipeline', methods=['POST'])
+async def create_pipeline():
+    """创建“脚本 + 图片”流水线任务，立即返回任务 ID"""
+    set_priority(BULK, request_user())
+    g.metrics_model = IMAGE_MODEL
+    if not client:
+        return jsonify({"success": False, "error": "Client未初始化"}), 500
+
+    data = await request.get_json() or {}
+    concept = data.get('concept')
+    if not concept:
+        return jsonify({
+            "success": False,
+            "error": "请提供 AI 概念"
+        }), 400
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), MAX_CONCURRENT_UPSTREAM))
+    except (TypeError, ValueError):
+        return jsonify({
+            "success": False,
+            "error": "concurrency 必须是整数"
+        }), 400
+
+    job = pipeline_jobs.add(PipelineJob(
+        concept=concept,
+        style=data.get('style', 'default'),
+        model=data.get('model', 'gemini-3-pro-preview')
+    ))
+    job.task = asyncio.ensure_future(run_pipeline(job, concurrency))
+    log.annotate(jobId=job.id, concurrency=concurrency)
+
+    return jsonify({
+        "success": True,
+        "jobId": job.id,
+        "status": job.status
+    }), 202
+
+
+@app.route('/api/pipeline/<job_id>', methods=['GET'])
+async def get_pipeline(job_id):
+    """轮询流水线任务进度，?images=1 时附带已生成的图片"""
+    job = pipeline_jobs.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+
+    include_images = request.args.get('images') == '1'
+    return jsonify({"success": True, **job.snapshot(include_images)})
+
+
+@app.route('/api/pipeline/<job_id>/events', methods=['GET'])
+async def subscribe_pipeline(job_id):
+    """订阅流水线任务进度 (默认 NDJSON，Accept: text/event-stream 时为 SSE)，?images=1 时推送图片数据"""
+    job = pipeline_jobs.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+
+    use_sse = 'text/event-stream' in request.headers.get('Accept', '')
+    include_images = request.args.get('images') == '1'
+
+    async def event_stream():
+        queue = job.subscribe()
+        try:
+            # 先发送当前快照，之后只推送增量
+            yield encode_stream_event("snapshot", job.snapshot(include_images), use_sse)
+            if job.done:
+                return
+            while True:
+                event, payload = await queue.get()
+                if event == "image" and not include_images:
+                    payload = {k: v for k, v in payload.items() if k != "imageData"}
+                yield encode_stream_event(event, payload, use_sse)
+                if event in ("done", "error"):
+                    return
+        finally:
+            job.unsubscribe(queue)
+
+    return stream_response(event_stream(), use_sse)
+
+
+# 持久化任务：任务与每格结果保存在 SQLite，进程重启后只补生成缺失的格子
+JOB_DB_PATH = os.getenv('GEMINI_JOB_DB', os.path.join('.cache', 'jobs.sqlite3'))
+JOB_WORKERS = int(os.getenv('GEMINI_JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS = int(os.getenv('GEMINI_JOB_MAX_ATTEMPTS', '3'))
+JOB_TTL = int(os.getenv('GEMINI_JOB_TTL', str(7 * 86400)))
+
+
+async def run_comic_job(job_id):
+    """执行一个持久化任务：脚本和每一格图片生成后立即写入检查点
+
+    部分格失败时任务仍算完成（可单独重新生成失败的格）；所有格都失败时任务失败
+    """
+    # 后台任务按批量优先级执行，每个任务单独轮转，多个任务之间公平分配名额
+    set_priority(BULK, f"job:{job_id}")
+    job = await job_queue.get(job_id)
+    panels = job["script"]
+    if panels is None:
+        log.info("job_script", "任务生成脚本", jobId=job_id)
+        result, _, _ = await load_script(job["concept"], job["model"])
+        panels = result["panels"]
+        await asyncio.to_thread(job_store.save_script, job_id, panels, result["rawText"])
+
+    done = {number for number, r in job["results"].items() if r["status"] == "success"}
+    missing = [panel for panel in panels if panel["panelNumber"] not in done]
+    if done:
+        log.info("job_resumed", "任务从检查点恢复", jobId=job_id, done=len(done), remaining=len(missing))
+    semaphore = asyncio.Semaphore(job["concurrency"])
+
+    async def render(panel):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                image_bytes, mime_type = await render_panel_image(panel, job["style"])
+            except Exception as e:
+                log.warning("job_panel_failed", f"任务第 {panel['panelNumber']} 格生成失败: {e}",
+                            jobId=job_id, panel=panel['panelNumber'])
+                await asyncio.to_thread(
+                    job_store.save_panel, job_id, panel["panelNumber"], "failed",
+                    error=str(e), elapsed=round(time.monotonic() - start, 3)
+                )
+                return
+            await asyncio.to_thread(
+                job_store.save_panel, job_id, panel["panelNumber"], "success",
+                image=image_bytes, mime_type=mime_type, elapsed=round(time.monotonic() - start, 3)
+            )
+            done.add(panel["panelNumber"])
+
+    tasks = [asyncio.ensure_future(render(panel)) for panel in missing]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if panels and not done:
+        raise JobFailedError(f"全部 {len(panels)} 格图片生成失败")
+    log.info("job_done", "任务完成", jobId=job_id, panels=len(panels), succeeded=len(done))
+
+
+def describe_job(job, include_images=False):
+    """任务状态：脚本中的每一格附上出图结果"""
+    panels = []
+    for panel in job["script"] or []:
+        result = job["results"].get(panel["panelNumber"])
+        entry = {**panel, "status": result["status"] if result else "pending"}
+        if result:
+            entry.update({"error": result["error"], "elapsed": result["elapsed"], "mimeType": result["mime_type"]})
+            if include_images and result.get("image") is not None:
+                entry["imageData"] = base64.b64encode(result["image"]).decode('utf-8')
+        panels.append(entry)
+    succeeded = sum(1 for p in panels if p["status"] == "success")
+    failed = sum(1 for p in panels if p["status"] == "failed")
+    end = job["finished_at"] or time.time()
+    return {
+        "jobId": job["id"],
+        "status": job["status"],
+        "concept": job["concept"],
+        "style": job["style"],
+        "model": job["model"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+        "scriptDone": job["script"] is not None,
+        "totalPanels": len(panels),
+        "succeeded": succeeded,
+        "failed": failed,
+        "pending": len(panels) - succeeded - failed,
+        "createdAt": job["created_at"],
+        "elapsed": round(end - job["created_at"], 3),
+        "panels": panels,
+    }
+
+
+job_store = JobStore(JOB_DB_PATH)
+# 多 worker 时只有 0 号 worker 执行任务，其他 worker 提交的任务由它定期从数据库领取
+JOB_POLL_INTERVAL = float(os.getenv('GEMINI_JOB_POLL_INTERVAL', '2'))
+job_queue = JobQueue(
+    job_store, run_comic_job, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS, ttl=JOB_TTL,
+    poll_interval=JOB_POLL_INTERVAL if int(os.getenv('GEMINI_WORKERS', '1')) > 1 else 0
+)
+
+
+# 启动预热：hypercorn 在 before_serving 完成后才开始 accept，
+# 预热期间到达的连接留在监听队列里，不会被拒绝，也不会打到还没准备好的 worker。
+# 导入 google.genai 和上游探测较慢（约 1 秒），在开始 accept 之后于后台进行，不推迟第一个响应；
+# 这期间到达的上游请求等待同一次导入（ensure_genai），自己建立连接
+WARMUP = os.getenv('GEMINI_WARMUP', '1') != '0'
+WARMUP_TIMEOUT = float(os.getenv('GEMINI_WARMUP_TIMEOUT', '5'))
+startup = {}
+upstream_warmup = None
+
+
+def preload():
+    """prefork 的 master 进程在 fork 前调用：加载只读状态，worker 通过写时复制共享"""
+    style_registry.reload()
+
+
+async def warm_up():
+    """加载风格参考图（accept 之前完成）"""
+    start = time.perf_counter()
+    await asyncio.to_thread(style_registry.reload)
+    return {"stylesMs": round((time.perf_counter() - start) * 1000, 1)}
+
+
+async def warm_up_upstream():
+    """在后台导入 google.genai，并用每个 Key 的 Client 做一次上游探测，提前建立连接（DNS、代理、TLS）"""
+    start = time.perf_counter()
+    await ensure_genai()
+    timings = {"genaiImportMs": round((time.perf_counter() - start) * 1000, 1)}
+
+    async def probe(api_key):
+        try:
+            await asyncio.wait_for(
+                api_key.client.aio.models.get(model=READY_PROBE_MODEL or IMAGE_MODEL), WARMUP_TIMEOUT
+            )
+            return True
+        except Exception as e:
+            log.warning("warmup_probe_failed", f"预热时上游探测失败: {e}", key=api_key.label,
+                        error=metrics.error_class(e))
+            return False
+
+    if key_pool.keys:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(probe(api_key) for api_key in key_pool.keys))
+        timings["upstreamMs"] = round((time.perf_counter() - start) * 1000, 1)
+        timings["upstreamOk"] = sum(results)
+    startup.update(timings)
+    log.info("upstream_warm", "上游预热完成", **timings)
+
+
+@app.before_serving
+async def start_worker():
+    global upstream_warmup
+    began = time.perf_counter()
+    # prefork 在 fork 后设置；导入模块时还在 master 进程里，所以在这里读取
+    worker = os.getenv('GEMINI_WORKER_INDEX', '0')
+    started_at = float(os.getenv('GEMINI_WORKER_STARTED_AT') or STARTED_AT)
+    timings = await warm_up() if WARMUP else {}
+    if worker == '0':
+        await job_queue.start()
+    remote_assets.start()
+    startup.update({
+        "worker": int(worker),
+        "pid": os.getpid(),
+        "preloaded": os.getenv('GEMINI_PRELOADED') == '1',
+        "warmupMs": round((time.perf_counter() - began) * 1000, 1),
+        "coldStartMs": round((time.time() - started_at) * 1000, 1),
+        # 从 prefork 进程启动算起（包括导入），即重启后多久能处理第一个请求
+        **({"sinceBootMs": round((time.time() - float(os.environ['GEMINI_BOOTED_AT'])) * 1000, 1)}
+           if os.getenv('GEMINI_BOOTED_AT') else {}),
+        **timings,
+    })
+    log.info("worker_ready", "worker 预热完成，开始接受请求", **startup)
+    if WARMUP:
+        upstream_warmup = asyncio.ensure_future(warm_up_upstream())
+
+
+@app.after_serving
+async def stop_worker():
+    if upstream_warmup is not None:
+        upstream_warmup.cancel()
+    await job_queue.stop()
+    await remote_assets.stop()
+
+
+@app.route('/api/jobs', methods=['POST'])
+async def submit_job():
+    """提交持久化的整部漫画生成任务（脚本 + 全部图片），立即返回任务 ID"""
+    if not client:
+        return jsonify({"success": False, "error": "Client未初始化"}), 500
+
+    data = await request.get_json() or {}
+    concept = data.get('concept')
+    if not concept:
+        return jsonify({
+            "success": False,
+            "error": "请提供 AI 概念"
+        }), 400
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), MAX_CONCURRENT_UPSTREAM))
+    except (TypeError, ValueError):
+        return jsonify({
+            "success": False,
+            "error": "concurrency 必须是整数"
+        }), 400
+
+    job_id = await job_queue.submit(
+        concept=concept,
+        style=data.get('style', 'default'),
+        model=data.get('model', 'gemini-3-pro-preview'),
+        concurrency=concurrency
+    )
+    log.annotate(jobId=job_id, concurrency=concurrency)
+    return jsonify({
+        "success": True,
+        "jobId": job_id,
+        "status": "queued"
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    """查询任务状态与每一格的进度（不含图片）"""
+    job = await job_queue.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+    return jsonify({"success": True, **describe_job(job)})
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+async def get_job_result(job_id):
+    """获取任务结果（含图片）；任务未结束时返回 202 和当前进度"""
+    job = await job_queue.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+    if job["status"] in ("queued", "running"):
+        return jsonify({"success": True, **describe_job(job)}), 202
+    job = await job_queue.get(job_id, include_images=True)
+    return jsonify({"success": True, **describe_job(job, include_images=True)})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+async def cancel_job(job_id):
+    """取消排队中或运行中的任务，已生成的格子保留"""
+    job = await job_queue.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "任务不存在"}), 404
+    if not await job_queue.cancel(job_id):
+        return jsonify({
+            "success": False,
+            "error": f"任务已结束 ({job['status']})，无法取消"
+        }), 409
+    log.annotate(jobId=job_id)
+    return jsonify({"success": True, "jobId": job_id, "status": "cancelled"})
 
 
 if __name__ == '__main__':
@@ -349,12 +1798,34 @@ if __name__ == '__main__':
     print(f"✅ 服务器地址: http://127.0.0.1:{port}")
     print(f"✅ 使用 Python Google SDK")
     print(f"✅ 自动支持系统代理")
+    print(f"✅ ASGI 异步模式 (上游并发自适应: 初始 {INITIAL_CONCURRENT_UPSTREAM}，"
+          f"范围 {MIN_CONCURRENT_UPSTREAM}-{MAX_CONCURRENT_UPSTREAM})")
     print(f"{'='*60}")
     print(f"\n📡 可用端点:")
     print(f"  GET  /health - 健康检查")
+    print(f"  GET  /ready - 就绪检查（熔断状态 + 上游探测）")
+    print(f"  GET  /metrics - Prometheus 指标")
+    if PROFILE_TOKEN:
+        print(f"  POST /debug/profile - 按需采样分析（需令牌）")
     print(f"  POST /api/generate-script - 生成脚本")
+    print(f"  POST /api/generate-script/stream - 生成脚本，逐格流式返回")
     print(f"  POST /api/generate-image - 生成图片")
     print(f"  POST /api/regenerate-image - 重新生成图片")
+    print(f"  POST /api/generate-comic - 批量生成整部漫画图片")
+    print(f"  POST /api/generate-comic/stream - 批量生成，逐格流式返回")
+    print(f"  POST /api/pipeline - 创建脚本+图片流水线任务")
+    print(f"  GET  /api/pipeline/<jobId> - 查询流水线任务进度")
+    print(f"  GET  /api/pipeline/<jobId>/events - 订阅流水线任务进度")
+    print(f"  POST /api/jobs - 提交持久化任务（脚本 + 全部图片）")
+    print(f"  GET  /api/jobs/<jobId> - 查询任务状态")
+    print(f"  GET  /api/jobs/<jobId>/result - 获取任务结果")
+    print(f"  POST /api/jobs/<jobId>/cancel - 取消任务")
     print(f"\n🎯 启动服务器...\n")
 
-    app.run(host='127.0.0.1', port=port, debug=False)
+    # 生产环境使用: python -m gemini_proxy.prefork（多 worker、预加载）
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    asyncio.run(serve(app, config))
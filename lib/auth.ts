@@ -1,5 +1,6 @@
 import { cookies } from 'next/headers';
 import { getSessionUserId as getSessionUserIdFromStorage } from '@/lib/storage';
+import { getClientIp } from '@/lib/security/logger';
 import type { NextRequest } from 'next/server';
 
 /**
@@ -23,3 +24,16 @@ export async function getSessionUserId(request: NextRequest): Promise<string | n
   }
 }
 
+/**
+ * 转发给 Python 代理服务器的用户标识（X-User-Id），代理服务器按它在同一优先级内公平排队
+ * 已登录用户用用户ID，未登录时用客户端IP；都取不到时返回 undefined
+ */
+export async function getProxyUserId(request: NextRequest): Promise<string | undefined> {
+  const userId = await getSessionUserId(request);
+  if (userId) {
+    return `user:${userId}`;
+  }
+
+  const ip = getClientIp(request);
+  return ip !== 'unknown' ? `ip:${ip}` : undefined;
+}
@@ -3,16 +3,44 @@
  * 通过 Python 代理服务器调用 Gemini API
  */
 
+import { createHash } from 'crypto';
+
 const PROXY_SERVER_URL = process.env.GEMINI_PROXY_SERVER || 'http://127.0.0.1:3001';
 const REQUEST_TIMEOUT = parseInt(process.env.GEMINI_REQUEST_TIMEOUT || '120000'); // 120秒
 
+/**
+ * 由请求内容计算幂等键：超时后重试相同的请求时，代理服务器会复用进行中或已完成的结果
+ */
+function contentIdempotencyKey(endpoint: string, data: any): string {
+  return createHash('sha256').update(`${endpoint}\0${JSON.stringify(data)}`).digest('hex');
+}
+
+/**
+ * 发往代理服务器的请求头
+ * 传入 userId 时附带 X-User-Id 头：所有请求都从 Next.js 服务端发出，
+ * 不带这个头时代理服务器只能看到同一个地址，无法按用户公平排队
+ */
+function proxyHeaders(userId?: string, extra: Record<string, string> = {}): Record<string, string> {
+  const headers: Record<string, string> = {
+    'Content-Type': 'application/json',
+    ...extra,
+  };
+  if (userId) {
+    headers['X-User-Id'] = userId;
+  }
+  return headers;
+}
+
 /**
  * 通用请求处理函数
+ * 传入 idempotencyKey 时附带 Idempotency-Key 头，重复请求不会再次调用 Gemini
  */
 async function proxyRequest(
   endpoint: string,
   data: any,
-  timeout: number = REQUEST_TIMEOUT
+  timeout: number = REQUEST_TIMEOUT,
+  idempotencyKey?: string,
+  userId?: string
 ): Promise<any> {
   const controller = new AbortController();
   const timeoutId = setTimeout(() => controller.abort(), timeout);
@@ -29,11 +57,14 @@ async function proxyRequest(
 
     const startTime = Date.now();
 
+    const headers = proxyHeaders(userId);
+    if (idempotencyKey) {
+      headers['Idempotency-Key'] = idempotencyKey;
+    }
+
     const response = await fetch(`${PROXY_SERVER_URL}${endpoint}`, {
       method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
+      headers,
       body: JSON.stringify(data),
       signal: controller.signal,
     });
@@ -88,7 +119,7 @@ async function proxyRequest(
 /**
  * 调用 Gemini API 生成漫画脚本
  */
-export async function generateComicScript(concept: string): Promise<any> {
+export async function generateComicScript(concept: string, userId?: string): Promise<any> {
   const model = process.env.GEMINI_SCRIPT_MODEL || 'gemini-2.0-flash-exp';
 
   console.log(`[Proxy] 📝 正在生成脚本...`);
@@ -96,10 +127,11 @@ export async function generateComicScript(concept: string): Promise<any> {
   console.log(`[Proxy]    模型: ${model}`);
 
   try {
-    const data = await proxyRequest('/api/generate-script', {
-      concept,
-      model,
-    });
+    const body = { concept, model };
+    const data = await proxyRequest(
+      '/api/generate-script', body, REQUEST_TIMEOUT,
+      contentIdempotencyKey('/api/generate-script', body), userId
+    );
 
     if (!data.success) {
       throw new Error(data.error || '生成脚本失败');
@@ -119,7 +151,8 @@ export async function generateComicScript(concept: string): Promise<any> {
 export async function generatePanelImage(
   panel: any,
   style: string,
-  referenceImageData?: string
+  referenceImageData?: string,
+  userId?: string
 ): Promise<string> {
   const model = process.env.GEMINI_IMAGE_MODEL || 'gemini-2.0-flash-exp';
 
@@ -128,12 +161,11 @@ export async function generatePanelImage(
   console.log(`[Proxy]    参考: ${referenceImageData ? '有' : '无'}`);
 
   try {
-    const data = await proxyRequest('/api/generate-image', {
-      panel,
-      style,
-      model,
-      referenceImageData,
-    });
+    const body = { panel, style, model, referenceImageData };
+    const data = await proxyRequest(
+      '/api/generate-image', body, REQUEST_TIMEOUT,
+      contentIdempotencyKey('/api/generate-image', body), userId
+    );
 
     if (!data.success) {
       throw new Error(data.error || '生成图片失败');
@@ -147,13 +179,61 @@ export async function generatePanelImage(
   }
 }
 
+/**
+ * 调用 Gemini API 生成图片，直接获取图片字节（不经过 Base64）
+ * 适合服务端直接落盘的场景；可选让代理服务器转码为 JPEG / WebP
+ */
+export async function generatePanelImageBinary(
+  panel: any,
+  style: string,
+  format?: 'png' | 'jpeg' | 'webp',
+  quality?: number,
+  userId?: string
+): Promise<{ buffer: Buffer; mimeType: string }> {
+  const controller = new AbortController();
+  const timeoutId = setTimeout(() => controller.abort(), REQUEST_TIMEOUT);
+
+  console.log(`[Proxy] 🎨 正在生成第 ${panel.panelNumber} 格图片（二进制）...`);
+
+  try {
+    const response = await fetch(`${PROXY_SERVER_URL}/api/generate-image`, {
+      method: 'POST',
+      headers: proxyHeaders(userId, { 'Accept': 'image/*' }),
+      body: JSON.stringify({ panel, style, format, quality }),
+      signal: controller.signal,
+    });
+
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `HTTP ${response.status}: ${response.statusText}`);
+    }
+
+    const buffer = Buffer.from(await response.arrayBuffer());
+    const mimeType = response.headers.get('Content-Type') || 'image/png';
+    console.log(`[Proxy] ✅ 图片生成成功 (${(buffer.length / 1024).toFixed(1)} KB, ${mimeType})`);
+    return { buffer, mimeType };
+  } catch (error: any) {
+    if (error.name === 'AbortError') {
+      throw new Error(`请求超时 (${REQUEST_TIMEOUT/1000}秒)`);
+    }
+    console.error(`[Proxy] ❌ 图片生成失败:`, error);
+    throw error;
+  } finally {
+    clearTimeout(timeoutId);
+  }
+}
+
 /**
  * 重新生成图片
+ * 每次点击都应生成新图，因此幂等键由调用方按“一次点击”提供：漫画生成页每次点击生成一个
+ * Idempotency-Key，经 /api/generate-comic/regenerate 转发到这里，同一次点击的重试不会重复生成
  */
 export async function regeneratePanelImage(
   panel: any,
   style: string,
-  referenceImageData?: string
+  referenceImageData?: string,
+  idempotencyKey?: string,
+  userId?: string
 ): Promise<string> {
   console.log(`[Proxy] 🔄 重新生成第 ${panel.panelNumber} 格图片...`);
 
@@ -162,7 +242,7 @@ export async function regeneratePanelImage(
       panel,
       style,
       referenceImageData,
-    });
+    }, REQUEST_TIMEOUT, idempotencyKey, userId);
 
     if (!data.success) {
       throw new Error(data.error || '重新生成失败');
@@ -176,6 +256,73 @@ export async function regeneratePanelImage(
   }
 }
 
+/**
+ * 批量生成整部漫画的图片（由代理服务器并发生成）
+ * 返回每一格的结果，单格失败不影响其他格
+ */
+export async function generateComicImages(
+  panels: any[],
+  style: string,
+  concurrency?: number,
+  userId?: string
+): Promise<any[]> {
+  console.log(`[Proxy] 📚 正在批量生成 ${panels.length} 格图片...`);
+  console.log(`[Proxy]    风格: ${style}`);
+
+  try {
+    // 批量任务耗时接近最慢的一格，但仍给足余量
+    const data = await proxyRequest('/api/generate-comic', {
+      panels,
+      style,
+      concurrency,
+    }, REQUEST_TIMEOUT * 3, undefined, userId);
+
+    console.log(`[Proxy] ✅ 批量生成完成: 成功 ${data.succeeded}/${data.totalPanels}，耗时 ${data.elapsed}s`);
+    return data.results;
+  } catch (error) {
+    console.error(`[Proxy] ❌ 批量生成失败:`, error);
+    throw error;
+  }
+}
+
+/**
+ * 提交持久化的整部漫画生成任务（脚本 + 全部图片），立即返回任务 ID
+ * 任务在代理服务器上后台执行，不受请求超时、浏览器关闭或代理重启影响
+ */
+export async function submitComicJob(
+  concept: string,
+  style: string,
+  concurrency?: number,
+  userId?: string
+): Promise<string> {
+  const model = process.env.GEMINI_SCRIPT_MODEL || 'gemini-2.0-flash-exp';
+  const data = await proxyRequest('/api/jobs', { concept, style, model, concurrency }, REQUEST_TIMEOUT, undefined, userId);
+  console.log(`[Proxy] 🚀 已提交任务 ${data.jobId}`);
+  return data.jobId;
+}
+
+/**
+ * 查询任务状态；withImages 为 true 且任务已结束时返回带图片的完整结果
+ */
+export async function getComicJob(jobId: string, withImages: boolean = false): Promise<any> {
+  const path = withImages ? `/api/jobs/${jobId}/result` : `/api/jobs/${jobId}`;
+  const response = await fetch(`${PROXY_SERVER_URL}${path}`, {
+    signal: AbortSignal.timeout(REQUEST_TIMEOUT),
+  });
+  const data = await response.json().catch(() => ({}));
+  if (!response.ok) {
+    throw new Error(data.error || `HTTP ${response.status}: ${response.statusText}`);
+  }
+  return data;
+}
+
+/**
+ * 取消任务，已生成的格子保留
+ */
+export async function cancelComicJob(jobId: string): Promise<void> {
+  await proxyRequest(`/api/jobs/${jobId}/cancel`, {});
+}
+
 /**
  * 健康检查
  */
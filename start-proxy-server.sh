@@ -30,7 +30,7 @@ source .venv/bin/activate
 echo ""
 echo "📦 检查 Python 依赖..."
 
-if ! python3 -c "import flask" 2>/dev/null; then
+if ! python3 -c "import quart" 2>/dev/null; then
     echo "安装依赖中..."
     uv pip install -q -r requirements.txt
 
@@ -61,4 +61,5 @@ echo "🎯 启动 Python 代理服务器"
 echo "================================"
 echo ""
 
-python3 gemini_proxy_server.py
+# 生产入口：先绑定端口、预加载应用，再 fork 出 GEMINI_WORKERS 个 worker（默认 1）
+exec python3 -m gemini_proxy.prefork
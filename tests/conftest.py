@@ -0,0 +1,15 @@
+"""
+pytest 公共配置：使用离线模拟后端，缓存和任务库放在临时目录，不访问 Gemini、不写项目目录
+"""
+
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="gemini-proxy-tests-")
+os.environ.setdefault("GEMINI_MOCK", "script_latency=0.1,image_latency=0.05,sigma=0,stream_chunks=4,seed=1")
+os.environ.setdefault("GEMINI_CONTEXT_CACHE", "0")
+os.environ.setdefault("GEMINI_SCRIPT_CACHE_FILE", os.path.join(_tmp, "scripts.json"))
+os.environ.setdefault("GEMINI_IMAGE_CACHE_DIR", os.path.join(_tmp, "images"))
+os.environ.setdefault("GEMINI_JOB_DB", os.path.join(_tmp, "jobs.sqlite3"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
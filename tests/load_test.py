@@ -0,0 +1,314 @@
+"""
+代理服务器压测
+按目标并发持续请求 /api/generate-script、/api/generate-image，统计吞吐量、延迟分位数、错误率和服务端内存峰值，
+结果写成 JSON，可以和其他提交的结果对比。
+
+用法:
+    # 自动启动一个使用模拟后端的服务器并压测（不消耗配额）
+    python tests/load_test.py --spawn --mock "script_latency=0.5,image_latency=2" -c 32 -d 30 -o results.json
+
+    # 压测已经在运行的服务器
+    python tests/load_test.py --url http://127.0.0.1:3001 --endpoints script -c 8 -d 60
+
+    # 对比两次结果，p95 变慢超过 10% 时返回非 0
+    python tests/load_test.py --compare baseline.json results.json --max-regression 10
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = {
+    "script": "/api/generate-script",
+    "image": "/api/generate-image",
+}
+
+
+def build_payload(endpoint, repeat):
+    """repeat=True 时使用固定内容（命中缓存），否则每次不同"""
+    tag = "repeat" if repeat else uuid.uuid4().hex
+    if endpoint == "script":
+        return {"concept": f"压测概念 {tag}"}
+    return {
+        "panel": {"panelNumber": 1, "sceneDescription": f"load test scene {tag}", "dialogue": "压测"},
+        "style": "default"
+    }
+
+
+def percentile(sorted_values, pct):
+    """最近秩法分位数"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, elapsed):
+    """samples: [(状态码或异常名, 耗时秒)]"""
+    statuses = {}
+    for status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [latency for status, latency in samples if status == 200]
+    latencies = sorted(latency * 1000 for _, latency in samples)
+    ok_sorted = sorted(latency * 1000 for latency in ok)
+    return {
+        "requests": len(samples),
+        "succeeded": len(ok),
+        "errorRate": round(1 - len(ok) / len(samples), 4) if samples else 0.0,
+        "statuses": statuses,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        # 成功请求的延迟（毫秒）；allLatency 包含失败请求
+        "latency": {
+            "p50": _round(percentile(ok_sorted, 50)),
+            "p95": _round(percentile(ok_sorted, 95)),
+            "p99": _round(percentile(ok_sorted, 99)),
+            "max": _round(ok_sorted[-1] if ok_sorted else None),
+            "mean": _round(sum(ok_sorted) / len(ok_sorted) if ok_sorted else None),
+        },
+        "allLatency": {
+            "p50": _round(percentile(latencies, 50)),
+            "p95": _round(percentile(latencies, 95)),
+            "p99": _round(percentile(latencies, 99)),
+        },
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+async def run_phase(client, endpoint, concurrency, duration, max_requests, warmup, repeat_ratio):
+    """以固定并发压测一个接口，直到时间到或请求数达到上限"""
+    path = ENDPOINTS[endpoint]
+    samples = []
+    issued = 0
+    deadline = None
+
+    async def one():
+        payload = build_payload(endpoint, random.random() < repeat_ratio)
+        start = time.perf_counter()
+        try:
+            response = await client.post(path, json=payload)
+            await response.aread()
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        return status, time.perf_counter() - start
+
+    # 预热请求不计入结果
+    if warmup:
+        await asyncio.gather(*[one() for _ in range(warmup)])
+
+    async def worker():
+        nonlocal issued
+        while time.perf_counter() < deadline and (not max_requests or issued < max_requests):
+            issued += 1
+            samples.append(await one())
+
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(samples, time.perf_counter() - start)
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def spawn_server(port, mock_spec, workdir, workers=1):
+    """启动使用模拟后端的服务器；缓存、任务库和日志都放在临时目录"""
+    env = {
+        **os.environ,
+        "GEMINI_MOCK": mock_spec or "1",
+        # 模拟后端不需要按真实配额限速
+        "GEMINI_KEY_RPM": os.getenv("GEMINI_KEY_RPM", "1000000"),
+        "GEMINI_KEY_BURST": os.getenv("GEMINI_KEY_BURST", "1000000"),
+        "GEMINI_IMAGE_CACHE_DIR": os.path.join(workdir, "images"),
+        "GEMINI_JOB_DB": os.path.join(workdir, "jobs.sqlite3"),
+        "GEMINI_LOG_LEVEL": os.getenv("GEMINI_LOG_LEVEL", "WARNING"),
+    }
+    log_file = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gemini_proxy.prefork", "--bind", f"127.0.0.1:{port}", "--workers", str(workers)],
+        cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    return process, log_file
+
+
+async def wait_ready(client, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("服务器启动超时")
+
+
+async def run_load_test(args):
+    process = log_file = None
+    workdir = tempfile.mkdtemp(prefix="proxy-load-") if args.spawn else None
+    base_url = args.url
+    if args.spawn:
+        base_url = f"http://127.0.0.1:{args.port}"
+        process, log_file = spawn_server(args.port, args.mock, workdir, args.workers)
+        print(f"🚀 已启动模拟后端服务器 (pid {process.pid})，日志: {workdir}/server.log")
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+            await wait_ready(client)
+            results = {}
+            for endpoint in args.endpoints:
+                print(f"📈 压测 {ENDPOINTS[endpoint]}: 并发 {args.concurrency}，{args.duration}s")
+                results[endpoint] = await run_phase(
+                    client, endpoint, args.concurrency, args.duration,
+                    args.requests, args.warmup, args.repeat_ratio
+                )
+                print_summary(endpoint, results[endpoint])
+            health = (await client.get("/health")).json()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+            log_file.close()
+
+    return {
+        "commit": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "url": base_url,
+            "endpoints": args.endpoints,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "repeatRatio": args.repeat_ratio,
+            "mock": args.mock if args.spawn else None,
+            "workers": args.workers if args.spawn else None,
+        },
+        "results": results,
+        "server": {
+            "maxRssMB": health.get("max_rss_mb"),
+            "mockBackend": health.get("mock_backend"),
+            "retry": health.get("retry"),
+        },
+    }
+
+
+def print_summary(endpoint, summary):
+    latency = summary["latency"]
+    print(f"   请求 {summary['requests']}，成功 {summary['succeeded']}，错误率 {summary['errorRate']:.2%}，"
+          f"吞吐 {summary['throughput']}/s")
+    print(f"   延迟 p50 {latency['p50']}ms  p95 {latency['p95']}ms  p99 {latency['p99']}ms  max {latency['max']}ms")
+    print(f"   状态码: {summary['statuses']}")
+
+
+def compare(baseline_path, current_path, max_regression):
+    """逐项对比两次结果；p95 / p99 变慢或吞吐下降超过 max_regression% 视为退化，返回退出码"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(current_path, encoding="utf-8") as f:
+        current = json.load(f)
+    print(f"📊 {baseline.get('commit')} -> {current.get('commit')}")
+    regressions = []
+    for endpoint, now in current["results"].items():
+        before = baseline["results"].get(endpoint)
+        if before is None:
+            continue
+        print(f"\n{ENDPOINTS.get(endpoint, endpoint)}")
+        rows = [
+            ("throughput", before["throughput"], now["throughput"], True),
+            ("errorRate", before["errorRate"], now["errorRate"], False),
+            ("p50", before["latency"]["p50"], now["latency"]["p50"], False),
+            ("p95", before["latency"]["p95"], now["latency"]["p95"], False),
+            ("p99", before["latency"]["p99"], now["latency"]["p99"], False),
+        ]
+        for name, old, new, higher_is_better in rows:
+            if old is None or new is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if name in ("throughput", "p95", "p99") and worse > max_regression:
+                flag = "  ⚠️ 退化"
+                regressions.append(f"{endpoint}.{name}")
+            print(f"  {name:<10} {old:>10} -> {new:>10}  ({change:+.1f}%){flag}")
+    old_rss = baseline.get("server", {}).get("maxRssMB")
+    new_rss = current.get("server", {}).get("maxRssMB")
+    if old_rss and new_rss:
+        print(f"\n内存峰值: {old_rss} MB -> {new_rss} MB ({(new_rss - old_rss) / old_rss * 100:+.1f}%)")
+    if regressions:
+        print(f"\n❌ 超过 {max_regression}% 的退化: {', '.join(regressions)}")
+        return 1
+    print("\n✅ 没有超过阈值的退化")
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gemini 代理服务器压测")
+    parser.add_argument("--url", default="http://127.0.0.1:3001", help="被测服务器地址")
+    parser.add_argument("--spawn", action="store_true", help="自动启动使用模拟后端的服务器")
+    parser.add_argument("--port", type=int, default=3101, help="--spawn 时服务器监听的端口")
+    parser.add_argument("--workers", type=int, default=1, help="--spawn 时服务器的 worker 进程数")
+    parser.add_argument("--mock", default="", help="模拟后端配置，如 script_latency=0.5,error_rate=0.01")
+    parser.add_argument("--endpoints", default="script,image", help="逗号分隔：script,image")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=30.0, help="每个接口压测的秒数")
+    parser.add_argument("-n", "--requests", type=int, default=0, help="每个接口的请求数上限（0 为不限）")
+    parser.add_argument("--warmup", type=int, default=0, help="预热请求数（不计入结果）")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="使用固定内容（命中缓存）的请求比例")
+    parser.add_argument("--timeout", type=float, default=600.0, help="单个请求的超时（秒）")
+    parser.add_argument("-o", "--output", help="结果 JSON 的保存路径")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="对比两次结果")
+    parser.add_argument("--max-regression", type=float, default=10.0, help="--compare 的退化阈值（%%）")
+    args = parser.parse_args()
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = [e for e in args.endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error(f"未知的接口: {', '.join(unknown)}")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        sys.exit(compare(*args.compare, args.max_regression))
+
+    result = asyncio.run(run_load_test(args))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"💾 结果已保存到 {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
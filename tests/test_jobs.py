@@ -0,0 +1,62 @@
+"""
+持久化任务的最终状态：部分格失败时任务完成，所有格都失败时任务失败
+使用离线模拟后端（见 conftest.py）：python -m pytest tests
+"""
+
+import asyncio
+
+import gemini_proxy_server as server
+from gemini_proxy.job_queue import FINISHED
+
+# 任务队列内部的 asyncio.Queue 绑定第一次使用时的事件循环，所有用例共用一个循环
+loop = asyncio.new_event_loop()
+
+
+async def run_job(concept):
+    """提交任务并等到结束，返回 /api/jobs/<jobId> 的内容"""
+    await server.job_queue.start()
+    try:
+        client = server.app.test_client()
+        response = await client.post("/api/jobs", json={"concept": concept, "style": "peach", "concurrency": 2})
+        assert response.status_code == 202
+        job_id = (await response.get_json())["jobId"]
+        for _ in range(200):
+            job = await (await client.get(f"/api/jobs/{job_id}")).get_json()
+            if job["status"] in FINISHED:
+                return job
+            await asyncio.sleep(0.05)
+        raise AssertionError(f"任务未结束: {job}")
+    finally:
+        await server.job_queue.stop()
+
+
+def failing_render(fail_panels):
+    """替换 render_panel_image：fail_panels 中的格（None 表示全部）抛出异常"""
+    render = server.render_panel_image
+
+    async def render_panel_image(panel, style_name, *args, **kwargs):
+        if fail_panels is None or panel["panelNumber"] in fail_panels:
+            raise server.ImageGenerationError("boom")
+        return await render(panel, style_name, *args, **kwargs)
+
+    return render_panel_image
+
+
+def test_all_panels_failed_marks_job_failed(monkeypatch):
+    monkeypatch.setattr(server, "render_panel_image", failing_render(None))
+    job = loop.run_until_complete(run_job("全部失败"))
+
+    assert job["status"] == "failed"
+    assert job["succeeded"] == 0
+    assert job["failed"] == job["totalPanels"] > 0
+    assert "生成失败" in job["error"]
+
+
+def test_partial_failure_completes_job(monkeypatch):
+    monkeypatch.setattr(server, "render_panel_image", failing_render({1}))
+    job = loop.run_until_complete(run_job("部分失败"))
+
+    assert job["status"] == "completed"
+    assert job["failed"] == 1
+    assert job["succeeded"] == job["totalPanels"] - 1
+
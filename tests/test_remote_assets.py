@@ -0,0 +1,58 @@
+"""
+上下文缓存的最小长度：短于模型最小缓存长度的系统提示词不创建缓存，直接内联发送
+使用离线模拟后端：python -m pytest tests
+"""
+
+import asyncio
+
+from google.genai import types
+
+from gemini_proxy.mock_genai import MockClient, parse_mock_config
+from gemini_proxy.remote_assets import RemoteAssets
+
+MODEL = "gemini-3-pro-preview"
+
+
+def mock_client():
+    # cache_min_tokens 使用默认值（4096），与真实模型一样拒绝太短的缓存
+    return MockClient(parse_mock_config("script_latency=0.01,sigma=0,image_size=64"))
+
+
+async def generate(assets, client, system_instruction):
+    config = types.GenerateContentConfig(system_instruction=system_instruction)
+    return await assets.generate(client, MODEL, "讲讲注意力机制", config)
+
+
+def test_short_prompt_skips_context_cache():
+    client = mock_client()
+    assets = RemoteAssets(upload_files=False)
+
+    async def run():
+        for _ in range(3):
+            await generate(assets, client, "你是一个漫画编剧。" * 10)
+
+    asyncio.run(run())
+    stats = assets.stats()
+    # 统计一次 token 数后不再尝试创建，也不会因创建失败进入等待
+    assert stats["contextsSkipped"] == 3
+    assert stats["contextsCreated"] == 0
+    assert stats["fallbacks"] == 0
+    assert client.aio.store.caches == {}
+
+
+def test_long_prompt_creates_context_cache():
+    client = mock_client()
+    assets = RemoteAssets(upload_files=False)
+
+    async def run():
+        response = None
+        for _ in range(2):
+            response = await generate(assets, client, "你是一个漫画编剧，" * 2000)
+        await assets.stop()
+        return response
+
+    response = asyncio.run(run())
+    stats = assets.stats()
+    assert stats["contextsCreated"] == 1
+    assert stats["contextsSkipped"] == 0
+    assert response.usage_metadata.cached_content_token_count > 4096
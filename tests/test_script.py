@@ -85,6 +85,42 @@ def generate_and_save_image(panel):
     
     return False
 
+def generate_and_save_all_images(panels):
+    """通过批量接口并发生成所有格的图片并保存"""
+    url = f"{BASE_URL}/api/generate-comic"
+    payload = {
+        "panels": panels,
+        "style": "cat",
+    }
+
+    try:
+        start = time.time()
+        response = requests.post(url, json=payload)
+        if response.status_code != 200:
+            print(f"❌ HTTP 错误: {response.status_code}")
+            return 0
+
+        data = response.json()
+        success_count = 0
+        for result in data.get("results", []):
+            panel_num = result.get("panelNumber")
+            if not result.get("success"):
+                print(f"❌ 第 {panel_num} 格失败: {result.get('error')}")
+                continue
+
+            img_path = os.path.join(OUTPUT_DIR, f"{panel_num}.png")
+            with open(img_path, 'wb') as f:
+                f.write(base64.b64decode(result.get("imageData")))
+            print(f"✅ 第 {panel_num} 格保存成功 ({result.get('elapsed')}s) -> {img_path}")
+            success_count += 1
+
+        print(f"⏱️ 批量生成总耗时: {time.time()-start:.2f}s")
+        return success_count
+
+    except Exception as e:
+        print(f"❌ 请求异常: {e}")
+        return 0
+
 def main():
     print(f"🚀 开始测试完整工作流: {CONCEPT}")
     setup_directories()
@@ -111,16 +147,10 @@ def main():
         # 2. 保存脚本到 TXT
         save_script_to_txt(panels)
 
-        # 3. 遍历脚本生成图片
+        # 3. 根据脚本批量并发生成图片
         print(f"\n🎨 [步骤 2] 开始根据脚本生成图片 (共 {len(panels)} 张)...")
-        
-        success_count = 0
-        for panel in panels:
-            if generate_and_save_image(panel):
-                success_count += 1
-            # 加上一点延时，防止请求过快（可选）
-            break
-            time.sleep(0.5)
+
+        success_count = generate_and_save_all_images(panels)
 
         print(f"\n{'='*50}")
         print(f"🎉 流程结束！")
@@ -0,0 +1,79 @@
+"""
+流式接口的请求汇总行：响应体发完之后才写出，带上生成过程中 annotate 的字段
+使用离线模拟后端（见 conftest.py）：python -m pytest tests
+"""
+
+import asyncio
+import json
+import logging
+
+import gemini_proxy_server as server
+from gemini_proxy import metrics
+from gemini_proxy.structured_log import logger
+
+
+class Records(logging.Handler):
+    """收集 gemini_proxy 日志记录"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def summaries(self, path):
+        return [r.fields for r in self.records if r.event == "request" and r.fields.get("path") == path]
+
+
+def in_flight(endpoint):
+    return metrics.REQUESTS_IN_FLIGHT.labels(endpoint)._value.get()
+
+
+async def stream_script(client, concept):
+    response = await client.post("/api/generate-script/stream", json={"concept": concept})
+    body = await response.get_data(as_text=True)
+    assert response.status_code == 200
+    assert '"event": "done"' in body
+
+
+def test_stream_summary_written_after_body():
+    handler = Records()
+    logger.addHandler(handler)
+    try:
+        async def run():
+            client = server.app.test_client()
+            await stream_script(client, "注意力机制")
+            await stream_script(client, "注意力机制")
+
+        asyncio.run(run())
+    finally:
+        logger.removeHandler(handler)
+
+    first, second = handler.summaries("/api/generate-script/stream")
+    # 第一次调用上游：耗时覆盖整个生成过程，首格耗时在汇总行里
+    assert first["status"] == 200
+    assert "firstPanelMs" in first
+    assert first["durationMs"] >= first["firstPanelMs"]
+    assert first["durationMs"] >= 100
+    # 第二次命中脚本缓存
+    assert second["cached"] is True
+    assert "firstPanelMs" in second
+
+
+def test_stream_in_flight_until_body_sent():
+    endpoint = "/api/generate-script/stream"
+
+    async def run():
+        client = server.app.test_client()
+        async with client.request(endpoint, method="POST", headers={"Content-Type": "application/json"}) as connection:
+            await connection.send(json.dumps({"concept": "卷积神经网络"}).encode())
+            await connection.send_complete()
+            body = await connection.receive()
+            # 响应头已发出、还在等上游生成：请求仍算在途
+            assert in_flight(endpoint) == 1
+            while b'"event": "done"' not in body:
+                body += await connection.receive()
+        assert in_flight(endpoint) == 0
+
+    asyncio.run(run())